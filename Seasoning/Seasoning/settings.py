@@ -198,6 +198,7 @@ TEMPLATE_CONTEXT_PROCESSORS = (
     "django.core.context_processors.tz",
     "django.core.context_processors.request",
     'django.contrib.messages.context_processors.messages',
+    'general.context_processors.site_statistics',
 )
 
 
@@ -292,6 +293,10 @@ LOGGING = {
         'django.db.backends': {
             'level': 'DEBUG',
             'handlers': ['console']
+        },
+        'recipes.engine': {
+            'level': 'WARNING',
+            'handlers': ['console']
         }
     }
 }
@@ -328,3 +333,10 @@ DDF_DEFAULT_DATA_FIXTURE = 'Seasoning.utils.UserNamesOverwriter'
 # will cause certain tests depending on MySQL fail. Set this setting to True to
 # skip these tests when an sqlite backend is in use.
 SKIP_MYSQL_TESTS = True
+
+# Store the footprint of every recipe on every day of the year besides the footprint on the
+# first day of every month (see recipes.models.RecipeMonthlyFootprint)
+DAILY_RECIPE_FOOTPRINTS = False
+
+# Remove Dutch inflections from the words in the recipe search index and in search queries
+RECIPE_SEARCH_STEMMING = True
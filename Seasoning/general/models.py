@@ -1,4 +1,5 @@
-from django.db import models
+import time
+from django.db import models, IntegrityError
 
 class StaticPage(models.Model):
     
@@ -13,4 +14,64 @@ class StaticPage(models.Model):
     last_modified = models.DateTimeField(auto_now=True)
     
     def __unicode__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+# A process reads the version of a set of data at most once per this amount of seconds,
+# see ``DataVersionManager.current_version``
+VERSION_CHECK_INTERVAL = 2
+
+class DataVersionManager(models.Manager):
+    
+    # The versions read by this process, as (version, time read) tuples by name
+    _read_versions = {}
+    
+    def current_version(self, name):
+        """
+        Return the version of the data with the given name, which is 0 if it has never
+        changed. Versions are read from the database at most once per VERSION_CHECK_INTERVAL
+        seconds, but changes made by this process are noticed immediately.
+        
+        """
+        now = time.time()
+        try:
+            version, read = self._read_versions[name]
+            if now - read < VERSION_CHECK_INTERVAL:
+                return version
+        except KeyError:
+            pass
+        versions = list(self.filter(name=name).values_list('version', flat=True))
+        version = versions[0] if len(versions) > 0 else 0
+        self._read_versions[name] = (version, now)
+        return version
+    
+    def increment(self, name):
+        """
+        Increment the version of the data with the given name
+        
+        """
+        self._read_versions.pop(name, None)
+        if self.filter(name=name).update(version=models.F('version') + 1) <= 0:
+            try:
+                self.create(name=name, version=1)
+            except IntegrityError:
+                # Another process created the version in the meantime
+                self.filter(name=name).update(version=models.F('version') + 1)
+
+class DataVersion(models.Model):
+    """
+    The version of a set of data of which every process keeps a copy in memory, like
+    the ingredient catalog. Every change to the data increments its version, so the
+    processes know their copies have become outdated. The versions are kept in the
+    database because it is the only storage shared by all processes.
+    
+    """
+    class Meta:
+        db_table = 'dataversion'
+    
+    objects = DataVersionManager()
+    
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+    
+    def __unicode__(self):
+        return '%s: %d' % (self.name, self.version)
@@ -18,8 +18,7 @@ along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
     
 """
 from django import template
-from recipes.models import Recipe
-from django.db.models.aggregates import Max
+from recipes.statistics import get_site_statistics
 
 register = template.Library()
 
@@ -37,9 +36,13 @@ def mean_rating(rating):
     width_percentage = int((rating/5.0)*100)
     return '<span id="account-mean-rank-on" style="width: %d%%"></span><span id="account-mean-rank-off" style="width: %d%%"></span>' % (width_percentage, 100-width_percentage)
 
-@register.simple_tag
-def mean_footprint(footprint):
+@register.simple_tag(takes_context=True)
+def mean_footprint(context, footprint):
     if footprint is None:
         return '<span id="account-mean-footprint-off" style="width: 100%"></span>'
-    width_percentage = int((footprint/Recipe.objects.all().aggregate(Max('footprint'))['footprint__max'])*100)
+    # The site statistics are added to the context by the site_statistics context processor
+    statistics = context.get('site_statistics') or get_site_statistics()
+    if not statistics.max_footprint:
+        return '<span id="account-mean-footprint-off" style="width: 100%"></span>'
+    width_percentage = int((footprint/statistics.max_footprint)*100)
     return '<span id="account-mean-footprint-on" style="width: %d%%"></span><span id="account-mean-footprint-off" style="width: %d%%"></span>' % (width_percentage, 100-width_percentage)
\ No newline at end of file
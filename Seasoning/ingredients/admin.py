@@ -1,6 +1,6 @@
 from django.contrib import admin
 from ingredients.models import Country, Sea, Unit, Ingredient, TransportMethod,\
-    Synonym, CanUseUnit, AvailableInCountry, AvailableInSea
+    Synonym, CanUseUnit, AvailableInCountry, AvailableInSea, deferred_recompute
 from ingredients.fields import LastOfMonthWidget, MonthWidget
 from django.db import models
 from authentication.forms import ShownImageInput
@@ -49,9 +49,20 @@ class IngredientAdmin(admin.ModelAdmin):
                 AvailableInCountryInline,
                 AvailableInSeaInline ]
     
+    list_filter = ('accepted', 'is_always_available')
+    
     formfield_overrides = {
         models.ImageField: {'widget': ShownImageInput}}
     
+    def add_view(self, *args, **kwargs):
+        # Update the ingredient once, after all inlines have been saved
+        with deferred_recompute():
+            return super(IngredientAdmin, self).add_view(*args, **kwargs)
+    
+    def change_view(self, *args, **kwargs):
+        with deferred_recompute():
+            return super(IngredientAdmin, self).change_view(*args, **kwargs)
+    
 admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Country)
 admin.site.register(Sea)
@@ -0,0 +1,176 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import re
+import bisect
+import json
+from ingredients.catalog import get_catalog, normalize_name
+
+# The maximum amount of names returned for a query
+AUTOCOMPLETE_RESULTS = 20
+
+# The maximum amount of answered queries that are remembered by an index
+QUERY_CACHE_SIZE = 2000
+
+# The maximum amount of suggestions for an unknown name, and the minimal similarity of
+# a suggested name (the fraction of trigrams it shares with the unknown name)
+SUGGESTIONS = 5
+MIN_SUGGESTION_SIMILARITY = 0.3
+
+# Only this many characters of an unknown name are used to look for suggestions, which
+# bounds the time needed to find them
+MAX_SUGGESTION_QUERY_LENGTH = 50
+
+def trigrams(name):
+    """
+    Return the set of trigrams of the words in the given name. Every word is padded
+    with two spaces in front and one at the back, so short words still have trigrams
+    and the start of a word weighs more than its end.
+    
+    """
+    grams = set()
+    for word in re.split(r'\W+', normalize_name(name), flags=re.UNICODE):
+        if word:
+            padded = u'  %s ' % word
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class NameIndex(object):
+    """
+    An index over the names, plural names and synonyms of all accepted ingredients in a
+    catalog snapshot, answering autocomplete queries without touching the database.
+    
+    Every suffix of every normalized name is kept in one sorted list, so the names containing
+    a query are found with two binary searches. Names starting with the query come first,
+    followed by names with a word starting with it and then the other names. Within these
+    groups, shorter names come first.
+    
+    The JSON of every name is serialized when the index is built, and the answer to every
+    query is remembered, so most requests only join a few strings or do a single lookup.
+    
+    The index also maps every trigram to the names containing it, which is used to suggest
+    names that look like a name that is not known (e.g. because of a typo).
+    
+    """
+    
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        
+        names = set()
+        for ingredient in snapshot.ingredients.values():
+            if not ingredient.accepted:
+                continue
+            names.update([ingredient.name, ingredient.plural_name])
+            for synonym in ingredient.synonyms:
+                names.update([synonym.name, synonym.plural_name])
+        names.discard(u'')
+        names.discard(None)
+        self.names = sorted(names)
+        
+        self.fragments = [json.dumps({'value': name, 'label': name}) for name in self.names]
+        self.suffixes = []
+        self.ranks = []
+        for i, name in enumerate(self.names):
+            normalized = normalize_name(name)
+            self.ranks.append((len(normalized), normalized))
+            self.suffixes.extend((normalized[start:], start, i) for start in range(len(normalized)))
+        self.suffixes.sort()
+        self.suffix_keys = [suffix[0] for suffix in self.suffixes]
+        
+        self.trigram_counts = []
+        self.trigram_names = {}
+        for i, name in enumerate(self.names):
+            grams = trigrams(name)
+            self.trigram_counts.append(len(grams))
+            for gram in grams:
+                self.trigram_names.setdefault(gram, []).append(i)
+        self.query_cache = {}
+    
+    def match(self, query, limit=AUTOCOMPLETE_RESULTS):
+        """
+        Return the positions in ``names`` of the best matches for the given query
+        
+        """
+        query = normalize_name(query)
+        if not query:
+            return []
+        first = bisect.bisect_left(self.suffix_keys, query)
+        last = bisect.bisect_left(self.suffix_keys, query + u'\uffff', first)
+        
+        # The best rank of every matching name, 0 for a match at the start of the name, 1
+        # at the start of another word and 2 elsewhere
+        matches = {}
+        for _, start, i in self.suffixes[first:last]:
+            if start == 0:
+                rank = 0
+            elif not self.ranks[i][1][start - 1].isalnum():
+                rank = 1
+            else:
+                rank = 2
+            if rank < matches.get(i, 3):
+                matches[i] = rank
+        return sorted(matches, key=lambda i: (matches[i], self.ranks[i]))[:limit]
+    
+    def complete(self, query, limit=AUTOCOMPLETE_RESULTS):
+        """
+        Return the JSON list of the best matching names for the given query, in the format
+        of the jQuery UI autocomplete widget
+        
+        """
+        key = (query, limit)
+        try:
+            return self.query_cache[key]
+        except KeyError:
+            pass
+        result = u'[%s]' % u', '.join(self.fragments[i] for i in self.match(query, limit))
+        if len(self.query_cache) >= QUERY_CACHE_SIZE:
+            self.query_cache.clear()
+        self.query_cache[key] = result
+        return result
+
+    def suggest(self, name, limit=SUGGESTIONS):
+        """
+        Return the names that look most like the given name, most similar first
+        
+        """
+        grams = trigrams(name[:MAX_SUGGESTION_QUERY_LENGTH])
+        shared = {}
+        for gram in grams:
+            for i in self.trigram_names.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        similarities = dict((i, float(count)/(len(grams) + self.trigram_counts[i] - count))
+                            for i, count in shared.items())
+        matches = [i for i in similarities if similarities[i] >= MIN_SUGGESTION_SIMILARITY]
+        matches.sort(key=lambda i: (-similarities[i], self.ranks[i]))
+        return [self.names[i] for i in matches[:limit]]
+
+# The name index of this process
+_name_index = None
+
+def get_name_index():
+    """
+    Return the name index of this process, which is rebuilt together with the catalog
+    snapshot it was built from
+    
+    """
+    global _name_index
+    snapshot = get_catalog()
+    if _name_index is None or _name_index.snapshot is not snapshot:
+        _name_index = NameIndex(snapshot)
+    return _name_index
@@ -0,0 +1,229 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import time
+import unicodedata
+import numpy
+from general.models import DataVersion
+from django.db.models.signals import post_save, post_delete
+from ingredients.models import Unit, Ingredient, Synonym, CanUseUnit, Country, Sea, TransportMethod,\
+    AvailableInCountry, AvailableInSea, day_of_year
+
+# The name of the version of the catalog. Every change to the catalog increments this
+# version, so every process knows its snapshot has become outdated.
+CATALOG_VERSION = 'ingredients_catalog'
+
+# The models the catalog is built from
+CATALOG_MODELS = (Unit, Ingredient, Synonym, CanUseUnit, Country, Sea, TransportMethod, AvailableInCountry, AvailableInSea)
+
+def normalize_name(name):
+    """
+    Return the form of a name used for looking it up: lowercase and without accents
+    
+    """
+    name = unicodedata.normalize('NFKD', unicode(name).strip().lower())
+    return u''.join(char for char in name if not unicodedata.combining(char))
+
+class CatalogValue(object):
+    """
+    A compact, read-only copy of a catalog object. The attributes are given as
+    keyword arguments and must be listed in the ``__slots__`` of the subclass.
+    
+    """
+    __slots__ = ()
+    
+    def __init__(self, **values):
+        for attr, value in values.items():
+            setattr(self, attr, value)
+
+class UnitValue(CatalogValue):
+    __slots__ = ('id', 'name', 'short_name', 'parent_unit_id', 'ratio')
+
+class LocationValue(CatalogValue):
+    """
+    A Country or a Sea
+    
+    """
+    __slots__ = ('id', 'name', 'distance')
+
+class TransportMethodValue(CatalogValue):
+    __slots__ = ('id', 'name', 'emission_per_km')
+
+class AvailableInValue(CatalogValue):
+    __slots__ = ('id', 'location_id', 'transport_method_id', 'date_from', 'date_until', 'footprint')
+
+class IngredientValue(CatalogValue):
+    """
+    An ingredient, with lists of its AvailableIn objects and its synonyms
+    
+    """
+    __slots__ = ('id', 'name', 'plural_name', 'type', 'veganism', 'accepted', 'base_footprint', 'preservability',
+                 'preservation_footprint', 'primary_unit_id', 'available_ins', 'synonyms')
+
+class SynonymValue(CatalogValue):
+    __slots__ = ('id', 'name', 'plural_name', 'ingredient_id')
+
+class CatalogSnapshot(object):
+    """
+    A read-only copy of the entire ingredient catalog, loaded with a few queries. It
+    contains the footprint of every ingredient on every day of the year, calculated
+    by the FootprintEngine.
+    
+    """
+    
+    def __init__(self, version=None):
+        self.version = version
+        self.created = time.time()
+        
+        self.units = dict((unit.id, UnitValue(id=unit.id, name=unit.name, short_name=unit.short_name,
+                                              parent_unit_id=unit.parent_unit_id, ratio=unit.ratio))
+                          for unit in Unit.objects.all())
+        self.countries = dict((country.id, LocationValue(id=country.id, name=country.name, distance=country.distance))
+                              for country in Country.objects.all())
+        self.seas = dict((sea.id, LocationValue(id=sea.id, name=sea.name, distance=sea.distance))
+                         for sea in Sea.objects.all())
+        self.transport_methods = dict((tpm.id, TransportMethodValue(id=tpm.id, name=tpm.name, emission_per_km=tpm.emission_per_km))
+                                      for tpm in TransportMethod.objects.all())
+        
+        self.ingredients = {}
+        for ingredient in Ingredient.objects.all():
+            self.ingredients[ingredient.id] = IngredientValue(id=ingredient.id, name=ingredient.name, plural_name=ingredient.plural_name,
+                                                              type=ingredient.type,
+                                                              veganism=ingredient.veganism, accepted=ingredient.accepted,
+                                                              base_footprint=ingredient.base_footprint,
+                                                              preservability=ingredient.preservability,
+                                                              preservation_footprint=ingredient.preservation_footprint,
+                                                              primary_unit_id=None, available_ins=[], synonyms=[])
+        for synonym in Synonym.objects.filter(ingredient__isnull=False):
+            self.ingredients[synonym.ingredient_id].synonyms.append(SynonymValue(id=synonym.id, name=synonym.name,
+                                                                                 plural_name=synonym.plural_name,
+                                                                                 ingredient_id=synonym.ingredient_id))
+        
+        # Maps every normalized name, plural name and synonym to the ingredients with it, as
+        # (priority, ingredient id, accepted) tuples. Names have priority over plural names.
+        self.names = {}
+        for ingredient in self.ingredients.values():
+            names = [(0, ingredient.name), (1, ingredient.plural_name)]
+            for synonym in ingredient.synonyms:
+                names.extend([(0, synonym.name), (1, synonym.plural_name)])
+            for priority, name in names:
+                if name:
+                    self.names.setdefault(normalize_name(name), []).append((priority, ingredient.id, ingredient.accepted))
+        
+        # Maps (ingredient id, unit id) to the conversion factor of the unit for the ingredient
+        self.conversion_factors = {}
+        # Maps the id of every ingredient to the set of ids of the units it can use. These
+        # are exactly the units it has a conversion factor for.
+        self.useable_units = {}
+        derived_units = {}
+        for unit in self.units.values():
+            if unit.parent_unit_id is not None and unit.ratio is not None:
+                derived_units.setdefault(unit.parent_unit_id, []).append(unit)
+        for ingredient_id, unit_id, is_primary_unit, conversion_factor in CanUseUnit.objects.values_list('ingredient', 'unit', 'is_primary_unit', 'conversion_factor'):
+            self.conversion_factors[(ingredient_id, unit_id)] = conversion_factor
+            self.useable_units.setdefault(ingredient_id, set()).add(unit_id)
+            if is_primary_unit:
+                self.ingredients[ingredient_id].primary_unit_id = unit_id
+            # An ingredient that can use a base unit can use all units derived from it, 
+            # unless their ratio is unknown
+            for unit in derived_units.get(unit_id, []):
+                self.conversion_factors.setdefault((ingredient_id, unit.id), conversion_factor*unit.ratio)
+                self.useable_units[ingredient_id].add(unit.id)
+        for model in (AvailableInCountry, AvailableInSea):
+            for avail in model.objects.all():
+                self.ingredients[avail.ingredient_id].available_ins.append(AvailableInValue(id=avail.id, location_id=avail.location_id,
+                                                                                            transport_method_id=avail.transport_method_id,
+                                                                                            date_from=avail.date_from, date_until=avail.date_until,
+                                                                                            footprint=avail.footprint))
+        
+        from ingredients.engine import FootprintEngine
+        engine = FootprintEngine()
+        self.index = engine.index
+        # Row X - 1 contains the footprint of every ingredient on day X of the year
+        self.calendar = engine.footprint_calendar()
+    
+    def footprint(self, ingredient_id, date):
+        """
+        Return the footprint of the ingredient with the given id on the given date, or
+        None if it is not available on that date. Raises a KeyError if the ingredient
+        is not in the snapshot.
+        
+        """
+        footprint = self.calendar[day_of_year(date) - 1, self.index[ingredient_id]]
+        if numpy.isnan(footprint):
+            return None
+        return float(footprint)
+    
+    def ingredient_ids_with_name(self, name, accepted_only=False):
+        """
+        Return the sorted ids of the ingredients with the given name, plural name or synonym,
+        ignoring case and accents. If the name matches the (singular) name of an ingredient,
+        ingredients with it as their plural name are not returned.
+        
+        """
+        matches = [match for match in self.names.get(normalize_name(name), []) if match[2] or not accepted_only]
+        if len(matches) <= 0:
+            return []
+        priority = min(match[0] for match in matches)
+        return sorted(set(match[1] for match in matches if match[0] == priority))
+    
+    def can_use_unit(self, ingredient_id, unit_id):
+        """
+        Return whether the ingredient with the given id can use the unit with the given id
+        
+        """
+        return unit_id in self.useable_units.get(ingredient_id, ())
+    
+    def conversion_factor(self, ingredient_id, unit_id):
+        """
+        Return the conversion factor of the given unit for the ingredient with the given
+        id, or None if the ingredient can't use this unit
+        
+        """
+        return self.conversion_factors.get((ingredient_id, unit_id))
+
+# The snapshot of this process
+_snapshot = None
+
+def get_catalog():
+    """
+    Return the catalog snapshot of this process, which is rebuilt first if the catalog 
+    has changed since it was loaded. Changes made by other processes are noticed within
+    ``general.models.VERSION_CHECK_INTERVAL`` seconds.
+    
+    """
+    global _snapshot
+    version = DataVersion.objects.current_version(CATALOG_VERSION)
+    if _snapshot is None or _snapshot.version != version:
+        _snapshot = CatalogSnapshot(version)
+    return _snapshot
+
+def invalidate_catalog(**kwargs):
+    """
+    Mark the catalog snapshot of every process as outdated. This is connected to the 
+    post_save and post_delete signals of every model in the catalog.
+    
+    """
+    global _snapshot
+    _snapshot = None
+    DataVersion.objects.increment(CATALOG_VERSION)
+
+for model in CATALOG_MODELS:
+    post_save.connect(invalidate_catalog, sender=model, dispatch_uid='invalidate_catalog_%s' % model.__name__)
+    post_delete.connect(invalidate_catalog, sender=model, dispatch_uid='invalidate_catalog_%s' % model.__name__)
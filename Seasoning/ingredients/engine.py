@@ -0,0 +1,155 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import numpy
+from ingredients.models import Ingredient, AvailableIn, AvailableInCountry, AvailableInSea, day_of_year
+
+# The first day of the year that comes after the 29th of February in BASE_YEAR. Days
+# before it are 366 days apart from the same date in the next year, days after it only 365.
+FIRST_DAY_AFTER_LEAP_DAY = 60
+
+class FootprintEngine(object):
+    """
+    Calculates the footprints of a whole set of ingredients on one or many days at once.
+    
+    The ingredients and all of their AvailableIn objects are loaded into NumPy arrays
+    when the engine is created. After that, the minimal footprint of every ingredient
+    on every requested day is calculated in a single vectorized pass, following the
+    same rules as ``Ingredient.get_available_in_with_smallest_footprint``.
+    
+    Footprints are returned as a matrix with a row for every requested day and a column
+    for every ingredient (in the order of ``ingredient_ids``). If an ingredient is not
+    available on a day, its footprint on that day is NaN.
+    
+    """
+    
+    def __init__(self, ingredient_ids=None):
+        """
+        Load the given ingredients, or every ingredient if no ids are given
+        
+        """
+        ingredients = Ingredient.objects.all()
+        available_ins_country = AvailableInCountry.objects.filter(ingredient__type=Ingredient.SEASONAL)
+        available_ins_sea = AvailableInSea.objects.filter(ingredient__type=Ingredient.SEASONAL_SEA)
+        if ingredient_ids is not None:
+            ingredients = ingredients.filter(pk__in=ingredient_ids)
+            available_ins_country = available_ins_country.filter(ingredient__in=ingredient_ids)
+            available_ins_sea = available_ins_sea.filter(ingredient__in=ingredient_ids)
+        
+        ingredients = list(ingredients.order_by('id').values_list('id', 'type', 'base_footprint',
+                                                                   'preservability', 'preservation_footprint',
+                                                                   'accepted'))
+        self.ingredient_ids = numpy.array([ing[0] for ing in ingredients], dtype=numpy.int64)
+        self.types = numpy.array([ing[1] for ing in ingredients], dtype=numpy.int64)
+        self.base_footprints = numpy.array([ing[2] for ing in ingredients], dtype=numpy.float64)
+        self.preservabilities = numpy.array([ing[3] for ing in ingredients], dtype=numpy.int64)
+        self.preservation_footprints = numpy.array([ing[4] for ing in ingredients], dtype=numpy.float64)
+        self.accepted = numpy.array([ing[5] for ing in ingredients], dtype=numpy.bool_)
+        self.index = dict((ingredient_id, i) for i, ingredient_id in enumerate(self.ingredient_ids))
+        
+        available_ins = list(available_ins_country.values_list('ingredient', 'date_from', 'date_until', 'footprint'))
+        available_ins.extend(available_ins_sea.values_list('ingredient', 'date_from', 'date_until', 'footprint'))
+        # Sort the available ins by ingredient, so the minimum per ingredient can be
+        # calculated with a single reduceat
+        available_ins = sorted((self.index[avail[0]], day_of_year(avail[1]), day_of_year(avail[2]), avail[3])
+                               for avail in available_ins)
+        self.available_in_ingredients = numpy.array([avail[0] for avail in available_ins], dtype=numpy.int64)
+        self.days_from = numpy.array([avail[1] for avail in available_ins], dtype=numpy.int64)
+        self.days_until = numpy.array([avail[2] for avail in available_ins], dtype=numpy.int64)
+        self.available_in_footprints = numpy.array([avail[3] for avail in available_ins], dtype=numpy.float64)
+    
+    def __len__(self):
+        return len(self.ingredient_ids)
+    
+    @staticmethod
+    def next_year(days):
+        """
+        Move the given days of BASE_YEAR to the next year, keeping the day numbers
+        relative to the start of BASE_YEAR. See ``AvailableIn.next_year``.
+        
+        """
+        return days + numpy.where(days < FIRST_DAY_AFTER_LEAP_DAY, AvailableIn.DAYS_IN_BASE_YEAR,
+                                  AvailableIn.DAYS_IN_BASE_YEAR - 1)
+    
+    def footprints_on_days(self, days):
+        """
+        Return the footprint matrix for the given days of the year (starting at 1)
+        
+        """
+        days = numpy.asarray(days, dtype=numpy.int64)
+        footprints = numpy.empty((len(days), len(self)), dtype=numpy.float64)
+        footprints.fill(numpy.nan)
+        
+        # Basic ingredients always have their base footprint
+        basic = self.types == Ingredient.BASIC
+        footprints[:, basic] = self.base_footprints[basic]
+        
+        if len(self.available_in_ingredients) == 0:
+            return footprints
+        
+        # One row per day, one column per available in
+        days = days[:, numpy.newaxis]
+        preservabilities = self.preservabilities[self.available_in_ingredients]
+        preservation_footprints = self.preservation_footprints[self.available_in_ingredients]
+        
+        # See AvailableIn.is_active
+        dates = numpy.where(days < self.days_from, self.next_year(days), days)
+        wrapped = self.days_from > self.days_until
+        days_until = numpy.where(wrapped, self.next_year(self.days_until), self.days_until)
+        active = dates <= days_until
+        available = dates <= days_until + preservabilities
+        
+        # See AvailableIn.days_apart
+        days_apart = numpy.where(days < self.days_until, self.next_year(days), days) - self.days_until
+        
+        available_in_footprints = self.available_in_footprints + numpy.where(active, 0, days_apart)*preservation_footprints
+        available_in_footprints = numpy.where(available, available_in_footprints, numpy.inf)
+        
+        # The minimal footprint for every ingredient that has available ins
+        ingredients, starts = numpy.unique(self.available_in_ingredients, return_index=True)
+        smallest_footprints = numpy.minimum.reduceat(available_in_footprints, starts, axis=1)
+        smallest_footprints[numpy.isinf(smallest_footprints)] = numpy.nan
+        footprints[:, ingredients] = smallest_footprints
+        
+        return footprints
+    
+    def footprints(self, dates):
+        """
+        Return the footprint matrix for the given dates
+        
+        """
+        return self.footprints_on_days([day_of_year(date) for date in dates])
+    
+    def footprint_calendar(self):
+        """
+        Return the footprint matrix for every day of the year. Row X - 1 contains
+        the footprints on day X of the year.
+        
+        """
+        return self.footprints_on_days(numpy.arange(1, AvailableIn.DAYS_IN_BASE_YEAR + 1))
+    
+    def footprints_by_id(self, date):
+        """
+        Return a dict mapping the id of every ingredient to its footprint on the given
+        date, or None if it is not available on that date.
+        
+        """
+        footprints = self.footprints([date])[0]
+        return dict((int(ingredient_id), None if numpy.isnan(footprint) else float(footprint))
+                    for ingredient_id, footprint in zip(self.ingredient_ids, footprints))
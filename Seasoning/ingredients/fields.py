@@ -26,6 +26,8 @@ from django.utils.safestring import mark_safe
 import calendar
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.core.validators import EMPTY_VALUES
+from ingredients import catalog
 import datetime
 
 class MonthWidget(Widget):
@@ -86,7 +88,11 @@ class AutoCompleteSelectIngredientWidget(forms.widgets.TextInput):
         if value:
             try:
                 ingredient_pk = int(value)
-                value = Ingredient.objects.get(pk=ingredient_pk).name
+                try:
+                    value = catalog.get_catalog().ingredients[ingredient_pk].name
+                except KeyError:
+                    # The ingredient might have been added after the catalog was loaded
+                    value = Ingredient.objects.get(pk=ingredient_pk).name
             except ValueError:
                 # If we cannot cast the value into an int, it's probably the name of
                 # the ingredient already, so we don't need to do anything
@@ -103,6 +109,9 @@ class AutoCompleteSelectIngredientField(forms.fields.CharField):
     
     unknown_ingredient_error_message = 'The given ingredient was not found.'
     
+    # A dict of ingredients by id, which are used instead of fetching them from the database
+    prefetched_ingredients = None
+    
     def __init__(self, *args, **kwargs):
         widget = kwargs.get('widget', False)
         if not widget or not isinstance(widget, AutoCompleteSelectIngredientWidget):
@@ -117,10 +126,27 @@ class AutoCompleteSelectIngredientField(forms.fields.CharField):
             return value
         try:
             if self.unaccepted_ingredients_allowed:
-                ingredient = Ingredient.objects.with_name(value)
+                ingredient = Ingredient.objects.with_name(value, prefetched=self.prefetched_ingredients)
             else:
-                ingredient = Ingredient.objects.accepted_with_name(value)
+                ingredient = Ingredient.objects.accepted_with_name(value, prefetched=self.prefetched_ingredients)
         except (ValueError, Ingredient.DoesNotExist):
             raise ValidationError(self.unknown_ingredient_error_message)
         return ingredient
-            
\ No newline at end of file
+
+class UnitChoiceField(forms.ModelChoiceField):
+    """
+    Form field to select a unit, which looks up the selected unit in a dict of
+    prefetched units by id if one is given
+    
+    """
+    
+    prefetched_units = None
+    
+    def to_python(self, value):
+        if self.prefetched_units is not None and value not in EMPTY_VALUES:
+            try:
+                return self.prefetched_units[int(value)]
+            except (KeyError, ValueError, TypeError):
+                # Let the parent class find out what is wrong with the value
+                pass
+        return super(UnitChoiceField, self).to_python(value)
@@ -0,0 +1,24 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from ingredients.models import CanUseUnit
+
+class Command(NoArgsCommand):
+    help = "Remove the CanUseUnit objects of derived units, their conversion factors are calculated from their parent unit"
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        """
+        Delete every CanUseUnit object of a derived unit for which the ingredient can use the 
+        parent unit as well. Objects of derived units whose parent unit can't be used by the 
+        ingredient are kept, as they can't be calculated.
+        
+        """
+        base_units = set(CanUseUnit.objects.filter(unit__parent_unit__isnull=True).values_list('ingredient', 'unit'))
+        derived_ids = [cuu_id for cuu_id, ingredient_id, parent_unit_id
+                       in CanUseUnit.objects.filter(unit__parent_unit__isnull=False).values_list('id', 'ingredient', 'unit__parent_unit')
+                       if (ingredient_id, parent_unit_id) in base_units]
+        
+        for start in range(0, len(derived_ids), 500):
+            CanUseUnit.objects.filter(pk__in=derived_ids[start:start + 500]).delete()
+        
+        self.stdout.write('Removed %d derived CanUseUnit objects' % len(derived_ids))
@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+from ingredients.propagation import propagate_changes
+
+class Command(NoArgsCommand):
+    help = "Bring all footprints, conversion factors and calendars up to date with the countries, seas, transport methods and units"
+    
+    def handle_noargs(self, **options):
+        """
+        Propagate every country, sea, transport method, unit and base footprint to the data
+        derived from them, and report the amount of changed rows and the duration of every stage.
+        
+        """
+        for stage, rows, seconds in propagate_changes(everything=True):
+            self.stdout.write('%s: %d rows in %.3f seconds' % (stage, rows, seconds))
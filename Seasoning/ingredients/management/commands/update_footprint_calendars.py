@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand
+from ingredients.models import Ingredient, IngredientFootprint
+
+class Command(NoArgsCommand):
+    help = "Rebuild the footprint calendar and the availability of every ingredient"
+    
+    def handle_noargs(self, **options):
+        """
+        Calculate the footprint calendars of all seasonal ingredients in one pass and
+        store them. Then refresh the availability of every ingredient.
+        
+        """
+        rebuilt = IngredientFootprint.objects.rebuild_calendars()
+        
+        for ingredient in Ingredient.objects.all():
+            ingredient.update_availability()
+        
+        self.stdout.write('Rebuilt the footprint calendars of %d ingredients' % rebuilt)
@@ -18,7 +18,9 @@ You should have received a copy of the GNU General Public License
 along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
     
 """
-from django.db import models
+from django.db import models, connection
+from contextlib import contextmanager
+import threading
 import time
 from imagekit.models.fields import ProcessedImageField, ImageSpecField
 from imagekit.processors.resize import ResizeToFill, SmartResize
@@ -35,6 +37,66 @@ def get_image_filename(instance, old_filename):
     filename = str(time.time()) + '.png'
     return 'images/ingredients/' + filename
 
+def day_of_year(date):
+    """
+    Return the day of the year (starting at 1) the given date falls on in
+    AvailableIn.BASE_YEAR
+    
+    """
+    return date.replace(year=AvailableIn.BASE_YEAR).timetuple().tm_yday
+
+# The state of the deferred_recompute blocks of the current thread
+_deferred = threading.local()
+
+@contextmanager
+def deferred_recompute():
+    """
+    Defer the updates triggered by changes to ingredients and their related objects (see
+    ``ingredient_changed``) until the end of this block. Every changed ingredient is then
+    updated once, and the recipes using them are queued for recomputation once, no matter
+    how many related objects were saved.
+    
+    If the block raises an exception, the updates are discarded, as the changes are
+    expected to be rolled back. Blocks can be nested, the updates are done at the end of
+    the outermost block.
+    
+    """
+    depth = getattr(_deferred, 'depth', 0)
+    if depth == 0:
+        _deferred.availability_changed = set()
+        _deferred.changed = set()
+    _deferred.depth = depth + 1
+    try:
+        yield
+    finally:
+        _deferred.depth = depth
+    
+    if depth == 0:
+        for ingredient in Ingredient.objects.filter(pk__in=list(_deferred.availability_changed)):
+            ingredient.update_footprint_calendar()
+            ingredient.update_availability()
+        recipes.models.QueuedRecipe.objects.enqueue_for_ingredients(_deferred.changed)
+
+def ingredient_changed(ingredient, availability=True):
+    """
+    Update everything that depends on the given ingredient after it or one of its related
+    objects has changed. If availability is True, its footprint calendar and availability
+    are rebuilt. The recipes using the ingredient are queued for recomputation.
+    
+    Inside a ``deferred_recompute`` block, this is postponed until the end of the block.
+    
+    """
+    if getattr(_deferred, 'depth', 0) > 0:
+        if availability:
+            _deferred.availability_changed.add(ingredient.pk)
+        _deferred.changed.add(ingredient.pk)
+        return
+    
+    if availability:
+        ingredient.update_footprint_calendar()
+        ingredient.update_availability()
+    recipes.models.QueuedRecipe.objects.enqueue_for_ingredients([ingredient.pk])
+
 class Unit(models.Model):
     """
     Represent a unit
@@ -70,15 +132,45 @@ class Unit(models.Model):
             return self.short_name
         return self.name
     
-class IngredientManager(models.Manager):
+    def save(self, *args, **kwargs):
+        super(Unit, self).save(*args, **kwargs)
+        from ingredients.propagation import propagate_changes
+        propagate_changes(unit_ids=[self.pk])
     
-    def with_name(self, name):
-        name_filter = models.Q(name__iexact=name) | models.Q(synonyms__name__iexact=name)
-        return self.distinct().get(name_filter)
+class IngredientManager(models.Manager):
     
-    def accepted_with_name(self, name):
-        name_filter = models.Q(name__iexact=name) | models.Q(synonyms__name__iexact=name)
-        return self.distinct().get(name_filter, accepted=True)
+    def _with_name(self, name, accepted_only, prefetched):
+        """
+        Return the ingredient with the given name, plural name or synonym. The name is
+        resolved to the id of the ingredient in the catalog snapshot, so only the
+        ingredient itself is fetched from the database, unless it is in the given dict
+        of prefetched ingredients by id. Names that are not in the snapshot are looked
+        up in the database.
+        
+        """
+        ingredient_ids = catalog.get_catalog().ingredient_ids_with_name(name, accepted_only)
+        if len(ingredient_ids) > 1:
+            raise self.model.MultipleObjectsReturned('Got %d ingredients with name %s' % (len(ingredient_ids), name))
+        if len(ingredient_ids) <= 0:
+            # The ingredient might have been added or accepted after the snapshot was loaded
+            name_filter = models.Q(name__iexact=name) | models.Q(synonyms__name__iexact=name)
+            if accepted_only:
+                return self.distinct().get(name_filter, accepted=True)
+            return self.distinct().get(name_filter)
+        if prefetched is not None and ingredient_ids[0] in prefetched:
+            ingredient = prefetched[ingredient_ids[0]]
+            if accepted_only and not ingredient.accepted:
+                raise self.model.DoesNotExist('Ingredient with name %s does not exist.' % name)
+            return ingredient
+        if accepted_only:
+            return self.get(pk=ingredient_ids[0], accepted=True)
+        return self.get(pk=ingredient_ids[0])
+    
+    def with_name(self, name, prefetched=None):
+        return self._with_name(name, False, prefetched)
+    
+    def accepted_with_name(self, name, prefetched=None):
+        return self._with_name(name, True, prefetched)
     
     def with_name_like(self, name):
         name_filter = models.Q(name__icontains=name) | models.Q(synonyms__name__icontains=name)
@@ -87,6 +179,41 @@ class IngredientManager(models.Manager):
     def accepted_with_name_like(self, name):
         name_filter = models.Q(name__icontains=name) | models.Q(synonyms__name__icontains=name)
         return self.distinct().filter(name_filter, accepted=True)
+    
+    def _with_availability(self, field, date, available):
+        """
+        Filter the ingredients on the bit of the given availability bitmap field for the
+        given date, or today if no date is given
+        
+        """
+        if date is None:
+            date = datetime.date.today()
+        column = '%s.%s' % (connection.ops.quote_name(Ingredient._meta.db_table), connection.ops.quote_name(field))
+        return self.extra(where=['SUBSTR(%s, %%s, 1) %s %%s' % (column, '=' if available else '<>')],
+                          params=[day_of_year(date), AVAILABLE])
+    
+    def available_on(self, date=None):
+        """
+        Return the ingredients that are available on the given date, possibly because
+        they are being preserved
+        
+        """
+        return self._with_availability('extended_availability', date, True)
+    
+    def in_season_on(self, date=None):
+        """
+        Return the ingredients that are in season on the given date, which means they
+        are available without being preserved
+        
+        """
+        return self._with_availability('availability', date, True)
+    
+    def not_in_season_on(self, date=None):
+        """
+        Return the ingredients that are not in season on the given date
+        
+        """
+        return self._with_availability('availability', date, False)
 
 class Ingredient(models.Model):
     """
@@ -155,11 +282,44 @@ class Ingredient(models.Model):
     accepted = models.BooleanField(default=False)
     bramified = models.BooleanField(default=False)
     
-    useable_units = models.ManyToManyField(Unit, through='CanUseUnit')
+    # The result of ``always_available``, this is refreshed every time the availability
+    # of this ingredient changes
+    is_always_available = models.BooleanField(default=False, editable=False, db_index=True)
+    
+    # Bitmaps of the days of the year this ingredient is available on, with and without
+    # the preservability extension, see ``availability_bitmap``
+    availability = models.CharField(max_length=366, default='', editable=False)
+    extended_availability = models.CharField(max_length=366, default='', editable=False)
+    
+    # The base units this ingredient can use, see ``useable_units`` for all units it can use
+    base_units = models.ManyToManyField(Unit, through='CanUseUnit')
     
     def __unicode__(self):
         return self.name
+    
+    @property
+    def useable_units(self):
+        """
+        Return a queryset of the units this ingredient can use. These are the units it
+        has a CanUseUnit object for, and every unit derived from them with a known ratio.
+        
+        """
+        return Unit.objects.filter(models.Q(useable_by__ingredient=self) |
+                                   models.Q(parent_unit__useable_by__ingredient=self, ratio__isnull=False)).distinct()
 
+    @property
+    def useable_unit_count(self):
+        """
+        The amount of units this ingredient can use (see ``useable_units``), which is
+        counted in the catalog snapshot
+        
+        """
+        snapshot = catalog.get_catalog()
+        if self.pk not in snapshot.ingredients:
+            # The ingredient was added after the snapshot was loaded
+            return self.useable_units.count()
+        return len(snapshot.useable_units.get(self.pk, ()))
+    
     @property
     def primary_unit(self):
         try:
@@ -186,7 +346,7 @@ class Ingredient(models.Model):
         elif self.type == Ingredient.SEASONAL_SEA:
             return self.available_in_sea.all()
     
-    def get_active_available_ins(self, date=None):
+    def get_active_available_ins(self, date=None, available_ins=None):
         """
         Returns a list of the available in objects belonging to this ingredient
         that are available on the given date (The given date is between the from and until
@@ -198,17 +358,35 @@ class Ingredient(models.Model):
         pretty complicated, while the performance benefit is not very obvious as
         every ingredient will only have a few available_ins
         
+        If a list of available ins is given, only these will be checked instead of
+        querying the database.
+        
         """
         if date is None:
             date = datetime.date.today()
+        if available_ins is None:
+            available_ins = self.get_available_ins()
         
         active_available_ins = []
-        for available_in in self.get_available_ins():
+        for available_in in available_ins:
             if available_in.is_active(date, date_until_extension=self.preservability):
                 active_available_ins.append(available_in)
         return active_available_ins
     
-    def get_available_in_with_smallest_footprint(self, date=None):
+    def get_available_in_footprint(self, available_in, date):
+        """
+        Return the footprint of this ingredient on the given date when it is supplied 
+        using the given AvailableIn object. If the AvailableIn is no longer active on
+        the given date, the ingredient is being preserved and the preservation footprint
+        is added for every day it has been preserved.
+        
+        """
+        if not available_in.is_active(date, date_until_extension=0):
+            # This means this available in is currently under preservation
+            return available_in.footprint + available_in.days_apart(date)*self.preservation_footprint
+        return available_in.footprint
+    
+    def get_available_in_with_smallest_footprint(self, date=None, available_ins=None):
         """
         Return the AvailableIn with the smallest footprint of the AvailableIn objects 
         that are active on the given date beloning to this ingredient. If no date
@@ -225,15 +403,9 @@ class Ingredient(models.Model):
             date = datetime.date.today()
         
         smallest_footprint = None
-        for available_in in self.get_active_available_ins(date):
-            if self.name == 'Rode kool':
-                x =1
-            if not available_in.is_active(date_until_extension=0):
-                # This means this available in is currently under preservation
-                footprint = available_in.footprint + available_in.days_apart()*self.preservation_footprint
-            else:
-                footprint = available_in.footprint
-            if not smallest_footprint or smallest_footprint > footprint:
+        for available_in in self.get_active_available_ins(date, available_ins):
+            footprint = self.get_available_in_footprint(available_in, date)
+            if smallest_footprint is None or smallest_footprint > footprint:
                 smallest_footprint = footprint
                 smallest_available_in = available_in
         if smallest_footprint is None:
@@ -244,30 +416,57 @@ class Ingredient(models.Model):
         """
         Check if this Ingredient is always available somewhere
         
+        Every AvailableIn object covers an interval of days of the year, extended with the
+        preservability of this ingredient. Intervals that wrap around the end of the year
+        are split in two. The ingredient is always available if the union of these
+        intervals covers the entire year, which is checked in a single pass over the
+        sorted intervals.
+        
         """
         try:
             available_ins = self.get_available_ins()
         except self.BasicIngredientException:
             return True
         
-        current_date = datetime.date(AvailableIn.BASE_YEAR, 1, 1)
+        intervals = []
+        for avail in available_ins:
+            intervals.extend(avail.day_intervals(date_until_extension=self.preservability))
+        
+        covered_until = 0
+        for day_from, day_until in sorted(intervals):
+            if day_from > covered_until + 1:
+                # Nothing covers the day after covered_until
+                return False
+            covered_until = max(covered_until, day_until)
+        return covered_until >= AvailableIn.DAYS_IN_BASE_YEAR
+    
+    def update_availability(self):
+        """
+        Refresh the stored result of ``always_available`` and the availability bitmaps
+        of this ingredient and its AvailableIn objects. This must be done every time this
+        ingredient or one of its AvailableIn objects changes.
         
-        while available_ins:
-            before_loop_date = current_date
+        """
+        try:
+            available_ins = list(self.get_available_ins())
+        except self.BasicIngredientException:
+            self.is_always_available = True
+            self.availability = self.extended_availability = AVAILABLE * AvailableIn.DAYS_IN_BASE_YEAR
+        else:
             for avail in available_ins:
-                if avail.is_active(current_date, date_until_extension=self.preservability):
-                    extended_until_date = avail.extended_date_until(date_until_extension=self.preservability)
-                    if current_date < extended_until_date:
-                        current_date = extended_until_date + datetime.timedelta(days=1)
-                        if current_date.year > extended_until_date.year:
-                            # We've wrapped around
-                            return True                        
-                    else:
-                        # the availability wrapped around the year => we're finished
-                        return True
-            if before_loop_date == current_date:
-                # This loop did nothing
-                return False        
+                old_bitmaps = (avail.availability, avail.extended_availability)
+                # The extended bitmap depends on the preservability of this ingredient
+                avail.ingredient = self
+                avail.update_availability()
+                if old_bitmaps != (avail.availability, avail.extended_availability):
+                    type(avail).objects.filter(pk=avail.pk).update(availability=avail.availability,
+                                                                    extended_availability=avail.extended_availability)
+            self.is_always_available = self.always_available()
+            self.availability = union_bitmaps([avail.availability for avail in available_ins])
+            self.extended_availability = union_bitmaps([avail.extended_availability for avail in available_ins])
+        Ingredient.objects.filter(pk=self.pk).update(is_always_available=self.is_always_available,
+                                                     availability=self.availability,
+                                                     extended_availability=self.extended_availability)
     
     def footprint(self, date=None):
         """
@@ -277,23 +476,75 @@ class Ingredient(models.Model):
         If this is a basic ingredient, the footprint is just the base_footprint of the
         object
         
-        If this is a Seasonal ingredient, the footprint is the base_footprint of the
-        object, plus the minimal of the currently available AvailableIn* objects.
+        If this is a Seasonal ingredient, the footprint is looked up in the catalog
+        snapshot, which contains the minimal footprint of the AvailableIn* objects of
+        every ingredient for every day of the year.
         
         """
+        if self.type == Ingredient.BASIC:
+            return self.base_footprint
+        
         if date is None:
             date = datetime.date.today()
         
         try:
-            available_in = self.get_available_in_with_smallest_footprint(date)
-            if not available_in.is_active(date_until_extension=0):
-                # This means this available in is currently under preservation
-                footprint = available_in.footprint + available_in.days_apart()*self.preservation_footprint
-            else:
-                footprint = available_in.footprint
-            return footprint
-        except self.BasicIngredientException:
-            return self.base_footprint
+            footprint = catalog.get_catalog().footprint(self.pk, date)
+        except KeyError:
+            # The ingredient was added after the snapshot was loaded
+            return self.get_available_in_footprint(self.get_available_in_with_smallest_footprint(date), date)
+        if footprint is None:
+            raise ObjectDoesNotExist('No active AvailableIn object was found for ingredient ' + str(self))
+        return footprint
+    
+    # Cache for the footprint calendar of this ingredient, see ``get_footprint_calendar``
+    _footprint_calendar = None
+    
+    def get_footprint_calendar(self):
+        """
+        Return a list containing the footprint of this ingredient on every day of
+        the year, None meaning the ingredient is not available on that day. The
+        footprint on day X of the year can be found at index X - 1.
+        
+        The calendar is read from the database (or from the prefetched ``calendar_days``) 
+        only once per instance. If it has not been built yet, it will be built now.
+        
+        """
+        if self._footprint_calendar is None:
+            calendar_days = self.calendar_days.all()
+            if len(calendar_days) <= 0:
+                # The calendar has not been built yet
+                return self.update_footprint_calendar()
+            self._footprint_calendar = expand_calendar([(calendar_day.day, calendar_day.footprint)
+                                                        for calendar_day in calendar_days])
+        return self._footprint_calendar
+    
+    def calculate_footprint_calendar(self):
+        """
+        Calculate the footprint of this ingredient on every day of the year from
+        its AvailableIn objects. Returns a list as described in ``get_footprint_calendar``.
+        
+        """
+        from ingredients.engine import FootprintEngine
+        return footprint_calendar_list(FootprintEngine([self.pk]).footprint_calendar()[:, 0])
+    
+    def update_footprint_calendar(self):
+        """
+        Rebuild the footprint calendar of this ingredient. This must be done every
+        time this ingredient or one of its AvailableIn objects changes.
+        
+        Basic ingredients do not need a calendar, as their footprint is always
+        their base footprint.
+        
+        """
+        if self.type == Ingredient.BASIC:
+            IngredientFootprint.objects.filter(ingredient=self).delete()
+            self._footprint_calendar = None
+            return None
+        
+        calendar = self.calculate_footprint_calendar()
+        IngredientFootprint.objects.store_calendars({self.pk: calendar})
+        self._footprint_calendar = calendar
+        return calendar
     
     def can_use_unit(self, unit):
         return unit in self.useable_units.all()
@@ -308,16 +559,208 @@ class Ingredient(models.Model):
             self.preservation_footprint = 0
         saved = super(Ingredient, self).save()
         
-        # Update all recipes using this ingredient
-        uses = recipes.models.UsesIngredient.objects.filter(ingredient=self)
-        if len(uses) > 0 and len(uses) < 100:
-            # If more than 100 recipes use this ingredient, just wait for the cron job to
-            # avoid overloading the server
-            for uses_ingredient in uses:
-                uses_ingredient.save(update_recipe=True)
+        # The footprints of the available ins depend on the base footprint
+        from ingredients.propagation import update_available_in_footprints
+        country_rows, _ = update_available_in_footprints(AvailableInCountry, ingredient_ids=[self.pk])
+        sea_rows, _ = update_available_in_footprints(AvailableInSea, ingredient_ids=[self.pk])
+        if country_rows + sea_rows > 0:
+            catalog.invalidate_catalog()
+        
+        # Rebuild the calendar and availability, and queue the recipes using this ingredient
+        ingredient_changed(self)
         
         return saved
 
+# The characters used in availability bitmaps
+AVAILABLE, NOT_AVAILABLE = '1', '0'
+
+def availability_bitmap(intervals):
+    """
+    Return the availability bitmap for the given intervals of days of the year (see
+    ``AvailableIn.day_intervals``). This is a string with a character for every day of
+    AvailableIn.BASE_YEAR, which is AVAILABLE if the day is in one of the intervals. Whether
+    something is available on a day can be checked in SQL with SUBSTR(bitmap, day, 1).
+    
+    """
+    bitmap = [NOT_AVAILABLE] * AvailableIn.DAYS_IN_BASE_YEAR
+    for day_from, day_until in intervals:
+        bitmap[day_from - 1:day_until] = [AVAILABLE] * (day_until - day_from + 1)
+    return ''.join(bitmap)
+
+def union_bitmaps(bitmaps):
+    """
+    Return the availability bitmap of the days that are available in any of the given
+    bitmaps
+    
+    """
+    return ''.join(AVAILABLE if AVAILABLE in days else NOT_AVAILABLE
+                   for days in zip(*bitmaps)) or NOT_AVAILABLE * AvailableIn.DAYS_IN_BASE_YEAR
+
+def get_conversion_factors():
+    """
+    Return a dict mapping (ingredient id, unit id) tuples to the conversion factor of
+    the unit for the ingredient (see ``CanUseUnit``). Units derived from a unit the 
+    ingredient can use are included, with the conversion factor of their parent unit 
+    multiplied by their ratio.
+    
+    The dict is part of the catalog snapshot, so looking up a conversion factor does
+    not query the database. It must not be modified.
+    
+    """
+    return catalog.get_catalog().conversion_factors
+
+def get_conversion_factor(ingredient_id, unit_id):
+    """
+    Return the conversion factor of the given unit for the given ingredient, or None
+    if the ingredient can't use the unit. See ``get_conversion_factors``.
+    
+    If the conversion factor is not in the catalog snapshot, it is looked up in the
+    database, as the ingredient or unit might have been added after the snapshot was
+    loaded.
+    
+    """
+    conversion_factor = get_conversion_factors().get((ingredient_id, unit_id))
+    if conversion_factor is not None:
+        return conversion_factor
+    
+    try:
+        unit = Unit.objects.get(pk=unit_id)
+    except Unit.DoesNotExist:
+        return None
+    if unit.parent_unit_id is None:
+        base_unit_id, ratio = unit.pk, 1
+    elif unit.ratio is None:
+        return None
+    else:
+        base_unit_id, ratio = unit.parent_unit_id, unit.ratio
+    conversion_factors = list(CanUseUnit.objects.filter(ingredient=ingredient_id, unit=base_unit_id).values_list('conversion_factor', flat=True))
+    if len(conversion_factors) <= 0:
+        return None
+    return conversion_factors[0]*ratio
+
+def footprint_calendar_list(footprints):
+    """
+    Convert a column of footprints calculated by the FootprintEngine into
+    a footprint calendar list, replacing NaN by None
+    
+    """
+    return [None if footprint != footprint else float(footprint) for footprint in footprints]
+
+def transition_days(calendar):
+    """
+    Return the days of the year (starting at 1) on which the footprint in the given
+    footprint calendar differs from the footprint on the day before. The 1st of March
+    is also compared to the 28th of February, because outside of leap years it is
+    the day before.
+    
+    """
+    days = []
+    for day, footprint in enumerate(calendar, start=1):
+        # calendar[day - 2] is the day before, for the 1st of January this is the 31st of December
+        if footprint != calendar[day - 2] or (day == AvailableIn.LEAP_DAY + 1 and footprint != calendar[day - 3]):
+            days.append(day)
+    return days
+
+def expand_calendar(calendar_days):
+    """
+    Return the footprint calendar list described by the given (day, footprint) tuples, as
+    stored by ``IngredientFootprintManager.store_calendars``. Every day has the footprint
+    of the last given day before or on it, the days before the first given day have the
+    footprint of the last one, as the calendar wraps around at the end of the year.
+    
+    """
+    calendar_days = sorted(calendar_days)
+    calendar = []
+    footprint = calendar_days[-1][1]
+    next_days = iter(calendar_days)
+    next_day = next(next_days)
+    for day in range(1, AvailableIn.DAYS_IN_BASE_YEAR + 1):
+        if next_day is not None and next_day[0] == day:
+            footprint = next_day[1]
+            next_day = next(next_days, None)
+        calendar.append(footprint)
+    return calendar
+
+class IngredientFootprintManager(models.Manager):
+    
+    def store_calendars(self, calendars):
+        """
+        Replace the stored footprint calendars of the ingredients in the given
+        dict, which maps ingredient ids to footprint calendar lists. Only the
+        transition days are stored, or the first day if the footprint never changes.
+        
+        """
+        self.filter(ingredient__in=list(calendars.keys())).delete()
+        calendar_days = []
+        for ingredient_id, calendar in calendars.items():
+            transitions = transition_days(calendar)
+            if len(transitions) > 0:
+                calendar_days.extend(IngredientFootprint(ingredient_id=ingredient_id, day=day, footprint=calendar[day - 1],
+                                                         transition=True)
+                                     for day in transitions)
+            else:
+                calendar_days.append(IngredientFootprint(ingredient_id=ingredient_id, day=1, footprint=calendar[0],
+                                                         transition=False))
+        self.bulk_create(calendar_days, batch_size=1000)
+    
+    def rebuild_calendars(self, ingredient_ids=None):
+        """
+        Recalculate and store the footprint calendars of the given seasonal ingredients,
+        or of every seasonal ingredient if no ids are given, in one pass. Returns the
+        amount of calendars that were rebuilt.
+        
+        """
+        from ingredients.engine import FootprintEngine
+        seasonal = Ingredient.objects.exclude(type=Ingredient.BASIC)
+        if ingredient_ids is not None:
+            seasonal = seasonal.filter(pk__in=list(ingredient_ids))
+        engine = FootprintEngine(seasonal.values_list('id', flat=True))
+        if len(engine) <= 0:
+            return 0
+        calendar_matrix = engine.footprint_calendar()
+        
+        calendars = {}
+        for i, ingredient_id in enumerate(engine.ingredient_ids):
+            calendars[int(ingredient_id)] = footprint_calendar_list(calendar_matrix[:, i])
+        self.store_calendars(calendars)
+        return len(calendars)
+    
+    def transitioning_ingredients(self, date):
+        """
+        Return the ids of the ingredients whose footprint on the given date differs
+        from their footprint on the day before
+        
+        """
+        return self.filter(day=day_of_year(date), transition=True).values_list('ingredient', flat=True)
+
+class IngredientFootprint(models.Model):
+    """
+    Represents the footprint of a seasonal ingredient from one day of the year on.
+    
+    Only the days on which the footprint differs from the day before, the transitions,
+    are stored (or the first day if it never changes). Together, these days form the
+    footprint calendar of the ingredient (see ``expand_calendar``), which is rebuilt
+    every time the ingredient or its AvailableIn objects change. Only recipes using an
+    ingredient with a transition on a certain day have to be recalculated on that day.
+    
+    The day is the day of the year in AvailableIn.BASE_YEAR, see ``day_of_year``. A
+    footprint of None means the ingredient is not available from that day on.
+    
+    """
+    class Meta:
+        db_table = 'ingredientfootprint'
+        unique_together = (('ingredient', 'day'),)
+    
+    objects = IngredientFootprintManager()
+    
+    ingredient = models.ForeignKey(Ingredient, related_name='calendar_days', db_column='ingredient')
+    day = models.PositiveSmallIntegerField()
+    footprint = models.FloatField(null=True)
+    transition = models.BooleanField(default=False, db_index=True)
+    
+    def __unicode__(self):
+        return '%s on day %d' % (self.ingredient.name, self.day)
+
 class Synonym(models.Model):
     """
     Represents a synonym for an ingredient, these will be displayed when viewing
@@ -343,6 +786,9 @@ class CanUseUnit(models.Model):
     the following way:
         1 this_unit = conversion_factor primary_unit
     
+    Only base units are related to ingredients. The conversion factors of the units derived
+    from them are calculated when needed, see ``get_conversion_factors``.
+    
     """    
     class Meta:
         db_table = 'canuseunit'
@@ -359,21 +805,11 @@ class CanUseUnit(models.Model):
     
     def save(self, *args, **kwargs):
         super(CanUseUnit, self).save(*args, **kwargs)
-        if self.unit.parent_unit is None:
-            for unit in self.unit.derived_units.all():
-                try:
-                    canuseunit = CanUseUnit.objects.get(ingredient=self.ingredient, unit=unit)
-                    canuseunit.conversion_factor = self.conversion_factor*unit.ratio
-                    canuseunit.save()
-                except CanUseUnit.DoesNotExist:
-                    CanUseUnit(ingredient=self.ingredient, unit=unit, is_primary_unit=False, conversion_factor=self.conversion_factor*unit.ratio).save()
+        ingredient_changed(self.ingredient, availability=False)
     
     def delete(self, *args, **kwargs):
         super(CanUseUnit, self).delete(*args, **kwargs)
-        if self.unit.parent_unit is None:
-            # If this is a base unit, check if it has any derived canuseunits that need to be deleted
-            for canuseunit in CanUseUnit.objects.filter(ingredient=self.ingredient, unit__parent_unit=self.unit):
-                canuseunit.delete()
+        ingredient_changed(self.ingredient, availability=False)
         
 
 class Country(models.Model):
@@ -390,6 +826,11 @@ class Country(models.Model):
     
     def __unicode__(self):
         return self.name
+    
+    def save(self, *args, **kwargs):
+        super(Country, self).save(*args, **kwargs)
+        from ingredients.propagation import propagate_changes
+        propagate_changes(country_ids=[self.pk])
 
 
 class Sea(models.Model):
@@ -407,6 +848,11 @@ class Sea(models.Model):
     def __unicode__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        super(Sea, self).save(*args, **kwargs)
+        from ingredients.propagation import propagate_changes
+        propagate_changes(sea_ids=[self.pk])
+    
 class TransportMethod(models.Model):
     """
     This class represents a transport method. A transport method has a mean carbon emission
@@ -423,6 +869,11 @@ class TransportMethod(models.Model):
     def __unicode__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        super(TransportMethod, self).save(*args, **kwargs)
+        from ingredients.propagation import propagate_changes
+        propagate_changes(transport_method_ids=[self.pk])
+    
 class AvailableIn(models.Model):
     """
     Seasonal ingredients are available in different parts of the world at
@@ -435,6 +886,10 @@ class AvailableIn(models.Model):
     
     """
     BASE_YEAR = 2000
+    # BASE_YEAR is a leap year
+    DAYS_IN_BASE_YEAR = 366
+    # The day of the year of the 29th of February in BASE_YEAR
+    LEAP_DAY = 60
     
     class Meta:
         abstract = True
@@ -454,6 +909,11 @@ class AvailableIn(models.Model):
     # it is calculated when the model is saved
     footprint = models.FloatField(editable=False)
     
+    # Bitmaps of the days of the year this AvailableIn object is active on, with and without
+    # the preservability of the ingredient, see ``availability_bitmap``
+    availability = models.CharField(max_length=366, default='', editable=False)
+    extended_availability = models.CharField(max_length=366, default='', editable=False)
+    
     def extended_date_until(self, date_until_extension=None):
         if date_until_extension is None:
             date_until_extension = self.ingredient.preservability
@@ -464,6 +924,17 @@ class AvailableIn(models.Model):
                 return self.date_from
         return date
         
+    @classmethod
+    def next_year(cls, date):
+        """
+        Return the given date moved to the year after BASE_YEAR. As BASE_YEAR is a
+        leap year, the 29th of February becomes the 28th.
+        
+        """
+        if date.month == 2 and date.day == 29:
+            return date.replace(day=28, year=cls.BASE_YEAR + 1)
+        return date.replace(year=cls.BASE_YEAR + 1)
+        
     def month_from(self):
         return self.date_from.strftime('%B')
     
@@ -485,7 +956,7 @@ class AvailableIn(models.Model):
             date = date.replace(year=self.BASE_YEAR)
         
         if date < self.date_from:
-            date = date.replace(year=self.BASE_YEAR + 1)
+            date = self.next_year(date)
             
         if self.date_from <= self.date_until:
             # 2000      from          until  2001
@@ -494,24 +965,64 @@ class AvailableIn(models.Model):
         else:
             # 2000      until         from   2001
             # |---------]-------------[------|
-            try:
-                date_until = self.date_until.replace(year=self.BASE_YEAR + 1)
-            except ValueError:
-                if self.date_until.month == 2 and self.date_until.day == 29:
-                    date_until = self.date_until.replace(day=28, year=self.BASE_YEAR + 1)
-                else:
-                    raise
+            date_until = self.next_year(self.date_until)
             extended_until_date = (date_until + datetime.timedelta(days=date_until_extension))
             
         return date <= extended_until_date
     
+    def day_interval(self, date_until_extension=0):
+        """
+        Return the first and the last day this available in is active on, counted in
+        days from the start of BASE_YEAR (starting at 1). The last day can lie in the
+        next year, in which case it is larger than DAYS_IN_BASE_YEAR.
+        
+        """
+        date_until = self.date_until
+        if self.date_from > self.date_until:
+            date_until = self.next_year(date_until)
+        days_until = (date_until - datetime.date(self.BASE_YEAR, 1, 1)).days + 1
+        return day_of_year(self.date_from), days_until + date_until_extension
+    
+    def day_intervals(self, date_until_extension=0):
+        """
+        Return the intervals of days of BASE_YEAR (starting at 1) this available in is
+        active on, as a list of (first day, last day) tuples. An interval that wraps around
+        the end of the year is split in two.
+        
+        """
+        day_from, day_until = self.day_interval(date_until_extension)
+        if day_until <= self.DAYS_IN_BASE_YEAR:
+            return [(day_from, day_until)]
+        
+        # The part in the next year, which is not a leap year. The 29th of February
+        # counts as active if the 28th is (see ``next_year``)
+        day_until -= self.DAYS_IN_BASE_YEAR
+        if day_until >= self.LEAP_DAY - 1:
+            day_until += 1
+        return [(1, min(day_until, self.DAYS_IN_BASE_YEAR)), (day_from, self.DAYS_IN_BASE_YEAR)]
+    
+    def update_availability(self):
+        """
+        Recalculate the availability bitmaps of this available in
+        
+        """
+        self.availability = availability_bitmap(self.day_intervals())
+        self.extended_availability = availability_bitmap(self.day_intervals(self.ingredient.preservability))
+    
     def save(self, *args, **kwargs):
         self.footprint = self.ingredient.base_footprint + self.extra_production_footprint + self.location.distance*self.transport_method.emission_per_km
         
         self.date_from = self.date_from.replace(year=self.BASE_YEAR)
         self.date_until = self.date_until.replace(year=self.BASE_YEAR)
+        self.update_availability()
         
         super(AvailableIn, self).save(*args, **kwargs)
+        
+        ingredient_changed(self.ingredient)
+    
+    def delete(self, *args, **kwargs):
+        super(AvailableIn, self).delete(*args, **kwargs)
+        ingredient_changed(self.ingredient)
     
     def days_apart(self, date=None):
         """
@@ -529,7 +1040,7 @@ class AvailableIn(models.Model):
             return 0
         
         if date < self.date_until:
-            date = date.replace(year=self.BASE_YEAR + 1)
+            date = self.next_year(date)
         
         return (date - self.date_until).total_seconds() // (24*60*60)
     
@@ -564,4 +1075,6 @@ class AvailableInSea(AvailableIn):
     
     def sea(self):
         return self.location
-    
+
+# Connect the signals that keep the catalog snapshot up to date
+from ingredients import catalog
@@ -0,0 +1,177 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import time
+from django.db import connection, transaction
+from django.db.models import Q
+from ingredients.models import Ingredient, Unit, CanUseUnit, AvailableInCountry, AvailableInSea, IngredientFootprint
+from ingredients import catalog
+
+def available_in_footprint_sql(model):
+    """
+    Return an SQL expression calculating the footprint of the rows of the given AvailableIn
+    model, the same way as ``AvailableIn.save``
+    
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    location_model = model._meta.get_field('location').rel.to
+    transport_model = model._meta.get_field('transport_method').rel.to
+    return ('(SELECT %(ingredient)s.%(base_footprint)s FROM %(ingredient)s WHERE %(ingredient)s.%(id)s = %(table)s.%(ingredient_column)s)'
+            ' + %(table)s.%(extra_production_footprint)s'
+            ' + (SELECT %(location)s.%(distance)s FROM %(location)s WHERE %(location)s.%(id)s = %(table)s.%(location_column)s)'
+            ' * (SELECT %(transport)s.%(emission_per_km)s FROM %(transport)s WHERE %(transport)s.%(id)s = %(table)s.%(transport_column)s)'
+            % {'table': table, 'id': qn('id'),
+               'ingredient': qn(Ingredient._meta.db_table), 'location': qn(location_model._meta.db_table),
+               'transport': qn(transport_model._meta.db_table),
+               'ingredient_column': qn(model._meta.get_field('ingredient').column),
+               'location_column': qn(model._meta.get_field('location').column),
+               'transport_column': qn(model._meta.get_field('transport_method').column),
+               'base_footprint': qn('base_footprint'), 'extra_production_footprint': qn('extra_production_footprint'),
+               'distance': qn('distance'), 'emission_per_km': qn('emission_per_km')})
+
+def update_available_in_footprints(model, ingredient_ids=(), location_ids=(), transport_method_ids=(), everything=False):
+    """
+    Recalculate the footprints of the rows of the given AvailableIn model that belong to one
+    of the given ingredients, locations or transport methods (or of every row) with a single
+    UPDATE statement. Only rows whose footprint changes are updated.
+    
+    Returns the amount of updated rows and the set of ids of the ingredients they belong to.
+    
+    """
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    footprint = available_in_footprint_sql(model)
+    
+    conditions, params = [], []
+    if not everything:
+        for field, ids in (('ingredient', ingredient_ids), ('location', location_ids), ('transport_method', transport_method_ids)):
+            ids = list(ids)
+            if len(ids) > 0:
+                conditions.append('%s.%s IN (%s)' % (table, qn(model._meta.get_field(field).column), ', '.join(['%s'] * len(ids))))
+                params.extend(ids)
+        if len(conditions) <= 0:
+            return 0, set()
+    where = '%s.%s <> %s' % (table, qn('footprint'), footprint)
+    if len(conditions) > 0:
+        where = '(%s) AND %s' % (' OR '.join(conditions), where)
+    
+    cursor = connection.cursor()
+    cursor.execute('SELECT DISTINCT %s.%s FROM %s WHERE %s' % (table, qn(model._meta.get_field('ingredient').column), table, where), params)
+    ingredient_ids = set(row[0] for row in cursor.fetchall())
+    if len(ingredient_ids) <= 0:
+        return 0, ingredient_ids
+    cursor.execute('UPDATE %s SET %s = %s WHERE %s' % (table, qn('footprint'), footprint, where), params)
+    return cursor.rowcount, ingredient_ids
+
+def update_derived_conversion_factors(unit_ids=(), everything=False):
+    """
+    Recalculate the conversion factors of the stored CanUseUnit objects of the given units
+    and the units derived from them (or of every derived unit). These objects are no longer
+    created (see ``get_conversion_factors``), but older databases might still contain them.
+    
+    Returns the amount of updated rows and the set of ids of the ingredients they belong to.
+    
+    """
+    derived_units = Unit.objects.filter(parent_unit__isnull=False, ratio__isnull=False)
+    if not everything:
+        unit_ids = list(unit_ids)
+        derived_units = derived_units.filter(Q(pk__in=unit_ids) | Q(parent_unit__in=unit_ids))
+    ratios = dict((unit_id, (parent_unit_id, ratio)) for unit_id, parent_unit_id, ratio
+                  in derived_units.values_list('id', 'parent_unit', 'ratio'))
+    if len(ratios) <= 0:
+        return 0, set()
+    
+    parent_unit_ids = set(parent_unit_id for parent_unit_id, ratio in ratios.values())
+    base_factors = dict(((ingredient_id, unit_id), conversion_factor) for ingredient_id, unit_id, conversion_factor
+                        in CanUseUnit.objects.filter(unit__in=parent_unit_ids).values_list('ingredient', 'unit', 'conversion_factor'))
+    
+    # Group the rows by their new conversion factor, so they can be updated together
+    changed = {}
+    ingredient_ids = set()
+    for cuu_id, ingredient_id, unit_id, conversion_factor in CanUseUnit.objects.filter(unit__in=list(ratios.keys())).values_list('id', 'ingredient', 'unit', 'conversion_factor'):
+        parent_unit_id, ratio = ratios[unit_id]
+        if (ingredient_id, parent_unit_id) not in base_factors:
+            continue
+        new_conversion_factor = base_factors[(ingredient_id, parent_unit_id)] * ratio
+        if new_conversion_factor != conversion_factor:
+            changed.setdefault(new_conversion_factor, []).append(cuu_id)
+            ingredient_ids.add(ingredient_id)
+    
+    updated = 0
+    for conversion_factor, cuu_ids in changed.items():
+        updated += CanUseUnit.objects.filter(pk__in=cuu_ids).update(conversion_factor=conversion_factor)
+    return updated, ingredient_ids
+
+def propagate_changes(ingredient_ids=(), country_ids=(), sea_ids=(), transport_method_ids=(), unit_ids=(), everything=False):
+    """
+    Bring everything that is derived from the given ingredients, countries, seas, transport
+    methods and units (or from every one of them) up to date after they have changed:
+        
+        1. The footprints of the affected AvailableIn objects
+        2. The conversion factors of the affected stored CanUseUnit objects of derived units
+        3. The footprint calendars of the ingredients whose AvailableIn objects changed
+        4. The recipes using an affected ingredient or unit are queued for recomputation
+    
+    Every stage is done with a few set-based queries. Returns a list with a tuple containing
+    the name of the stage, the amount of changed rows (or newly queued recipes) and the time
+    it took in seconds for every stage.
+    
+    """
+    ingredient_ids, country_ids, sea_ids = list(ingredient_ids), list(country_ids), list(sea_ids)
+    transport_method_ids, unit_ids = list(transport_method_ids), list(unit_ids)
+    report = []
+    
+    start = time.time()
+    with transaction.commit_on_success():
+        country_rows, country_ingredient_ids = update_available_in_footprints(AvailableInCountry, ingredient_ids, country_ids,
+                                                                              transport_method_ids, everything)
+        sea_rows, sea_ingredient_ids = update_available_in_footprints(AvailableInSea, ingredient_ids, sea_ids,
+                                                                      transport_method_ids, everything)
+    changed_ingredient_ids = country_ingredient_ids | sea_ingredient_ids
+    report.append(('available in footprints', country_rows + sea_rows, time.time() - start))
+    
+    start = time.time()
+    with transaction.commit_on_success():
+        unit_rows, unit_ingredient_ids = update_derived_conversion_factors(unit_ids, everything)
+    report.append(('derived conversion factors', unit_rows, time.time() - start))
+    
+    if country_rows + sea_rows + unit_rows > 0:
+        # The updates above don't send signals
+        catalog.invalidate_catalog()
+    
+    start = time.time()
+    with transaction.commit_on_success():
+        rebuilt = IngredientFootprint.objects.rebuild_calendars(changed_ingredient_ids) if len(changed_ingredient_ids) > 0 else 0
+    report.append(('footprint calendars', rebuilt, time.time() - start))
+    
+    from recipes.models import Recipe, UsesIngredient, QueuedRecipe
+    start = time.time()
+    depth = QueuedRecipe.objects.depth()
+    if everything:
+        QueuedRecipe.objects.enqueue(Recipe.objects.values_list('id', flat=True))
+    else:
+        QueuedRecipe.objects.enqueue_for_ingredients(changed_ingredient_ids | unit_ingredient_ids)
+        if len(unit_ids) > 0:
+            # Recipes measuring an ingredient in one of the units, or in a unit derived from them
+            uses = UsesIngredient.objects.filter(Q(unit__in=unit_ids) | Q(unit__parent_unit__in=unit_ids))
+            QueuedRecipe.objects.enqueue(uses.values_list('recipe', flat=True))
+    report.append(('queued recipes', QueuedRecipe.objects.depth() - depth, time.time() - start))
+    
+    return report
@@ -1,13 +1,25 @@
 from django.test import TestCase
 import ingredients.models
-from ingredients.models import Unit, Country, Ingredient, AvailableInCountry, TransportMethod, AvailableIn, CanUseUnit, AvailableInSea
+from ingredients.models import Unit, Country, Ingredient, AvailableInCountry, TransportMethod, AvailableIn, CanUseUnit, AvailableInSea,\
+    IngredientFootprint, Synonym
 import datetime
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django_dynamic_fixture import G
 from ingredients.tests import test_datetime
 from general.decorators import mysqldb_required
-from recipes.models import Recipe, UsesIngredient, Cuisine
+from recipes.models import Recipe, UsesIngredient, Cuisine, QueuedRecipe
+from recipes.engine import recompute_queued_recipes
+from ingredients.engine import FootprintEngine
+from ingredients import catalog
+from ingredients.autocomplete import get_name_index
+from django.db.models import F
+from general.models import DataVersion
+import general.models
+from django.core.management import call_command
+from StringIO import StringIO
+import json
+from django.template import Template, Context
 
 # All calls to datetime.date.today within ingredients.models will
 # return 2013-05-05 as the current date
@@ -26,7 +38,37 @@ class SeaModelTestCase(TestCase):
     pass
 
 class TransportMethodModelTestCase(TestCase):
-    pass
+    
+    def test_save(self):
+        G(Cuisine, name='Andere')
+        ing = G(Ingredient, type=Ingredient.SEASONAL, base_footprint=5, preservability=0, accepted=True)
+        cuu = G(CanUseUnit, ingredient=ing, is_primary_unit=True, conversion_factor=1)
+        tpm = G(TransportMethod, emission_per_km=20)
+        avail = G(AvailableInCountry, location=G(Country, distance=10), transport_method=tpm,
+                  extra_production_footprint=30, ingredient=ing,
+                  date_from=datetime.date(2013, 1, 1),
+                  date_until=datetime.date(2013, 12, 31))
+        recipe = G(Recipe, portions=1)
+        G(UsesIngredient, recipe=recipe, ingredient=ing, amount=1, unit=cuu.unit)
+        QueuedRecipe.objects.all().delete()
+        
+        tpm.emission_per_km = 30
+        tpm.save()
+        self.assertEqual(AvailableInCountry.objects.get(pk=avail.pk).footprint, 5 + 10*30 + 30)
+        self.assertEqual(list(IngredientFootprint.objects.filter(ingredient=ing).values_list('footprint', flat=True).distinct()),
+                         [5 + 10*30 + 30])
+        self.assertEqual(list(QueuedRecipe.objects.values_list('recipe', flat=True)), [recipe.pk])
+        
+        # A change of the base footprint propagates as well
+        QueuedRecipe.objects.all().delete()
+        ing.base_footprint = 6
+        ing.save()
+        self.assertEqual(AvailableInCountry.objects.get(pk=avail.pk).footprint, 6 + 10*30 + 30)
+        
+        # Nothing changes if everything is up to date
+        out = StringIO()
+        call_command('propagate_reference_data', stdout=out)
+        self.assertIn('available in footprints: 0 rows', out.getvalue())
 
 class CanUseUnitModelTestCase(TestCase):
     pass
@@ -44,16 +86,28 @@ class CanUseUnitManagerTestCase(TestCase):
         ing = cuu.ingredient
         G(CanUseUnit, ingredient=ing, unit=unit)
         
+        # Derived units are not stored
         cuus = ing.canuseunit_set.all()
         
-        self.assertEqual(len(list(cuus)), 3)
+        self.assertEqual(len(list(cuus)), 2)
         self.assertTrue(punit in [x.unit for x in cuus])
-        self.assertTrue(cunit in [x.unit for x in cuus])
         self.assertTrue(unit in [x.unit for x in cuus])
         
-        cuus = ing.canuseunit_set.all()
-        
-        self.assertEqual(len(list(cuus)), 3)
+        self.assertEqual(set(ing.useable_units.all()), set([punit, cunit, unit]))
+    
+    def test_collapse_derived_units(self):
+        punit = G(Unit)
+        cunit = G(Unit, parent_unit=punit, ratio=2)
+        ing = G(Ingredient)
+        G(CanUseUnit, ingredient=ing, unit=punit, conversion_factor=3)
+        # Stored by earlier versions
+        G(CanUseUnit, ingredient=ing, unit=cunit, conversion_factor=6)
+        orphan = G(CanUseUnit, unit=cunit)
+        
+        call_command('collapse_derived_units', stdout=StringIO())
+        self.assertEqual(list(ing.canuseunit_set.values_list('unit', flat=True)), [punit.pk])
+        self.assertTrue(CanUseUnit.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(ingredients.models.get_conversion_factor(ing.pk, cunit.pk), 6)
 
 class AvailableInModelTestCase(TestCase):
         
@@ -147,8 +201,154 @@ class AvailableInModelTestCase(TestCase):
         date = datetime.date(2010, 5, 1)
         self.assertEqual(avail.days_apart(date), 0)
 
+class FootprintEngineTestCase(TestCase):
+    
+    def test_footprints(self):
+        bing = G(Ingredient, type=Ingredient.BASIC, base_footprint=3)
+        sing = G(Ingredient, type=Ingredient.SEASONAL, preservability=60,
+                 preservation_footprint=2)
+        country = G(Country, distance=10)
+        tpm = G(TransportMethod, emission_per_km=20)
+        G(AvailableInCountry, ingredient=sing, location=country,
+          transport_method=tpm, extra_production_footprint=500,
+          date_from=datetime.date(2013, 11, 1),
+          date_until=datetime.date(2013, 2, 28))
+        G(AvailableInCountry, ingredient=sing, location=country,
+          transport_method=tpm, extra_production_footprint=0,
+          date_from=datetime.date(2013, 6, 1),
+          date_until=datetime.date(2013, 8, 31))
+        empty_ing = G(Ingredient, type=Ingredient.SEASONAL_SEA)
+        
+        engine = FootprintEngine([bing.pk, sing.pk, empty_ing.pk])
+        dates = [datetime.date(2013, 1, 15), datetime.date(2013, 3, 10),
+                 datetime.date(2013, 4, 20), datetime.date(2013, 7, 1),
+                 datetime.date(2013, 9, 10)]
+        footprints = engine.footprints(dates)
+        self.assertEqual(footprints.shape, (len(dates), 3))
+        
+        # The engine must agree with the footprint calculated by the ingredient
+        sing = Ingredient.objects.get(pk=sing.pk)
+        for i, date in enumerate(dates):
+            self.assertEqual(footprints[i, engine.index[bing.pk]], bing.footprint(date))
+            self.assertAlmostEqual(footprints[i, engine.index[sing.pk]],
+                                   sing.get_available_in_footprint(sing.get_available_in_with_smallest_footprint(date), date))
+            self.assertTrue(footprints[i, engine.index[empty_ing.pk]] != footprints[i, engine.index[empty_ing.pk]])
+        
+        self.assertEqual(engine.footprint_calendar().shape, (AvailableIn.DAYS_IN_BASE_YEAR, 3))
+        self.assertEqual(engine.footprints_by_id(datetime.date(2013, 5, 5))[empty_ing.pk], None)
+
+class CatalogTestCase(TestCase):
+    
+    def test_get_catalog(self):
+        unit = G(Unit)
+        sing = G(Ingredient, type=Ingredient.SEASONAL, preservability=0)
+        G(CanUseUnit, ingredient=sing, unit=unit, conversion_factor=0.5, is_primary_unit=True)
+        avail = G(AvailableInCountry, ingredient=sing, location=G(Country, distance=10),
+                  transport_method=G(TransportMethod, emission_per_km=1), extra_production_footprint=0,
+                  date_from=datetime.date(2013, 2, 1), date_until=datetime.date(2013, 3, 31))
+        
+        snapshot = catalog.get_catalog()
+        self.assertTrue(catalog.get_catalog() is snapshot)
+        self.assertEqual(snapshot.ingredients[sing.pk].primary_unit_id, unit.pk)
+        self.assertEqual(snapshot.conversion_factor(sing.pk, unit.pk), 0.5)
+        self.assertEqual(snapshot.conversion_factor(sing.pk, G(Unit).pk), None)
+        # Units derived from a useable unit are resolved through their ratio
+        derived_unit = G(Unit, parent_unit=unit, ratio=4)
+        self.assertEqual(ingredients.models.get_conversion_factor(sing.pk, derived_unit.pk), 2)
+        # Derived units without a ratio can't be used
+        unknown_ratio_unit = G(Unit, parent_unit=unit, ratio=None)
+        self.assertTrue(catalog.get_catalog().can_use_unit(sing.pk, derived_unit.pk))
+        self.assertFalse(catalog.get_catalog().can_use_unit(sing.pk, unknown_ratio_unit.pk))
+        self.assertEqual(set(sing.useable_units), set([unit, derived_unit]))
+        snapshot = catalog.get_catalog()
+        self.assertEqual(snapshot.footprint(sing.pk, datetime.date(2013, 2, 10)), avail.footprint)
+        self.assertEqual(snapshot.footprint(sing.pk, datetime.date(2013, 5, 10)), None)
+        self.assertRaises(AttributeError, setattr, snapshot.ingredients[sing.pk], 'image', None)
+        
+        # Changing the catalog invalidates the snapshot
+        avail.date_until = datetime.date(2013, 5, 31)
+        avail.save()
+        snapshot = catalog.get_catalog()
+        self.assertEqual(snapshot.footprint(sing.pk, datetime.date(2013, 5, 10)), avail.footprint)
+        self.assertEqual(sing.footprint(datetime.date(2013, 5, 10)), avail.footprint)
+        
+        # Another process changing the catalog increments the version in the database, which
+        # is only read once every VERSION_CHECK_INTERVAL seconds
+        DataVersion.objects.filter(name=catalog.CATALOG_VERSION).update(version=F('version') + 1)
+        self.assertTrue(catalog.get_catalog() is snapshot)
+        self.assertNumQueries(0, catalog.get_catalog)
+        old_interval, general.models.VERSION_CHECK_INTERVAL = general.models.VERSION_CHECK_INTERVAL, 0
+        try:
+            self.assertFalse(catalog.get_catalog() is snapshot)
+        finally:
+            general.models.VERSION_CHECK_INTERVAL = old_interval
+        
+        # Ingredients and units that are not in the snapshot are looked up in the database
+        snapshot = catalog.get_catalog()
+        new_ing = G(Ingredient, name='Nieuw', type=Ingredient.SEASONAL, preservability=0)
+        # Pretend the new ingredient was added by another process
+        snapshot.version = DataVersion.objects.current_version(catalog.CATALOG_VERSION)
+        catalog._snapshot = snapshot
+        AvailableInCountry.objects.bulk_create([AvailableInCountry(ingredient=new_ing, location=avail.location,
+                                                                   transport_method=avail.transport_method, footprint=3,
+                                                                   date_from=datetime.date(2013, 2, 1),
+                                                                   date_until=datetime.date(2013, 3, 31))])
+        CanUseUnit.objects.bulk_create([CanUseUnit(ingredient=new_ing, unit=unit, conversion_factor=2, is_primary_unit=True)])
+        self.assertTrue(catalog.get_catalog() is snapshot)
+        self.assertEqual(new_ing.footprint(datetime.date(2013, 2, 10)), 3)
+        self.assertEqual(ingredients.models.get_conversion_factor(new_ing.pk, derived_unit.pk), 8)
+        self.assertEqual(ingredients.models.get_conversion_factor(new_ing.pk, G(Unit, parent_unit=unit, ratio=None).pk), None)
+    
+    def test_name_index(self):
+        G(Ingredient, name='Wortel', plural_name='Wortelen', accepted=True)
+        leek = G(Ingredient, name='Prei', plural_name='', accepted=True)
+        G(Synonym, name='Look-prei', plural_name='', ingredient=leek)
+        G(Ingredient, name='Rode wortel', plural_name='', accepted=True)
+        G(Ingredient, name='Gele wortel', plural_name='', accepted=False)
+        G(Ingredient, name=u'Pur\xe9e', plural_name='', accepted=True)
+        
+        name_index = get_name_index()
+        self.assertTrue(get_name_index() is name_index)
+        self.assertEqual([item['value'] for item in json.loads(name_index.complete('WORT'))],
+                         ['Wortel', 'Wortelen', 'Rode wortel'])
+        self.assertEqual([item['value'] for item in json.loads(name_index.complete('prei'))], ['Prei', 'Look-prei'])
+        self.assertEqual([item['value'] for item in json.loads(name_index.complete('ortel', limit=1))], ['Wortel'])
+        self.assertEqual(json.loads(name_index.complete('puree')), [{'value': u'Pur\xe9e', 'label': u'Pur\xe9e'}])
+        self.assertEqual(json.loads(name_index.complete('')), [])
+        
+        # Names that look like an unknown name are suggested
+        self.assertEqual(name_index.suggest('wortl'), ['Wortel', 'Wortelen'])
+        self.assertEqual(name_index.suggest('Wortels', limit=1), ['Wortel'])
+        self.assertEqual(name_index.suggest('rode wortl'), ['Rode wortel'])
+        self.assertEqual(name_index.suggest('banaan'), [])
+        
+        # The index is rebuilt with the catalog
+        G(Synonym, name='Peen', plural_name='', ingredient=leek)
+        self.assertEqual([item['value'] for item in json.loads(get_name_index().complete('pee'))], ['Peen'])
+
 class IngredientModelTestCase(TestCase):
     
+    def test_list_ingredients(self):
+        unit = G(Unit, parent_unit=None)
+        G(Unit, parent_unit=unit, ratio=2)
+        for i in range(5):
+            G(CanUseUnit, ingredient=G(Ingredient, name='Ingredient %d' % i), unit=unit)
+        catalog.get_catalog()
+        
+        # The amount of useable units of every ingredient is counted in the catalog snapshot,
+        # so listing them only queries the ingredients and their prefetched units
+        template = Template('{% for ingredient in ingredients %}<td>{{ ingredient.useable_unit_count }}</td>{% endfor %}')
+        def render_list():
+            ingredients = Ingredient.objects.all().order_by('accepted','name').prefetch_related('canuseunit_set__unit')
+            return template.render(Context({'ingredients': ingredients}))
+        self.assertEqual(render_list().count('<td>2</td>'), 5)
+        self.assertNumQueries(3, render_list)
+        
+        # An ingredient added after the snapshot was loaded is counted in the database
+        ing = G(Ingredient)
+        G(CanUseUnit, ingredient=ing, unit=unit)
+        self.assertEqual(ing.useable_unit_count, 2)
+    
     def test_primary_unit(self):
         ing = G(Ingredient)
         self.assertEqual(ing.primary_unit, None)
@@ -159,6 +359,32 @@ class IngredientModelTestCase(TestCase):
         pu = G(CanUseUnit, ingredient=ing, is_primary_unit=True).unit
         self.assertEqual(ing.primary_unit, pu)
     
+    def test_with_name(self):
+        carrot = G(Ingredient, name='Wortel', plural_name='Wortelen', accepted=True)
+        G(Synonym, name=u'Pe\xebn', plural_name='Penen', ingredient=carrot)
+        leek = G(Ingredient, name='Prei', plural_name='Preien', accepted=False)
+        
+        for name in ['wortel', 'WORTELEN', 'peen', u'Pe\xebn', 'penen']:
+            self.assertEqual(Ingredient.objects.with_name(name), carrot)
+            self.assertEqual(Ingredient.objects.accepted_with_name(name), carrot)
+        self.assertEqual(Ingredient.objects.with_name('preien'), leek)
+        self.assertRaises(Ingredient.DoesNotExist, Ingredient.objects.accepted_with_name, 'prei')
+        self.assertRaises(Ingredient.DoesNotExist, Ingredient.objects.with_name, 'ui')
+        self.assertNumQueries(1, Ingredient.objects.with_name, 'wortel')
+        
+        # Ingredients added or accepted by another process are found in the database
+        snapshot = catalog.get_catalog()
+        onion = G(Ingredient, name='Ui', plural_name='Uien', accepted=True)
+        Ingredient.objects.filter(pk=leek.pk).update(accepted=True)
+        snapshot.version = DataVersion.objects.current_version(catalog.CATALOG_VERSION)
+        catalog._snapshot = snapshot
+        self.assertEqual(Ingredient.objects.accepted_with_name('ui'), onion)
+        self.assertEqual(Ingredient.objects.accepted_with_name('prei'), leek)
+        
+        # Names have priority over plural names
+        carrots = G(Ingredient, name='Wortelen', plural_name='', accepted=True)
+        self.assertEqual(Ingredient.objects.with_name('wortelen'), carrots)
+    
     def test_can_use_unit(self):
         punit = G(Unit)
         unit = G(Unit, parent_unit=punit)
@@ -254,6 +480,9 @@ class IngredientModelTestCase(TestCase):
           date_from=datetime.date(2013, 10, 3),
           date_until=datetime.date(2013, 2, 1))
         self.assertTrue(ing.always_available())
+        # The stored flag is refreshed when the availability changes
+        self.assertTrue(Ingredient.objects.get(pk=ing.pk).is_always_available)
+        self.assertEqual(list(Ingredient.objects.filter(is_always_available=True, type=Ingredient.SEASONAL)), [ing])
         
         # Preservability pushes until date over edge
         ing2 = G(Ingredient, type=Ingredient.SEASONAL, preservability=90)
@@ -269,6 +498,50 @@ class IngredientModelTestCase(TestCase):
           date_from=datetime.date(2013, 4, 1),
           date_until=datetime.date(2013, 5, 31))
         self.assertTrue(ing2.always_available())
+        
+        # An interval wrapping around the year up to the 28th of February covers the
+        # 29th of February as well
+        ing3 = G(Ingredient, type=Ingredient.SEASONAL, preservability=0)
+        avail = G(AvailableInCountry, ingredient=ing3,
+                  date_from=datetime.date(2013, 3, 1),
+                  date_until=datetime.date(2013, 2, 28))
+        self.assertTrue(ing3.always_available())
+        self.assertTrue(Ingredient.objects.get(pk=ing3.pk).is_always_available)
+        avail.delete()
+        self.assertFalse(Ingredient.objects.get(pk=ing3.pk).is_always_available)
+        
+        G(AvailableInCountry, ingredient=ing3,
+          date_from=datetime.date(2013, 1, 1),
+          date_until=datetime.date(2013, 2, 28))
+        G(AvailableInCountry, ingredient=ing3,
+          date_from=datetime.date(2013, 3, 1),
+          date_until=datetime.date(2013, 12, 31))
+        self.assertFalse(ing3.always_available())
+    
+    def test_availability(self):
+        bing = G(Ingredient, type=Ingredient.BASIC)
+        sing = G(Ingredient, type=Ingredient.SEASONAL, preservability=10)
+        self.assertEqual(Ingredient.objects.get(pk=sing.pk).availability, '0'*AvailableIn.DAYS_IN_BASE_YEAR)
+        
+        # From the 1st of December until the 31st of January
+        avail = G(AvailableInCountry, ingredient=sing,
+                  date_from=datetime.date(2013, 12, 1),
+                  date_until=datetime.date(2013, 1, 31))
+        self.assertEqual(avail.availability, '1'*31 + '0'*304 + '1'*31)
+        self.assertEqual(avail.extended_availability, '1'*41 + '0'*294 + '1'*31)
+        self.assertEqual(Ingredient.objects.get(pk=sing.pk).extended_availability, avail.extended_availability)
+        
+        self.assertEqual(set(Ingredient.objects.in_season_on(datetime.date(2013, 1, 20))), set([bing, sing]))
+        self.assertEqual(list(Ingredient.objects.in_season_on(datetime.date(2013, 2, 5))), [bing])
+        self.assertEqual(list(Ingredient.objects.not_in_season_on(datetime.date(2013, 2, 5))), [sing])
+        self.assertEqual(set(Ingredient.objects.available_on(datetime.date(2013, 2, 5))), set([bing, sing]))
+        self.assertEqual(list(Ingredient.objects.available_on(datetime.date(2013, 2, 15))), [bing])
+        
+        # Changing the preservability updates the bitmaps of the available ins
+        sing.preservability = 0
+        sing.save()
+        self.assertEqual(AvailableInCountry.objects.get(pk=avail.pk).extended_availability, avail.availability)
+        self.assertEqual(Ingredient.objects.get(pk=sing.pk).extended_availability, avail.availability)
     
     def test_footprint(self):
         bing = G(Ingredient, type=Ingredient.BASIC)
@@ -296,6 +569,92 @@ class IngredientModelTestCase(TestCase):
                     date_until=datetime.date(2013, 5, 1))
         self.assertEqual(sing.footprint(), avail3.footprint + 4*sing.preservation_footprint)
         
+    def test_footprint_calendar(self):
+        bing = G(Ingredient, type=Ingredient.BASIC)
+        self.assertEqual(IngredientFootprint.objects.filter(ingredient=bing).count(), 0)
+        
+        sing = G(Ingredient, type=Ingredient.SEASONAL, preservability=10,
+                 preservation_footprint=1)
+        country = G(Country, distance=10)
+        tpm = G(TransportMethod, emission_per_km=20)
+        self.assertEqual(sing.get_footprint_calendar(), [None]*AvailableIn.DAYS_IN_BASE_YEAR)
+        
+        avail = G(AvailableInCountry, ingredient=sing, location=country,
+                  transport_method=tpm, extra_production_footprint=0,
+                  date_from=datetime.date(2013, 2, 1),
+                  date_until=datetime.date(2013, 2, 28))
+        # Only the days on which the footprint changes are stored
+        self.assertEqual(IngredientFootprint.objects.filter(ingredient=sing).count(), 12)
+        
+        # Reload the ingredient, so the calendar is read from the database
+        sing = Ingredient.objects.get(pk=sing.pk)
+        calendar = sing.get_footprint_calendar()
+        self.assertEqual(calendar[31], avail.footprint)
+        self.assertEqual(calendar[58], avail.footprint)
+        self.assertEqual(calendar[60], avail.footprint + 2*sing.preservation_footprint)
+        self.assertEqual(calendar[68], avail.footprint + 10*sing.preservation_footprint)
+        self.assertEqual(calendar[69], None)
+        self.assertEqual(calendar[30], None)
+        self.assertEqual(sing.footprint(datetime.date(2013, 2, 10)), avail.footprint)
+        self.assertRaises(ObjectDoesNotExist, sing.footprint, datetime.date(2013, 5, 5))
+        
+        # Days on which the footprint changes are marked as transitions, every day of
+        # preservation adds to the footprint
+        self.assertEqual(list(IngredientFootprint.objects.filter(ingredient=sing, transition=True).order_by('day').values_list('day', flat=True)),
+                         [32] + range(60, 71))
+        self.assertEqual(list(IngredientFootprint.objects.transitioning_ingredients(datetime.date(2013, 2, 1))), [sing.pk])
+        self.assertEqual(list(IngredientFootprint.objects.transitioning_ingredients(datetime.date(2013, 2, 2))), [])
+        
+        # Outside of leap years, the 1st of March follows the 28th of February
+        calendar = [None]*AvailableIn.DAYS_IN_BASE_YEAR
+        calendar[59:] = [1]*(AvailableIn.DAYS_IN_BASE_YEAR - 59)
+        self.assertEqual(ingredients.models.transition_days(calendar), [1, 60, 61])
+        self.assertEqual(ingredients.models.expand_calendar([(1, None), (60, 1), (61, 1)]), calendar)
+        self.assertEqual(ingredients.models.expand_calendar([(5, 2), (1, None)]), [None]*4 + [2]*(AvailableIn.DAYS_IN_BASE_YEAR - 4))
+        self.assertEqual(ingredients.models.expand_calendar([(3, 2)]), [2]*AvailableIn.DAYS_IN_BASE_YEAR)
+        
+        # Deleting an available in rebuilds the calendar
+        avail.delete()
+        sing = Ingredient.objects.get(pk=sing.pk)
+        self.assertEqual(sing.get_footprint_calendar(), [None]*AvailableIn.DAYS_IN_BASE_YEAR)
+    
+    
+    def test_deferred_recompute(self):
+        G(Cuisine, name='Andere')
+        sing = G(Ingredient, type=Ingredient.SEASONAL, preservability=0, accepted=True)
+        cuu = G(CanUseUnit, ingredient=sing, is_primary_unit=True, conversion_factor=1)
+        avail = G(AvailableInCountry, ingredient=sing,
+                  date_from=datetime.date(2013, 1, 1),
+                  date_until=datetime.date(2013, 12, 31))
+        recipe = G(Recipe, portions=1)
+        G(UsesIngredient, recipe=recipe, ingredient=sing, amount=1, unit=cuu.unit)
+        avail.delete()
+        QueuedRecipe.objects.all().delete()
+        
+        with ingredients.models.deferred_recompute():
+            sing.save()
+            for month in range(1, 13):
+                G(AvailableInCountry, ingredient=sing,
+                  date_from=datetime.date(2013, month, 1),
+                  date_until=datetime.date(2013, month, 28))
+            G(CanUseUnit, ingredient=sing, conversion_factor=2)
+            # Nothing is updated until the block ends
+            self.assertFalse(Ingredient.objects.get(pk=sing.pk).availability.startswith('1'))
+            self.assertEqual(QueuedRecipe.objects.depth(), 0)
+        
+        self.assertEqual(Ingredient.objects.get(pk=sing.pk).availability[:28], '1'*28)
+        self.assertEqual(len([footprint for footprint in Ingredient.objects.get(pk=sing.pk).get_footprint_calendar()
+                              if footprint is not None]), 12*28)
+        self.assertEqual(list(QueuedRecipe.objects.values_list('recipe', 'requests')), [(recipe.pk, 1)])
+        
+        # Changes inside a block that fails are discarded
+        try:
+            with ingredients.models.deferred_recompute():
+                sing.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(list(QueuedRecipe.objects.values_list('recipe', 'requests')), [(recipe.pk, 1)])
     
     def test_save(self):
         bing = G(Ingredient, type=Ingredient.BASIC, preservability=10,
@@ -314,5 +673,8 @@ class IngredientModelTestCase(TestCase):
         
         bing.base_footprint = 10*bing.base_footprint
         bing.save()
+        # The recipe is recalculated by the recompute queue
+        self.assertEqual(list(QueuedRecipe.objects.values_list('recipe', flat=True)), [recipe.pk])
+        recompute_queued_recipes()
         
         self.assertNotEqual(current_fp, Recipe.objects.get(id=recipe.id).footprint)
@@ -26,5 +26,6 @@ urlpatterns = patterns('',
     
     # AJAX Calls
     url(r'^ing_list/$', 'ingredients.views.ajax_ingredient_name_list'),
+    url(r'^ing_suggest/$', 'ingredients.views.ajax_ingredient_suggestions'),
     url(r'^ing_avail/$', 'ingredients.views.ajax_ingredient_availability'),
 )
@@ -27,6 +27,7 @@ from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.db.models import Q
 from ingredients.forms import SearchIngredientForm
 from django.views.decorators.csrf import csrf_exempt
+from ingredients.autocomplete import get_name_index
 
 def view_ingredients(request):
     
@@ -76,29 +77,34 @@ Ajax calls
 
 def ajax_ingredient_name_list(request):
     """
-    An ajax call that returns a json list with every ingredient 
-    name or synonym containing the given search query
+    An ajax call that returns a json list with the best matching ingredient 
+    names or synonyms containing the given search query
     
     """    
     if request.is_ajax() and 'term' in request.GET:
-        query = request.GET['term']
+        # The names are looked up in the name index of this process, which
+        # returns the serialized list
+        ingredients_json = get_name_index().complete(request.GET['term'])
         
-        # Query the database for ingredients with a name of synonym like the query
-        names = list(Ingredient.objects.filter(name__icontains=query, accepted=True).values_list('name', flat=True).order_by('name'))
-        names.extend(Synonym.objects.filter(name__icontains=query, ingredient__accepted=True).values_list('name', flat=True).order_by('name'))
-        
-        # Convert results to dict
-        result = [dict(zip(['value', 'label'], [name, name])) for name in sorted(names)]
-        
-        # Serialize to json
-        ingredients_json = json.dumps(result)
-  
         # Return the response
         return HttpResponse(ingredients_json, mimetype='application/javascript')
     
     # If this is not an ajax request, permission is denied
     raise PermissionDenied
 
+def ajax_ingredient_suggestions(request):
+    """
+    An ajax call that returns a json list with the names of accepted
+    ingredients that look like the given (unknown) name
+    
+    """
+    if request.is_ajax() and 'term' in request.GET:
+        suggestions = get_name_index().suggest(request.GET['term'])
+        return HttpResponse(json.dumps(suggestions), mimetype='application/javascript')
+    
+    # If this is not an ajax request, permission is denied
+    raise PermissionDenied
+
 @csrf_exempt
 def ajax_ingredient_availability(request):
     """
@@ -127,7 +133,7 @@ def list_ingredients(request):
     if not request.user.is_superuser:
         raise PermissionDenied
    
-    ingredients = Ingredient.objects.all().order_by('accepted', 'name').prefetch_related('canuseunit_set__unit', 'useable_units', 'available_in_country', 'available_in_sea')
+    ingredients = Ingredient.objects.all().order_by('accepted', 'name').prefetch_related('canuseunit_set__unit')
     perc_done = int(len(ingredients)/7)
     
     return render(request, 'admin/list_ingredients.html', {'ingredients': ingredients,
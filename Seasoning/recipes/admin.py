@@ -1,12 +1,17 @@
 from django.contrib import admin
-from recipes.models import Recipe, Cuisine, UsesIngredient, UnknownIngredient
+from recipes.models import Recipe, Cuisine, UsesIngredient, UnknownIngredient, QueuedRecipe
 
 class UsesIngredientInline(admin.TabularInline):
     model = UsesIngredient
 
 class RecipeAdmin(admin.ModelAdmin):
     inlines = [ UsesIngredientInline, ]
+
+class QueuedRecipeAdmin(admin.ModelAdmin):
+    list_display = ('recipe', 'time_queued', 'requests')
+    ordering = ('time_queued',)
     
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(Cuisine)
-admin.site.register(UnknownIngredient)
\ No newline at end of file
+admin.site.register(UnknownIngredient)
+admin.site.register(QueuedRecipe, QueuedRecipeAdmin)
\ No newline at end of file
@@ -0,0 +1,379 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import datetime
+import logging
+import numpy
+from django.conf import settings
+from django.db import connection, transaction
+from ingredients.engine import FootprintEngine
+from ingredients.models import Ingredient, IngredientFootprint, AvailableIn, get_conversion_factors, day_of_year
+from recipes.models import Recipe, UsesIngredient, QueuedRecipe, RecipeMonthlyFootprint,\
+    RecipeFootprintBucket
+from recipes.statistics import invalidate_site_statistics
+from recipes.search import index_recipes
+
+logger = logging.getLogger(__name__)
+
+# The amount of rows written by a single UPDATE statement. Every row takes 3 query
+# parameters, so this must stay below 333 for sqlite.
+UPDATE_CHUNK_SIZE = 300
+
+# The days of the year shown in the footprint evolution chart of a recipe
+MONTH_DAYS = [day_of_year(datetime.date(AvailableIn.BASE_YEAR, month, 1)) for month in range(1, 13)]
+
+class RecipeFootprintMatrix(object):
+    """
+    A sparse matrix with a row for every recipe and a column for every ingredient,
+    stored in CSR format (``data``, ``indices`` and ``indptr``).
+    
+    Every UsesIngredient object is an entry in the row of its recipe and the column
+    of its ingredient, with value amount * conversion_factor / portions. Multiplying
+    this matrix by a vector of ingredient footprints results in the footprint per
+    portion of every recipe. Multiplying it by a matrix with a row of footprints for
+    every ingredient (e.g. the transposed footprint calendar) results in these
+    footprints for every column.
+    
+    The columns are ordered like the ingredients of a FootprintEngine, whose index
+    has to be given when building the matrix.
+    
+    A UsesIngredient object with a unit that has no conversion factor for its ingredient
+    does not add to the footprint, ``unknown_recipes`` tells which recipes this makes
+    impossible to calculate.
+    
+    """
+    
+    def __init__(self, ingredient_index, recipe_ids=None, id_range=None):
+        """
+        Build the matrix for the given recipes, or for every recipe if no ids are given. If
+        an id range (start, end) is given, only recipes with start <= id < end are included.
+        
+        """
+        recipes = Recipe.objects.order_by('id')
+        uses = UsesIngredient.objects.order_by('recipe', 'id')
+        if recipe_ids is not None:
+            recipe_ids = list(recipe_ids)
+            recipes = recipes.filter(pk__in=recipe_ids)
+            uses = uses.filter(recipe__in=recipe_ids)
+        if id_range is not None:
+            recipes = recipes.filter(pk__gte=id_range[0], pk__lt=id_range[1])
+            uses = uses.filter(recipe__gte=id_range[0], recipe__lt=id_range[1])
+        
+        recipes = list(recipes.values_list('id', 'portions'))
+        self.recipe_ids = numpy.array([recipe[0] for recipe in recipes], dtype=numpy.int64)
+        # Recipes without portions would cause a division by zero
+        self.portions = numpy.array([max(recipe[1], 1) for recipe in recipes], dtype=numpy.float64)
+        row_index = dict((recipe_id, i) for i, recipe_id in enumerate(self.recipe_ids))
+        
+        conversion_factors = get_conversion_factors()
+        
+        uses = [uses_values for uses_values in uses.values_list('id', 'recipe', 'ingredient', 'unit', 'amount')
+                if uses_values[1] in row_index]
+        self.uses_ids = numpy.array([uses_values[0] for uses_values in uses], dtype=numpy.int64)
+        self.rows = numpy.array([row_index[uses_values[1]] for uses_values in uses], dtype=numpy.int64)
+        self.indices = numpy.array([ingredient_index[uses_values[2]] for uses_values in uses], dtype=numpy.int64)
+        # The amount of the primary unit of the ingredient used by every UsesIngredient, an unknown
+        # unit doesn't contribute to the footprint
+        self.amounts = numpy.array([uses_values[4]*conversion_factors.get((uses_values[2], uses_values[3]), 0)
+                                    for uses_values in uses], dtype=numpy.float64)
+        self.known_units = numpy.array([(uses_values[2], uses_values[3]) in conversion_factors for uses_values in uses],
+                                       dtype=numpy.bool_)
+        self.data = self.amounts / self.portions[self.rows]
+        self.indptr = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(self.rows, minlength=len(self)))))
+    
+    def __len__(self):
+        return len(self.recipe_ids)
+    
+    def dot(self, footprints):
+        """
+        Multiply this matrix by the given vector or matrix of ingredient footprints
+        
+        """
+        footprints = numpy.asarray(footprints, dtype=numpy.float64)
+        data = self.data if footprints.ndim == 1 else self.data[:, numpy.newaxis]
+        products = data * footprints[self.indices]
+        
+        result = numpy.zeros((len(self),) + footprints.shape[1:], dtype=numpy.float64)
+        # reduceat can't handle empty rows, these are left at 0
+        non_empty = self.indptr[:-1] < self.indptr[1:]
+        if non_empty.any():
+            result[non_empty] = numpy.add.reduceat(products, self.indptr[:-1][non_empty], axis=0)
+        return result
+    
+    def uses_footprints(self, footprints):
+        """
+        Return the footprint of every UsesIngredient (in the order of ``uses_ids``) for
+        the given vector of ingredient footprints
+        
+        """
+        return self.amounts * numpy.asarray(footprints, dtype=numpy.float64)[self.indices]
+    
+    def unknown_recipes(self, footprints, accepted):
+        """
+        Return a boolean array telling for every recipe whether its footprint can not be
+        calculated from the given vector of ingredient footprints, because it uses an accepted
+        ingredient (according to the given vector) without a footprint (NaN) or in a unit
+        without a conversion factor. Saving such a recipe raises an ObjectDoesNotExist error.
+        
+        """
+        footprints = numpy.asarray(footprints, dtype=numpy.float64)
+        unknown_uses = numpy.asarray(accepted, dtype=numpy.bool_)[self.indices] & (numpy.isnan(footprints[self.indices]) |
+                                                                                   ~self.known_units)
+        return numpy.bincount(self.rows[unknown_uses], minlength=len(self)) > 0
+
+def recipe_ingredient_footprints(engine, date):
+    """
+    Return the vector of footprints of the ingredients of the given engine on the given
+    date, as they are used for recipes: an unaccepted ingredient does not add to the
+    footprint of a recipe, while an accepted ingredient that is not available has no
+    footprint (NaN).
+    
+    """
+    return recipe_ingredient_footprints_on_days(engine, [day_of_year(date)])[0]
+
+def recipe_ingredient_footprints_on_days(engine, days):
+    """
+    Same as ``recipe_ingredient_footprints``, but for the given days of the year. Returns
+    a matrix with a row for every day.
+    
+    """
+    footprints = engine.footprints_on_days(days)
+    return numpy.where(engine.accepted, footprints, 0)
+
+def bulk_update_column(model, column, ids, values, chunk_size=UPDATE_CHUNK_SIZE, value_type=float):
+    """
+    Write the given values (floats by default) to the given column of the rows with the
+    given ids in the table of the given model, using one UPDATE statement per chunk of rows
+    
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = [int(row_id) for row_id in ids[start:start + chunk_size]]
+        chunk_values = [value_type(value) for value in values[start:start + chunk_size]]
+        params = []
+        for row_id, value in zip(chunk_ids, chunk_values):
+            params.extend([row_id, value])
+        params.extend(chunk_ids)
+        cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (qn(model._meta.db_table), qn(column), qn('id'),
+                                                                               ' '.join(['WHEN %s THEN %s'] * len(chunk_ids)),
+                                                                               qn('id'), ', '.join(['%s'] * len(chunk_ids))),
+                       params)
+    transaction.commit_unless_managed()
+
+def bulk_update_footprints(model, ids, footprints, chunk_size=UPDATE_CHUNK_SIZE):
+    """
+    Write the given footprints to the footprint column of the rows with the given
+    ids in the table of the given model
+    
+    """
+    bulk_update_column(model, 'footprint', ids, footprints, chunk_size)
+
+def recipe_histogram_values(recipe_ids):
+    """
+    Return a dict mapping the given recipe ids to the (footprint, course, veganism) tuple
+    of the recipe, as used by ``RecipeFootprintBucketManager.record``
+    
+    """
+    recipe_ids = [int(recipe_id) for recipe_id in recipe_ids]
+    values = {}
+    for start in range(0, len(recipe_ids), UPDATE_CHUNK_SIZE):
+        recipes = Recipe.objects.filter(pk__in=recipe_ids[start:start + UPDATE_CHUNK_SIZE])
+        values.update((recipe_id, (footprint, course, veganism)) for recipe_id, footprint, course, veganism
+                      in recipes.values_list('id', 'footprint', 'course', 'veganism'))
+    return values
+
+def recalculate_recipe_footprints(date=None, recipe_ids=None, engine=None, id_range=None):
+    """
+    Recalculate the footprints of the given recipes (or every recipe, optionally limited
+    to an id range) and their UsesIngredient objects on the given date, or today if no
+    date is given, and write them to the database. Returns the amount of recipes that were
+    updated.
+    
+    Only the footprints are updated, the veganism and acceptance state of the recipes
+    do not depend on the date and are left untouched. Recipes whose footprint can not be
+    calculated (see ``RecipeFootprintMatrix.unknown_recipes``) keep their old footprints,
+    like when saving them fails, and are logged.
+    
+    """
+    if date is None:
+        date = datetime.date.today()
+    if engine is None:
+        engine = FootprintEngine()
+    
+    matrix = RecipeFootprintMatrix(engine.index, recipe_ids, id_range)
+    ingredient_footprints = recipe_ingredient_footprints(engine, date)
+    unknown = matrix.unknown_recipes(ingredient_footprints, engine.accepted)
+    if unknown.any():
+        logger.warning('The footprints of the recipes %s can not be calculated on %s, they use an ingredient that is '
+                       'not available or a unit without a conversion factor',
+                       ', '.join(str(recipe_id) for recipe_id in matrix.recipe_ids[unknown]), date)
+    known_uses = ~unknown[matrix.rows]
+    bulk_update_footprints(UsesIngredient, matrix.uses_ids[known_uses], matrix.uses_footprints(ingredient_footprints)[known_uses])
+    
+    recipe_ids = matrix.recipe_ids[~unknown]
+    old_values = recipe_histogram_values(recipe_ids)
+    recipe_footprints = matrix.dot(ingredient_footprints)[~unknown]
+    bulk_update_footprints(Recipe, recipe_ids, recipe_footprints)
+    RecipeFootprintBucket.objects.record(old_values.values(),
+                                         [(float(footprint),) + old_values[int(recipe_id)][1:]
+                                          for recipe_id, footprint in zip(recipe_ids, recipe_footprints)
+                                          if int(recipe_id) in old_values])
+    invalidate_site_statistics()
+    return len(recipe_ids)
+
+def recalculate_transitioning_recipe_footprints(date=None, engine=None):
+    """
+    Recalculate the footprints of the recipes that use an ingredient whose footprint
+    changes on the given date, or today if no date is given. Returns the amount of
+    recipes that were updated.
+    
+    The footprints of all other recipes are the same as on the day before, so running
+    this every day keeps every recipe up to date. If a day is skipped, the transitions
+    of that day are missed and all recipes have to be recalculated.
+    
+    """
+    if date is None:
+        date = datetime.date.today()
+    
+    ingredient_ids = list(IngredientFootprint.objects.transitioning_ingredients(date))
+    if len(ingredient_ids) <= 0:
+        return 0
+    recipe_ids = set(UsesIngredient.objects.filter(ingredient__in=ingredient_ids).values_list('recipe', flat=True))
+    if len(recipe_ids) <= 0:
+        return 0
+    return recalculate_recipe_footprints(date=date, recipe_ids=recipe_ids, engine=engine)
+
+def update_monthly_footprints(recipe_ids=None, engine=None, id_range=None, daily=None):
+    """
+    Recalculate and store the footprint evolutions (see ``RecipeMonthlyFootprint``) of the
+    given recipes, or every recipe, optionally limited to an id range. The footprints on every
+    day of the year are stored as well if ``daily`` is True, which defaults to the
+    DAILY_RECIPE_FOOTPRINTS setting. Returns the amount of recipes that were updated.
+    
+    """
+    if engine is None:
+        engine = FootprintEngine()
+    if daily is None:
+        daily = getattr(settings, 'DAILY_RECIPE_FOOTPRINTS', False)
+    
+    matrix = RecipeFootprintMatrix(engine.index, recipe_ids, id_range)
+    # The evolution shows an ingredient that is not available on a day as not adding to
+    # the footprint, instead of leaving out that day
+    monthly_footprints = matrix.dot(numpy.nan_to_num(recipe_ingredient_footprints_on_days(engine, MONTH_DAYS)).T)
+    daily_footprints = None
+    if daily:
+        days = numpy.arange(1, AvailableIn.DAYS_IN_BASE_YEAR + 1)
+        daily_footprints = matrix.dot(numpy.nan_to_num(recipe_ingredient_footprints_on_days(engine, days)).T)
+    RecipeMonthlyFootprint.objects.store(matrix.recipe_ids, monthly_footprints, daily_footprints)
+    return len(matrix)
+
+def percentile_ranks(footprints):
+    """
+    Return the percentage of the given footprints that is not larger than each of them
+    
+    """
+    return 100.0 * numpy.searchsorted(numpy.sort(footprints), footprints, side='right') / len(footprints)
+
+def update_percentile_ranks():
+    """
+    Recalculate the footprint percentiles of every recipe, among all recipes, the recipes of
+    the same course and the recipes of the same veganism, in one pass. Only the percentiles
+    that have changed are written. Returns the amount of recipes that were updated.
+    
+    """
+    columns = ['footprint_percentile', 'course_footprint_percentile', 'veganism_footprint_percentile']
+    recipes = list(Recipe.objects.values_list('id', 'footprint', 'course', 'veganism', *columns))
+    if len(recipes) <= 0:
+        return 0
+    ids = numpy.array([recipe[0] for recipe in recipes], dtype=numpy.int64)
+    footprints = numpy.array([recipe[1] for recipe in recipes], dtype=numpy.float64)
+    
+    ranks = [percentile_ranks(footprints)]
+    for group_index in (2, 3):
+        groups = numpy.array([recipe[group_index] for recipe in recipes], dtype=numpy.int64)
+        group_ranks = numpy.empty(len(recipes), dtype=numpy.float64)
+        for group in numpy.unique(groups):
+            in_group = groups == group
+            group_ranks[in_group] = percentile_ranks(footprints[in_group])
+        ranks.append(group_ranks)
+    
+    updated = numpy.zeros(len(recipes), dtype=numpy.bool_)
+    for i, column in enumerate(columns):
+        # Recipes that have never been ranked have no percentile, which never equals the new one
+        old_ranks = numpy.array([numpy.nan if recipe[4 + i] is None else recipe[4 + i] for recipe in recipes], dtype=numpy.float64)
+        changed = old_ranks != ranks[i]
+        bulk_update_column(Recipe, column, ids[changed], ranks[i][changed])
+        updated |= changed
+    return int(updated.sum())
+
+def update_recipe_states(recipe_ids):
+    """
+    Recalculate the veganism and acceptance of the given recipes the same way as
+    ``Recipe.save``, using one UPDATE statement per combination of both
+    
+    """
+    recipe_ids = list(recipe_ids)
+    states = dict((recipe_id, (Ingredient.VEGAN, True)) for recipe_id in recipe_ids)
+    for start in range(0, len(recipe_ids), UPDATE_CHUNK_SIZE):
+        uses = UsesIngredient.objects.filter(recipe__in=recipe_ids[start:start + UPDATE_CHUNK_SIZE])
+        for recipe_id, veganism, accepted in uses.values_list('recipe', 'ingredient__veganism', 'ingredient__accepted'):
+            recipe_veganism, recipe_accepted = states[recipe_id]
+            states[recipe_id] = (min(recipe_veganism, veganism), recipe_accepted and accepted)
+    
+    old_values = recipe_histogram_values(recipe_ids)
+    recipes_by_state = {}
+    for recipe_id, state in states.items():
+        recipes_by_state.setdefault(state, []).append(recipe_id)
+    for (veganism, accepted), state_recipe_ids in recipes_by_state.items():
+        for start in range(0, len(state_recipe_ids), UPDATE_CHUNK_SIZE):
+            Recipe.objects.filter(pk__in=state_recipe_ids[start:start + UPDATE_CHUNK_SIZE]).update(veganism=veganism, accepted=accepted)
+    RecipeFootprintBucket.objects.record(old_values.values(),
+                                         [values[:2] + (states[recipe_id][0],) for recipe_id, values in old_values.items()])
+
+def recompute_queued_recipes(batch_size=UPDATE_CHUNK_SIZE, engine=None):
+    """
+    Recalculate the footprints, footprint evolutions, veganism and acceptance of the recipes
+    that have been waiting the longest in the recompute queue, and remove them from the queue.
+    Returns the amount of recipes that were recalculated.
+    
+    Recipes that are queued again while they are being recalculated stay in the queue.
+    
+    """
+    queued = list(QueuedRecipe.objects.order_by('time_queued').values_list('recipe', 'requests')[:batch_size])
+    if len(queued) <= 0:
+        return 0
+    recipe_ids = [recipe_id for recipe_id, requests in queued]
+    
+    with transaction.commit_on_success():
+        if engine is None:
+            engine = FootprintEngine()
+        recalculate_recipe_footprints(recipe_ids=recipe_ids, engine=engine)
+        update_monthly_footprints(recipe_ids=recipe_ids, engine=engine)
+        update_recipe_states(recipe_ids)
+        # The names of the ingredients might have changed
+        index_recipes(recipe_ids)
+        
+        # Only remove the recipes that have not been queued again in the meantime
+        recipes_by_requests = {}
+        for recipe_id, requests in queued:
+            recipes_by_requests.setdefault(requests, []).append(recipe_id)
+        for requests, request_recipe_ids in recipes_by_requests.items():
+            QueuedRecipe.objects.filter(recipe__in=request_recipe_ids, requests=requests).delete()
+    return len(recipe_ids)
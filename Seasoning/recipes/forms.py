@@ -21,7 +21,9 @@ from django import forms
 from recipes.models import Recipe, UsesIngredient, Cuisine
 import recipes
 from django.forms.widgets import RadioSelect, CheckboxSelectMultiple
-from ingredients.fields import AutoCompleteSelectIngredientField
+from ingredients.fields import AutoCompleteSelectIngredientField, UnitChoiceField
+from ingredients import catalog
+from ingredients.autocomplete import get_name_index
 from ingredients.models import Ingredient, Unit
 from django.forms.models import BaseInlineFormSet, inlineformset_factory
 from django.core.exceptions import ValidationError
@@ -81,13 +83,32 @@ class UsesIngredientForm(forms.ModelForm):
     ingredient = AutoCompleteSelectIngredientField()
     group = forms.CharField(max_length=100, required=False, widget=forms.HiddenInput(attrs={'class': 'group'}))
     amount = forms.FloatField(widget=forms.TextInput(attrs={'class': 'amount'}))
+    unit = UnitChoiceField(queryset=Unit.objects.all())
     
     def __init__(self, *args, **kwargs):
+        # Dicts of ingredients and units by id, shared by all forms of a formset
+        prefetched_ingredients = kwargs.pop('prefetched_ingredients', None)
+        prefetched_units = kwargs.pop('prefetched_units', None)
         form = super(UsesIngredientForm, self).__init__(*args, **kwargs)
+        self.fields['ingredient'].prefetched_ingredients = prefetched_ingredients
+        self.fields['unit'].prefetched_units = prefetched_units
         if self.instance.pk is not None:
-            self.fields['unit'].queryset = self.instance.ingredient.useable_units.all()
+            if prefetched_units is None:
+                self.fields['unit'].queryset = self.instance.ingredient.useable_units.all()
+            else:
+                unit_ids = catalog.get_catalog().useable_units.get(self.instance.ingredient_id, ())
+                units = [prefetched_units[unit_id] for unit_id in sorted(unit_ids) if unit_id in prefetched_units]
+                self.fields['unit'].choices = [(u'', self.fields['unit'].empty_label)] + \
+                    [(unit.pk, self.fields['unit'].label_from_instance(unit)) for unit in units]
         return form
 
+    def _get_validation_exclusions(self):
+        exclude = super(UsesIngredientForm, self)._get_validation_exclusions()
+        # The ingredient and unit fields only return existing objects, so the model does
+        # not need to look them up again
+        exclude.extend(['ingredient', 'unit'])
+        return exclude
+    
     def _get_changed_data(self, *args, **kwargs):
         super(UsesIngredientForm, self)._get_changed_data(*args, **kwargs)
         # If group is in changed_data, but no other fields are filled in, remove group so
@@ -114,6 +135,28 @@ class IngredientsFormSet(BaseInlineFormSet):
     unknown_ingredients = []
     unknown_ingredients_allowed = False
     
+    def _construct_forms(self):
+        """
+        Load every ingredient used by the forms, and every unit, before constructing
+        the forms, so the forms don't have to query them one by one
+        
+        """
+        ingredient_ids = set(uses.ingredient_id for uses in self.get_queryset())
+        if self.is_bound:
+            snapshot = catalog.get_catalog()
+            for i in range(self.total_form_count()):
+                name = self.data.get('%s-ingredient' % self.add_prefix(i), '')
+                if name:
+                    ingredient_ids.update(snapshot.ingredient_ids_with_name(name))
+        self.prefetched_ingredients = Ingredient.objects.in_bulk(list(ingredient_ids)) if ingredient_ids else {}
+        self.prefetched_units = dict((unit.pk, unit) for unit in Unit.objects.all())
+        super(IngredientsFormSet, self)._construct_forms()
+    
+    def _construct_form(self, i, **kwargs):
+        kwargs.setdefault('prefetched_ingredients', self.prefetched_ingredients)
+        kwargs.setdefault('prefetched_units', self.prefetched_units)
+        return super(IngredientsFormSet, self)._construct_form(i, **kwargs)
+    
     def clean(self):
         # TODO: fix so that when a certain parameter is given, unknown ingredient errors are ignored
         super(IngredientsFormSet, self).clean()
@@ -145,7 +188,8 @@ class IngredientsFormSet(BaseInlineFormSet):
                 if form.errors:
                     # If the form has errors, we known its an unknown ingredient error
                     unknown_ingredients.append({'name': form['ingredient'].value(),
-                                                'unit': form.cleaned_data['unit']})
+                                                'unit': form.cleaned_data['unit'],
+                                                'suggestions': get_name_index().suggest(form['ingredient'].value())})
                     form._errors = ErrorDict()
             self._errors = self.error_class()
             self.unknown_ingredients = unknown_ingredients
@@ -222,3 +266,9 @@ class IngredientInRecipeSearchForm(forms.Form):
     
     
 
+
+class PantryForm(forms.Form):
+    
+    ingredients = forms.CharField(label='Ingredienten',
+                                  widget=forms.TextInput(attrs={'placeholder': 'Welke ingredienten heb je in huis? (gescheiden door komma\'s)',
+                                                                'class': 'keywords-searchbar'}))
@@ -0,0 +1,252 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import numpy
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from general.models import DataVersion
+from ingredients.models import Ingredient
+from recipes.models import Recipe, UsesIngredient
+
+# The name of the version of the index. Every change to the ingredients of a recipe
+# increments this version, so every other process knows its index has become outdated.
+INDEX_VERSION = 'recipes_ingredient_index'
+
+class IngredientRecipeIndex(object):
+    """
+    An inverted index from ingredients to the recipes using them, stored as one sorted
+    array of recipe ids per ingredient (in CSR format: the recipes of the ingredient at
+    position i of ``ingredient_ids`` are ``recipe_ids[indptr[i]:indptr[i + 1]]``).
+    
+    For every entry, ``uses_counts`` holds the amount of UsesIngredient objects of the
+    recipe with the ingredient. ``all_recipe_ids`` holds the sorted ids of all recipes with
+    ingredients, and ``recipe_positions`` the position of the recipe of every entry in it.
+    
+    """
+    
+    def __init__(self, version):
+        self.version = version
+        self.build(self.load_entries(UsesIngredient.objects.all()))
+    
+    def load_entries(self, uses):
+        """
+        Return the (ingredient id, recipe id, count) entries of the given queryset of
+        UsesIngredient objects
+        
+        """
+        uses = uses.values('ingredient', 'recipe').annotate(count=Count('id')).order_by()
+        return numpy.array([(use['ingredient'], use['recipe'], use['count']) for use in uses],
+                           dtype=numpy.int64).reshape(-1, 3)
+    
+    def build(self, entries):
+        """
+        Build the index from the given (ingredient id, recipe id, count) entries
+        
+        """
+        entries = entries[numpy.lexsort((entries[:, 1], entries[:, 0]))]
+        self.ingredient_ids, starts = numpy.unique(entries[:, 0], return_index=True)
+        self.indptr = numpy.append(starts, len(entries))
+        self.recipe_ids = entries[:, 1]
+        self.uses_counts = entries[:, 2]
+        
+        self.all_recipe_ids, self.recipe_positions = numpy.unique(self.recipe_ids, return_inverse=True)
+        # The amount of UsesIngredient objects of every recipe
+        self.recipe_uses_counts = numpy.bincount(self.recipe_positions, weights=self.uses_counts,
+                                                 minlength=len(self.all_recipe_ids))
+    
+    def update_recipes(self, recipe_ids, version):
+        """
+        Replace the entries of the given recipes by the ones in the database, without
+        loading the entries of the other recipes again
+        
+        """
+        entries = numpy.column_stack((numpy.repeat(self.ingredient_ids, numpy.diff(self.indptr)),
+                                      self.recipe_ids, self.uses_counts))
+        entries = entries[numpy.in1d(entries[:, 1], list(recipe_ids), invert=True)]
+        self.build(numpy.concatenate((entries, self.load_entries(UsesIngredient.objects.filter(recipe__in=recipe_ids)))))
+        self.version = version
+    
+    def entries_of(self, ingredient_ids):
+        """
+        Return the positions in the index of the entries of the given ingredients
+        
+        """
+        ingredient_ids = numpy.asarray(list(ingredient_ids), dtype=numpy.int64)
+        positions = numpy.searchsorted(self.ingredient_ids, ingredient_ids)
+        found = positions < len(self.ingredient_ids)
+        found[found] = self.ingredient_ids[positions[found]] == ingredient_ids[found]
+        ranges = [numpy.arange(self.indptr[i], self.indptr[i + 1]) for i in numpy.unique(positions[found])]
+        if len(ranges) <= 0:
+            return numpy.array([], dtype=numpy.int64)
+        return numpy.concatenate(ranges)
+    
+    def recipes_using(self, ingredient_ids):
+        """
+        Return the sorted array of ids of the recipes using one of the given ingredients
+        
+        """
+        return numpy.unique(self.recipe_ids[self.entries_of(ingredient_ids)])
+    
+    def coverage(self, ingredient_ids):
+        """
+        Return the fraction of the UsesIngredient objects of every recipe (in the order of
+        ``all_recipe_ids``) that use one of the given ingredients
+        
+        """
+        entries = self.entries_of(ingredient_ids)
+        covered = numpy.bincount(self.recipe_positions[entries], weights=self.uses_counts[entries],
+                                 minlength=len(self.all_recipe_ids))
+        return covered / self.recipe_uses_counts
+
+# The index of this process
+_index = None
+
+def get_index():
+    """
+    Return the index of this process, which is rebuilt first if the ingredients of a
+    recipe have changed since it was built. Changes made by other processes are noticed
+    within ``general.models.VERSION_CHECK_INTERVAL`` seconds.
+    
+    """
+    global _index
+    version = DataVersion.objects.current_version(INDEX_VERSION)
+    if _index is None or _index.version != version:
+        _index = IngredientRecipeIndex(version)
+    return _index
+
+def update_index(recipe_ids):
+    """
+    Update the index after the ingredients of the given recipes have changed. The entries
+    of these recipes are replaced in the index of this process, while the index of every
+    other process is marked as outdated. If another process has changed the ingredients of
+    a recipe as well, the index of this process is rebuilt the next time it is used.
+    
+    """
+    global _index
+    recipe_ids = set(recipe_ids)
+    if len(recipe_ids) <= 0:
+        return
+    DataVersion.objects.increment(INDEX_VERSION)
+    if _index is None:
+        return
+    version = DataVersion.objects.current_version(INDEX_VERSION)
+    if version != _index.version + 1:
+        _index = None
+        return
+    _index.update_recipes(recipe_ids, version)
+
+def remove_deleted_recipe(sender, instance, **kwargs):
+    """
+    Remove a deleted recipe from the index. This is connected to the post_delete signal
+    of Recipe.
+    
+    """
+    update_index([instance.pk])
+
+def recipes_with_ingredient_name(index, name):
+    """
+    Return the sorted array of ids of the recipes using an ingredient of which the name
+    or the name of a synonym contains the given name
+    
+    """
+    return index.recipes_using(Ingredient.objects.with_name_like(name).values_list('id', flat=True))
+
+class IngredientFilteredRecipes(object):
+    """
+    The recipes of a queryset that are (or, when ``exclude`` is set, are not) in a sorted
+    array of recipe ids. Instead of sending the array to the database, only the ids of
+    the recipes in the queryset are fetched and filtered in memory, after which only the
+    recipes of a requested slice (e.g. the page of a ``Paginator``) are fetched, in the
+    order of the queryset.
+    
+    """
+    
+    def __init__(self, recipes, recipe_ids, exclude=False):
+        self.recipes = recipes
+        self.recipe_ids = recipe_ids
+        self.exclude = exclude
+        self._ids = None
+    
+    @property
+    def ids(self):
+        """
+        The ids of the matching recipes, in the order of the queryset
+        
+        """
+        if self._ids is None:
+            # The extra selects are fetched as well, as the queryset might be ordered by them
+            rows = self.recipes.values_list('id', *self.recipes.query.extra.keys())
+            ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+            self._ids = ids[numpy.in1d(ids, self.recipe_ids, invert=self.exclude)]
+        return self._ids
+    
+    def count(self):
+        return len(self.ids)
+    
+    def __len__(self):
+        return self.count()
+    
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0] if k >= 0 else list(self)[k]
+        page_ids = [int(recipe_id) for recipe_id in self.ids[k]]
+        recipes = dict((recipe.pk, recipe) for recipe in self.recipes.filter(pk__in=page_ids))
+        return [recipes[recipe_id] for recipe_id in page_ids if recipe_id in recipes]
+    
+    def __iter__(self):
+        return iter(self[:])
+
+def filter_on_ingredients(recipes, include_ingredient_names=(), include_ingredients_operator='and',
+                          exclude_ingredient_names=()):
+    """
+    Filter the given queryset of recipes on the ingredients they use. With the 'and'
+    operator, a recipe must use an ingredient matching every included name, with the 'or'
+    operator an ingredient matching one of them. A recipe must not use any ingredient
+    matching an excluded name.
+    
+    The names are resolved to ingredients first, then the matching recipes are combined
+    in memory using the index. As the amount of matching recipes is unbounded, they are
+    not sent to the database, an ``IngredientFilteredRecipes`` is returned instead. It
+    should be the last step of a query.
+    
+    """
+    if len(include_ingredient_names) <= 0 and len(exclude_ingredient_names) <= 0:
+        return recipes
+    index = get_index()
+    
+    included = None
+    for name in include_ingredient_names:
+        name_recipe_ids = recipes_with_ingredient_name(index, name)
+        if included is None:
+            included = name_recipe_ids
+        elif include_ingredients_operator == 'or':
+            included = numpy.union1d(included, name_recipe_ids)
+        else:
+            included = numpy.intersect1d(included, name_recipe_ids, assume_unique=True)
+    
+    excluded = numpy.array([], dtype=numpy.int64)
+    for name in exclude_ingredient_names:
+        excluded = numpy.union1d(excluded, recipes_with_ingredient_name(index, name))
+    
+    if included is not None:
+        return IngredientFilteredRecipes(recipes, numpy.setdiff1d(included, excluded, assume_unique=True))
+    # Without included ingredients, the excluded recipes are usually the smaller list
+    return IngredientFilteredRecipes(recipes, excluded, exclude=True)
+
+post_delete.connect(remove_deleted_recipe, sender=Recipe, dispatch_uid='remove_deleted_recipe_from_ingredient_index')
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from recipes.engine import recompute_queued_recipes, update_percentile_ranks, UPDATE_CHUNK_SIZE
+from recipes.models import QueuedRecipe
+
+class Command(BaseCommand):
+    help = "Recalculate the recipes in the recompute queue until it is empty. This must be scheduled, see README.md"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=UPDATE_CHUNK_SIZE,
+                    help='The amount of recipes recalculated in one transaction (default %d)' % UPDATE_CHUNK_SIZE),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+                    help='Only show the depth and lag of the queue'),
+    )
+    
+    def handle(self, *args, **options):
+        """
+        Drain the queue in batches, or show its state if --stats is given. The recipes are
+        ranked again once the queue is empty.
+        
+        """
+        if options['stats']:
+            lag = QueuedRecipe.objects.lag()
+            self.stdout.write('%d recipes in the queue, the oldest has been waiting for %s' % (QueuedRecipe.objects.depth(),
+                                                                                              lag if lag is not None else '0:00:00'))
+            return
+        
+        updated = 0
+        while True:
+            batch_updated = recompute_queued_recipes(batch_size=options['batch_size'])
+            if batch_updated <= 0:
+                break
+            updated += batch_updated
+        self.stdout.write('Recalculated %d recipes' % updated)
+        if updated > 0:
+            ranked = update_percentile_ranks()
+            self.stdout.write('Updated the footprint percentiles of %d recipes' % ranked)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from recipes.models import RecipeFootprintBucket
+
+class Command(NoArgsCommand):
+    help = "Recount the footprint buckets of all recipes, used by the relative footprint histograms"
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        RecipeFootprintBucket.objects.rebuild()
+        self.stdout.write('Counted %d footprint buckets' % RecipeFootprintBucket.objects.count())
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from recipes.models import Recipe
+from recipes.search import index_recipes
+
+class Command(NoArgsCommand):
+    help = "Rebuild the search index of every recipe"
+    
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+        index_recipes(recipe_ids)
+        self.stdout.write('Indexed %d recipes' % len(recipe_ids))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from optparse import make_option
+from ingredients.engine import FootprintEngine
+from recipes.engine import update_monthly_footprints
+from recipes.models import Recipe
+
+class Command(BaseCommand):
+    help = "Recalculate the stored footprint evolution of every recipe"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='The size of the recipe id ranges stored in one transaction (default 1000)'),
+        make_option('--daily', action='store_true', dest='daily', default=None,
+                    help='Store the footprints on every day of the year as well'),
+    )
+    
+    def handle(self, *args, **options):
+        """
+        Rebuild the evolutions of all recipes, one id range at a time
+        
+        """
+        engine = FootprintEngine()
+        max_id = Recipe.objects.aggregate(Max('id'))['id__max'] or 0
+        updated = 0
+        for start in range(0, max_id + 1, options['chunk_size']):
+            with transaction.commit_on_success():
+                updated += update_monthly_footprints(engine=engine, id_range=(start, start + options['chunk_size']),
+                                                     daily=options['daily'])
+        self.stdout.write('Updated the footprint evolution of %d recipes' % updated)
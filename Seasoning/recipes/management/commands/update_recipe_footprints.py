@@ -1,16 +1,176 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+from multiprocessing import Pool
+import datetime
+import json
+import os
+import time
 from recipes.models import Recipe, UsesIngredient
 from ingredients.models import Ingredient
+from ingredients.engine import FootprintEngine
+from recipes.engine import recalculate_recipe_footprints, recalculate_transitioning_recipe_footprints,\
+    update_percentile_ranks
+
+# The footprint engine of the current (worker) process, see ``init_worker``
+engine = None
+
+def init_worker():
+    """
+    Load the ingredient catalog into the footprint engine of this process
+    
+    """
+    global engine
+    engine = FootprintEngine()
+
+def update_chunk(chunk):
+    """
+    Recalculate the footprints of the recipes with start <= id < end on the given
+    date in a single transaction. Returns the end of the chunk and the amount of 
+    recipes that were updated.
+    
+    """
+    start, end, date = chunk
+    with transaction.commit_on_success():
+        updated = recalculate_recipe_footprints(date=date, engine=engine, id_range=(start, end))
+    return end, updated
 
 class Command(BaseCommand):
-    def handle(self):
+    help = "Recalculate the footprint of every recipe for the current date"
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--matrix', action='store_true', dest='matrix', default=False,
+                    help='Recalculate all footprints at once using a recipe x ingredient matrix, '
+                         'instead of saving every object'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='The size of the recipe id ranges that are recalculated in one '
+                         'transaction when using --matrix (default 1000)'),
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='The amount of processes recalculating chunks when using --matrix (default 1)'),
+        make_option('--transitions', action='store_true', dest='transitions', default=False,
+                    help='Only recalculate the recipes using an ingredient whose footprint changes today. '
+                         'This requires the command to run every day.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='A file keeping track of the last recipe that was updated when using --matrix. If '
+                         'the command is interrupted, running it again on the same day with the same file '
+                         'resumes it.'),
+    )
+    
+    def handle(self, *args, **options):
         """
         Recalculate the footprint of all usesingredients that use a seasonal ingredient. Then
-        recalculate the footprint of every recipe.
+        recalculate the footprint of every recipe. Finally, rank the recipes by their new
+        footprints.
+        
+        """
+        if options['transitions']:
+            updated = recalculate_transitioning_recipe_footprints()
+            self.stdout.write('Updated the footprints of %d recipes' % updated)
+        elif options['matrix']:
+            if options['chunk_size'] < 1 or options['workers'] < 1:
+                raise CommandError('The chunk size and the amount of workers must be at least 1')
+            self.handle_matrix(options['chunk_size'], options['workers'], options['checkpoint'])
+        else:
+            for uses_ingredient in UsesIngredient.objects.filter(ingredient__type__in=[Ingredient.SEASONAL, Ingredient.SEASONAL_SEA]):
+                uses_ingredient.save()
+                
+            for recipe in Recipe.objects.all():
+                recipe.save()
         
+        ranked = update_percentile_ranks()
+        self.stdout.write('Updated the footprint percentiles of %d recipes' % ranked)
+    
+    def handle_matrix(self, chunk_size, workers, checkpoint_file):
         """
-        for uses_ingredient in UsesIngredient.objects.filter(ingredient__type__in=[Ingredient.SEASONAL, Ingredient.SEASONAL_SEA]):
-            uses_ingredient.save()
+        Recalculate the footprints of all recipes in chunks of recipe id ranges, 
+        reporting the progress after every chunk.
+        
+        """
+        checkpoint = self.load_checkpoint(checkpoint_file)
+        date = datetime.datetime.strptime(checkpoint['date'], '%Y-%m-%d').date()
+        
+        if checkpoint['last_id'] is not None:
+            self.stdout.write('Resuming from checkpoint, the recipes up to id %d were already updated' % checkpoint['last_id'])
+        chunks = [(start, end, date) for start, end in self.chunk_bounds(checkpoint['last_id'], chunk_size)]
+        if len(chunks) <= 0:
+            self.stdout.write('There are no recipes to update')
+        
+        pool = None
+        if workers > 1:
+            # Every worker process must open its own database connection
+            connection.close()
+            pool = Pool(workers, initializer=init_worker)
+            # The results are returned in order, so every finished chunk extends the 
+            # recipes that were updated without gaps
+            results = pool.imap(update_chunk, chunks)
+        else:
+            init_worker()
+            results = (update_chunk(chunk) for chunk in chunks)
+        
+        start_time = time.time()
+        updated = 0
+        for i, (end, chunk_updated) in enumerate(results, start=1):
+            updated += chunk_updated
+            checkpoint['last_id'] = end - 1
+            self.save_checkpoint(checkpoint_file, checkpoint)
             
-        for recipe in Recipe.objects.all():
-            recipe.save()
\ No newline at end of file
+            elapsed = time.time() - start_time
+            self.stdout.write('Chunk %d/%d finished: %d recipes updated in %.1fs (%.1f recipes/s)' % (i, len(chunks), updated, elapsed,
+                                                                                                       updated / elapsed if elapsed > 0 else 0))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            # Every chunk is finished, so the next run has to start over
+            os.remove(checkpoint_file)
+        self.stdout.write('Updated the footprints of %d recipes' % updated)
+    
+    def chunk_bounds(self, last_id, chunk_size):
+        """
+        Return the (start, end) id ranges of the chunks of at most chunk_size recipes with
+        an id larger than the given one (or every recipe if it is None). The ids are fetched
+        in a single ordered pass over the primary key index, so no gaps in them lead to
+        empty chunks.
+        
+        """
+        if last_id is None:
+            last_id = 0
+        recipe_ids = list(Recipe.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True))
+        bounds = []
+        for i in range(0, len(recipe_ids), chunk_size):
+            end_id = recipe_ids[min(i + chunk_size, len(recipe_ids)) - 1]
+            bounds.append((last_id + 1, end_id + 1))
+            last_id = end_id
+        return bounds
+    
+    def load_checkpoint(self, checkpoint_file):
+        """
+        Load the checkpoint from the given file. If there is no checkpoint yet, a new one
+        is started for today. A checkpoint of an earlier day is refused, as resuming it
+        would calculate the remaining footprints for that day. The chunks only depend on
+        the last updated recipe, so a checkpoint can be resumed with any chunk size.
+        
+        """
+        today = datetime.date.today().strftime('%Y-%m-%d')
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                checkpoint = json.load(f)
+            if checkpoint['date'] != today:
+                raise CommandError('The checkpoint was made on %s, remove %s to update the footprints for today' 
+                                   % (checkpoint['date'], checkpoint_file))
+            return checkpoint
+        return {'date': today,
+                'last_id': None}
+    
+    def save_checkpoint(self, checkpoint_file, checkpoint):
+        """
+        Write the checkpoint to the given file. The file is replaced at once, so an interrupted
+        write never leaves a corrupt checkpoint.
+        
+        """
+        if not checkpoint_file:
+            return
+        with open(checkpoint_file + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(checkpoint_file + '.tmp', checkpoint_file)
\ No newline at end of file
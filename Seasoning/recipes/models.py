@@ -17,8 +17,8 @@ You should have received a copy of the GNU General Public License
 along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
     
 """
-import os, time
-from django.db import models
+import os, time, math
+from django.db import models, connection, transaction, IntegrityError
 from authentication.models import User
 from imagekit.models.fields import ProcessedImageField, ImageSpecField
 from imagekit.processors.resize import ResizeToFill, Resize, SmartResize
@@ -29,8 +29,9 @@ import datetime
 from django.core.validators import MaxValueValidator, MinValueValidator,\
     MaxLengthValidator
 from django.db.models.fields import FloatField
-from django.core.exceptions import ValidationError, PermissionDenied
+from django.core.exceptions import ValidationError, PermissionDenied, ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
+from django.db.models.signals import pre_delete, post_delete
 
 def get_image_filename(instance, old_filename):
     filename = str(time.time()) + '.png'
@@ -54,12 +55,9 @@ class RecipeManager(models.Manager):
               courses=[], include_ingredients_operator='and', include_ingredient_names=[],
               exclude_ingredient_names=[]):
         
-        recipes_list = Recipe.objects
-        
-        name_query = models.Q(name__icontains=search_string)
+        recipes_list = self.search(search_string)
             
         veg_filter = models.Q()
-        incl_ingredient_filter = models.Q()
         additional_filters = models.Q(accepted=True)
         if advanced_search:
             # Filter for Veganism
@@ -70,23 +68,13 @@ class RecipeManager(models.Manager):
             if nveg:
                 veg_filter = veg_filter | models.Q(veganism=Ingredient.NON_VEGETARIAN)
             
-            # Filter for included en excluded ingredients
-            if include_ingredients_operator == 'and':
-                for ingredient_name in include_ingredient_names:
-                    recipes_list = recipes_list.filter(ingredients__name__icontains=ingredient_name)
-            elif include_ingredients_operator == 'or':
-                for ingredient_name in include_ingredient_names:
-                    incl_ingredient_filter = incl_ingredient_filter | models.Q(ingredients__name__icontains=ingredient_name)            
-            for ingredient_name in exclude_ingredient_names:
-                recipes_list = recipes_list.exclude(ingredients__name__icontains=ingredient_name)
-            
             if cuisines:
                 additional_filters = additional_filters & models.Q(cuisine__in=cuisines)
             
             if courses:
                 additional_filters = additional_filters & models.Q(course__in=courses)
                      
-        recipes_list = recipes_list.filter(name_query & veg_filter & incl_ingredient_filter & additional_filters)
+        recipes_list = recipes_list.filter(veg_filter & additional_filters)
         
         # SORTING
         if sort_field:
@@ -94,13 +82,63 @@ class RecipeManager(models.Manager):
                 recipes_list = recipes_list.extra(select={'tot_time': 'active_time + passive_time'})
             sort_field = sort_order + sort_field
             recipes_list = recipes_list.order_by(sort_field)
+        recipes_list = recipes_list.distinct()
+        
+        if advanced_search:
+            # Filter for included en excluded ingredients, which is done last, as the 
+            # result is no longer a queryset
+            from recipes.ingredient_index import filter_on_ingredients
+            recipes_list = filter_on_ingredients(recipes_list, include_ingredient_names, include_ingredients_operator,
+                                                 exclude_ingredient_names)
+        return recipes_list
+    
+    def search(self, search_string):
+        """
+        Return the recipes matching the given search string, annotated with their
+        ``relevance``. See ``recipes.search.search``.
+        
+        """
+        from recipes.search import search
+        return search(self.all(), search_string)
+    
+    def in_season_on(self, date=None):
+        """
+        Return the recipes of which every ingredient is in season on the given date, or
+        today if no date is given
         
-        return recipes_list.distinct()
+        """
+        if date is None:
+            date = datetime.date.today()
+        qn = connection.ops.quote_name
+        return self.extra(where=['NOT EXISTS (SELECT 1 FROM %(uses)s JOIN %(ingredient)s ON %(uses)s.%(uses_ingredient)s = %(ingredient)s.%(id)s '
+                                 'WHERE %(uses)s.%(uses_recipe)s = %(recipe)s.%(id)s AND SUBSTR(%(ingredient)s.%(availability)s, %%s, 1) <> %%s)'
+                                 % {'uses': qn(UsesIngredient._meta.db_table), 'ingredient': qn(Ingredient._meta.db_table),
+                                    'recipe': qn(Recipe._meta.db_table), 'id': qn('id'), 'availability': qn('availability'),
+                                    'uses_ingredient': qn('ingredient'), 'uses_recipe': qn('recipe')}],
+                          params=[ingredients.models.day_of_year(date), ingredients.models.AVAILABLE])
+    
+    def greenest(self, percentage, course=None, veganism=None):
+        """
+        Return the recipes whose footprint is among the smallest given percentage of all
+        recipes, or of the recipes of the given course or veganism. Recipes that have not
+        been ranked yet are left out.
+        
+        """
+        if course is None and veganism is None:
+            return self.filter(footprint_percentile__lte=percentage)
+        recipes = self.all()
+        if course is not None:
+            recipes = recipes.filter(course=course, course_footprint_percentile__lte=percentage)
+        if veganism is not None:
+            recipes = recipes.filter(veganism=veganism, veganism_footprint_percentile__lte=percentage)
+        return recipes
 
 class Recipe(models.Model):
     
     class Meta:
         db_table = 'recipe'
+        index_together = [['course', 'course_footprint_percentile'],
+                          ['veganism', 'veganism_footprint_percentile']]
         
     objects = RecipeManager()
     
@@ -148,6 +186,12 @@ class Recipe(models.Model):
     # Footprint per portion
     footprint = FloatField(editable=False)
     veganism = models.PositiveSmallIntegerField(choices=Ingredient.VEGANISMS, editable=False)
+    # The percentage of all recipes, the recipes of the same course and the recipes of the same
+    # veganism with a footprint that is not larger than the footprint of this recipe. These are
+    # updated by the recompute commands, see ``recipes.engine.update_percentile_ranks``
+    footprint_percentile = models.FloatField(null=True, editable=False, db_index=True)
+    course_footprint_percentile = models.FloatField(null=True, editable=False)
+    veganism_footprint_percentile = models.FloatField(null=True, editable=False)
     
     accepted = models.BooleanField(default=False)        
     
@@ -170,29 +214,150 @@ class Recipe(models.Model):
         with the lowest veganism.
         
         """
+        ingredients_changed = kwargs.pop('ingredients_changed', False)
+        
         if not self.save_allowed:
             raise PermissionDenied('Saving this object has been disallowed')
         
-        self.footprint = 0
-        self.veganism = Ingredient.VEGAN
+        old_values = self.stored_values()
+        self.update_state(self.uses.all())
+        saved = super(Recipe, self).save(*args, **kwargs)
+        self.saved(old_values, ingredients_changed)
+        
+        return saved
+    
+    def histogram_values(self):
+        """
+        Return the stored (footprint, course, veganism) of this recipe as a list, as used
+        by ``RecipeFootprintBucketManager.record``
+        
+        """
+        if self.pk is None:
+            return []
+        return list(Recipe.objects.filter(pk=self.pk).values_list('footprint', 'course', 'veganism'))
+    
+    def stored_values(self):
+        """
+        Return the stored values of this recipe that the data derived from it depends on
+        as a dict, or None if it has not been saved yet
+        
+        """
+        if self.pk is None:
+            return None
+        values = list(Recipe.objects.filter(pk=self.pk).values('footprint', 'course', 'veganism', 'portions', 'name', 'description'))
+        return values[0] if len(values) > 0 else None
+    
+    def update_state(self, usess):
+        """
+        Calculate the footprint of this recipe by adding the footprints of the given
+        used ingredients, and its veganism and state from their ingredients, which are
+        looked up in the catalog snapshot.
         
+        """
+        from ingredients import catalog
+        snapshot = catalog.get_catalog()
+        
+        self.veganism = Ingredient.VEGAN
         total_footprint = 0
         self.accepted = True
-        for uses in self.uses.all():
+        for uses in usess:
             # Add the footprint for this used ingredient to the total
             total_footprint += uses.footprint
             
+            ingredient = snapshot.ingredients.get(uses.ingredient_id)
+            if ingredient is None:
+                # The ingredient was added after the snapshot was loaded
+                ingredient = uses.ingredient
+            
             # Check the veganism of this ingredient
-            if uses.ingredient.veganism < self.veganism:
-                self.veganism = uses.ingredient.veganism
+            if ingredient.veganism < self.veganism:
+                self.veganism = ingredient.veganism
             
             # Check the state of this ingredient
-            if not uses.ingredient.accepted:
+            if not ingredient.accepted:
                 self.accepted = False
         self.footprint = total_footprint / self.portions
+    
+    def saved(self, old_values, ingredients_changed=False):
+        """
+        Update the data derived from this recipe after it has been saved, given its stored
+        values before the save (see ``stored_values``) and whether its ingredients changed.
+        Saves that don't change anything it depends on, like those of a new vote, leave
+        it alone.
+        
+        """
+        old_histogram_values = []
+        if old_values is not None:
+            old_histogram_values = [(old_values['footprint'], old_values['course'], old_values['veganism'])]
+        RecipeFootprintBucket.objects.record(old_histogram_values, [(self.footprint, self.course, self.veganism)])
+        
+        if (old_values is None or ingredients_changed or old_values['name'] != self.name
+                or old_values['description'] != self.description):
+            from recipes.search import index_recipes
+            index_recipes([self.pk])
         
-                
-        return super(Recipe, self).save(*args, **kwargs)
+        if (old_values is not None and not ingredients_changed and old_values['footprint'] == self.footprint
+                and old_values['portions'] == self.portions):
+            return
+        # The stored footprint evolution is outdated, it will be rebuilt when it is requested
+        RecipeMonthlyFootprint.objects.filter(recipe=self).delete()
+    
+    def save_with_ingredients(self, usess, deleted_usess=()):
+        """
+        Save this recipe together with all of its used ingredients, of which the given
+        ones should be deleted.
+        
+        The footprints of the used ingredients and the state of the recipe are calculated
+        in memory from the catalog snapshot, after which everything is written in one
+        transaction: the recipe, the deleted used ingredients, one bulk insert for the new
+        used ingredients and one bulk update per column for the existing ones. If a
+        transaction is already being managed, for example by the view, it is used 
+        instead.
+        
+        """
+        if not self.save_allowed:
+            raise PermissionDenied('Saving this object has been disallowed')
+        
+        from ingredients import catalog
+        snapshot = catalog.get_catalog()
+        today = datetime.date.today()
+        for uses in usess:
+            if not uses.save_allowed:
+                raise PermissionDenied('Saving this object has been disallowed')
+            uses.calculate_footprint(snapshot, today)
+        
+        if transaction.is_managed():
+            # Part of the transaction of the caller, a nested commit_on_success would 
+            # commit it when it exits
+            return self._write_with_ingredients(usess, deleted_usess)
+        with transaction.commit_on_success():
+            return self._write_with_ingredients(usess, deleted_usess)
+    
+    def _write_with_ingredients(self, usess, deleted_usess):
+        from recipes.engine import bulk_update_column
+        from recipes.ingredient_index import update_index
+        old_values = self.stored_values()
+        self.update_state(usess)
+        saved = super(Recipe, self).save()
+        
+        deleted_ids = [uses.pk for uses in deleted_usess if uses.pk is not None]
+        if deleted_ids:
+            UsesIngredient.objects.filter(pk__in=deleted_ids).delete()
+        for uses in usess:
+            uses.recipe_id = self.pk
+        UsesIngredient.objects.bulk_create([uses for uses in usess if uses.pk is None])
+        existing = [uses for uses in usess if uses.pk is not None]
+        if existing:
+            ids = [uses.pk for uses in existing]
+            for column, attname, value_type in (('ingredient', 'ingredient_id', int), ('unit', 'unit_id', int),
+                                                ('amount', 'amount', float), ('group', 'group', unicode),
+                                                ('footprint', 'footprint', float)):
+                bulk_update_column(UsesIngredient, column, ids, [getattr(uses, attname) for uses in existing],
+                                   value_type=value_type)
+        update_index([self.pk])
+        
+        self.saved(old_values, ingredients_changed=True)
+        return saved
     
     def total_footprint(self):
         return self.footprint * self.portions
@@ -249,11 +414,33 @@ class UsesIngredient(models.Model):
         for a given ingredient footprint
         
         """
-        for canuseunit in self.ingredient.canuseunit_set.all():
-            if canuseunit.unit == self.unit:
-                unit_properties = canuseunit
-                break
-        return self.amount * unit_properties.conversion_factor * ingredient_footprint
+        conversion_factor = ingredients.models.get_conversion_factor(self.ingredient_id, self.unit_id)
+        if conversion_factor is None:
+            raise CanUseUnit.DoesNotExist('%s can not use %s' % (self.ingredient, self.unit))
+        return self.amount * conversion_factor * ingredient_footprint
+    
+    def calculate_footprint(self, snapshot, date):
+        """
+        Calculate the footprint of this object on the given date, with the footprint of
+        its ingredient in the given catalog snapshot
+        
+        """
+        ingredient = snapshot.ingredients.get(self.ingredient_id)
+        if ingredient is None:
+            # The ingredient was added after the snapshot was loaded, so its footprint 
+            # and conversion factor are read from the database
+            if self.ingredient.accepted:
+                self.footprint = self.normalized_footprint(self.ingredient.footprint(date))
+            else:
+                self.footprint = 0
+        elif not ingredient.accepted:
+            self.footprint = 0
+        else:
+            ingredient_footprint = snapshot.footprint(self.ingredient_id, date)
+            if ingredient_footprint is None:
+                raise ObjectDoesNotExist('No active AvailableIn object was found for ingredient ' + ingredient.name)
+            self.footprint = self.normalized_footprint(ingredient_footprint)
+        return self.footprint
     
     def clean(self, *args, **kwargs):
         # Validate that is ingredient is using a unit that it can use
@@ -265,11 +452,11 @@ class UsesIngredient(models.Model):
             # If the ingredient is not accepted, it might not have any useable units. To prevent
             # false positivies, skip the validation
             return self
-        try:
-            self.ingredient.useable_units.get(pk=self.unit.pk)
-            return self
-        except Unit.DoesNotExist:
+        # The useable units of every ingredient are part of the catalog snapshot
+        from ingredients import catalog
+        if not catalog.get_catalog().can_use_unit(self.ingredient_id, self.unit_id):
             raise ValidationError('This unit cannot be used for measuring this Ingredient.')
+        return self
         
     
     def save(self, *args, **kwargs):
@@ -285,11 +472,294 @@ class UsesIngredient(models.Model):
         
         saved = super(UsesIngredient, self).save(*args, **kwargs)
         
+        from recipes.ingredient_index import update_index
+        update_index([self.recipe_id])
         if update_recipe:
             # Update the recipe as well
-            self.recipe.save()
+            self.recipe.save(ingredients_changed=True)
+        else:
+            from recipes.search import index_recipes
+            index_recipes([self.recipe_id])
         
         return saved
+    
+    def delete(self, *args, **kwargs):
+        super(UsesIngredient, self).delete(*args, **kwargs)
+        from recipes.ingredient_index import update_index
+        update_index([self.recipe_id])
+        from recipes.search import index_recipes
+        index_recipes([self.recipe_id])
+
+class QueuedRecipeManager(models.Manager):
+    
+    def enqueue(self, recipe_ids):
+        """
+        Add the recipes with the given ids to the queue. Recipes that are already in the
+        queue are not added twice, but their request count is incremented, so a worker that
+        is currently recalculating them will leave them in the queue.
+        
+        """
+        recipe_ids = set(recipe_ids)
+        if len(recipe_ids) <= 0:
+            return
+        now = datetime.datetime.now()
+        queued_ids = set(self.filter(recipe__in=recipe_ids).values_list('recipe', flat=True))
+        if queued_ids:
+            self.filter(recipe__in=queued_ids).update(requests=models.F('requests') + 1)
+        try:
+            self.bulk_create([QueuedRecipe(recipe_id=recipe_id, time_queued=now)
+                              for recipe_id in recipe_ids - queued_ids])
+        except IntegrityError:
+            # Another process queued some of these recipes in the meantime
+            for recipe_id in recipe_ids - queued_ids:
+                queued, created = self.get_or_create(recipe_id=recipe_id, defaults={'time_queued': now})
+                if not created:
+                    self.filter(pk=queued.pk).update(requests=models.F('requests') + 1)
+    
+    def enqueue_for_ingredients(self, ingredient_ids):
+        """
+        Add every recipe using one of the ingredients with the given ids to the queue
+        
+        """
+        self.enqueue(UsesIngredient.objects.filter(ingredient__in=list(ingredient_ids)).values_list('recipe', flat=True))
+    
+    def depth(self):
+        """
+        The amount of recipes waiting to be recalculated
+        
+        """
+        return self.count()
+    
+    def lag(self):
+        """
+        The time the oldest recipe in the queue has been waiting, or None if the queue
+        is empty
+        
+        """
+        oldest = self.aggregate(models.Min('time_queued'))['time_queued__min']
+        if oldest is None:
+            return None
+        return datetime.datetime.now() - oldest
+
+class QueuedRecipe(models.Model):
+    """
+    A recipe whose footprint, veganism and acceptance have to be recalculated because
+    one of its ingredients has changed. The queue is drained by the
+    ``process_recompute_queue`` command.
+    
+    """
+    class Meta:
+        db_table = 'queuedrecipe'
+    
+    objects = QueuedRecipeManager()
+    
+    recipe = models.ForeignKey(Recipe, unique=True, db_column='recipe')
+    # The first time the recipe was added to the queue
+    time_queued = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+    # The amount of times the recipe was added to the queue
+    requests = models.PositiveIntegerField(default=1)
+    
+    def __unicode__(self):
+        return unicode(self.recipe)
+
+class RecipeSearchTerm(models.Model):
+    """
+    An entry in the search index of the recipes: a term that occurs in the name, the
+    description or the names of the ingredients of a recipe, with a weight depending on
+    where and how often it occurs. See ``recipes.search``.
+    
+    """
+    class Meta:
+        db_table = 'recipesearchterm'
+        # Also the index used to look up terms
+        unique_together = (('term', 'recipe'),)
+    
+    term = models.CharField(max_length=50)
+    recipe = models.ForeignKey(Recipe, db_column='recipe', related_name='search_terms')
+    weight = models.FloatField()
+    
+    def __unicode__(self):
+        return self.term
+
+class RecipeMonthlyFootprintManager(models.Manager):
+    
+    def store(self, recipe_ids, monthly_footprints, daily_footprints=None):
+        """
+        Replace the stored footprint evolutions of the recipes with the given ids. The
+        footprints are given as matrices with a row for every recipe, containing the
+        footprints per portion on the first day of every month, and optionally on every
+        day of the year.
+        
+        """
+        recipe_ids = [int(recipe_id) for recipe_id in recipe_ids]
+        for start in range(0, len(recipe_ids), 500):
+            self.filter(recipe__in=recipe_ids[start:start + 500]).delete()
+        now = datetime.datetime.now()
+        evolutions = []
+        for i, recipe_id in enumerate(recipe_ids):
+            daily = '' if daily_footprints is None else RecipeMonthlyFootprint.join_footprints(daily_footprints[i])
+            evolutions.append(RecipeMonthlyFootprint(recipe_id=recipe_id, time_updated=now,
+                                                     monthly=RecipeMonthlyFootprint.join_footprints(monthly_footprints[i]),
+                                                     daily=daily))
+        self.bulk_create(evolutions, batch_size=500)
+
+class RecipeMonthlyFootprint(models.Model):
+    """
+    The footprint per portion of a recipe on the first day of every month, and optionally on
+    every day of the year, as shown in the footprint evolution chart of the recipe. These are
+    stored as comma separated lists, so the evolution of a recipe can be read from a single row.
+    
+    The footprints are refreshed every time the recipe is recomputed (see
+    ``recipes.engine.update_monthly_footprints``). When a recipe is saved, its stored footprints
+    are removed.
+    
+    """
+    class Meta:
+        db_table = 'recipemonthlyfootprint'
+    
+    objects = RecipeMonthlyFootprintManager()
+    
+    recipe = models.OneToOneField(Recipe, primary_key=True, db_column='recipe', related_name='monthly_footprint')
+    monthly = models.CharField(max_length=300)
+    daily = models.TextField(blank=True, default='')
+    time_updated = models.DateTimeField(default=datetime.datetime.now)
+    
+    @staticmethod
+    def join_footprints(footprints):
+        return ','.join(repr(float(footprint)) for footprint in footprints)
+    
+    @staticmethod
+    def split_footprints(footprints):
+        if not footprints:
+            return []
+        return [float(footprint) for footprint in footprints.split(',')]
+    
+    def monthly_footprints(self):
+        return self.split_footprints(self.monthly)
+    
+    def daily_footprints(self):
+        """
+        The footprints on every day of the year, or an empty list if these were not stored
+        
+        """
+        return self.split_footprints(self.daily)
+    
+    def __unicode__(self):
+        return unicode(self.recipe)
+
+class RecipeFootprintBucketManager(models.Manager):
+    
+    def record(self, old_values, new_values):
+        """
+        Update the buckets after recipes have changed. Both arguments are lists of
+        (footprint, course, veganism) tuples, the first containing the values of the
+        changed recipes before the change, the second their values after it. Removed
+        recipes only have old values, new recipes only new ones.
+        
+        """
+        changes = {}
+        for footprint, course, veganism in old_values:
+            key = (RecipeFootprintBucket.bucket_of(footprint), course, veganism)
+            changes[key] = changes.get(key, 0) - 1
+        for footprint, course, veganism in new_values:
+            key = (RecipeFootprintBucket.bucket_of(footprint), course, veganism)
+            changes[key] = changes.get(key, 0) + 1
+        
+        for (bucket, course, veganism), change in changes.items():
+            if change == 0:
+                continue
+            buckets = self.filter(bucket=bucket, course=course, veganism=veganism)
+            if buckets.update(count=models.F('count') + change) <= 0 and change > 0:
+                try:
+                    self.create(bucket=bucket, course=course, veganism=veganism, count=change)
+                except IntegrityError:
+                    # Another process created this bucket in the meantime
+                    buckets.update(count=models.F('count') + change)
+            elif change < 0:
+                buckets.filter(count__lte=0).delete()
+    
+    def rebuild(self):
+        """
+        Recount the buckets from scratch. This is only required when recipe footprints
+        have been changed without going through ``record``.
+        
+        """
+        counts = {}
+        for footprint, course, veganism in Recipe.objects.values_list('footprint', 'course', 'veganism').iterator():
+            key = (RecipeFootprintBucket.bucket_of(footprint), course, veganism)
+            counts[key] = counts.get(key, 0) + 1
+        self.all().delete()
+        self.bulk_create([RecipeFootprintBucket(bucket=bucket, course=course, veganism=veganism, count=count)
+                          for (bucket, course, veganism), count in counts.items()], batch_size=500)
+    
+    def histogram(self, course, veganism, interval_count=10):
+        """
+        Return the histogram of the normalized footprints of all recipes, of the recipes
+        of the given course and of the recipes with the given veganism, with the given
+        amount of equally sized intervals between the smallest and largest footprint.
+        
+        The result is a dict with the counts (``all_fps``, ``cat_fps`` and ``veg_fps``),
+        the bounds of the histogram (``min_fp`` and ``max_fp``) and the ``interval_length``,
+        or None if there are no recipes. The bounds are rounded to whole buckets.
+        
+        """
+        buckets = self.filter(count__gt=0).values('bucket').annotate(total=models.Sum('count'))
+        all_counts = dict((bucket['bucket'], bucket['total']) for bucket in buckets)
+        if len(all_counts) <= 0:
+            return None
+        course_counts = dict((bucket['bucket'], bucket['total']) for bucket in buckets.filter(course=course))
+        veganism_counts = dict((bucket['bucket'], bucket['total']) for bucket in buckets.filter(veganism=veganism))
+        
+        first, last = min(all_counts), max(all_counts)
+        def intervals(counts):
+            interval_counts = [0] * interval_count
+            for bucket, count in counts.items():
+                interval_counts[(bucket - first)*interval_count // (last + 1 - first)] += count
+            return interval_counts
+        
+        min_fp = first * RecipeFootprintBucket.WIDTH
+        max_fp = (last + 1) * RecipeFootprintBucket.WIDTH
+        return {'all_fps': intervals(all_counts),
+                'cat_fps': intervals(course_counts),
+                'veg_fps': intervals(veganism_counts),
+                'min_fp': min_fp,
+                'max_fp': max_fp,
+                'interval_length': (max_fp - min_fp)/interval_count}
+
+class RecipeFootprintBucket(models.Model):
+    """
+    The amount of recipes of a course and veganism whose normalized footprint (for 4 portions)
+    falls into a bucket of footprints. Bucket X contains the footprints between X*WIDTH and
+    (X+1)*WIDTH.
+    
+    The buckets are kept up to date whenever the footprint, course or veganism of a recipe
+    changes, so the footprint histograms can be built without looking at the recipes.
+    
+    """
+    class Meta:
+        db_table = 'recipefootprintbucket'
+        unique_together = (('bucket', 'course', 'veganism'),)
+    
+    objects = RecipeFootprintBucketManager()
+    
+    # The size of the footprint range of a bucket
+    WIDTH = 0.1
+    
+    bucket = models.IntegerField()
+    course = models.PositiveSmallIntegerField(choices=Recipe.COURSES)
+    veganism = models.PositiveSmallIntegerField(choices=Ingredient.VEGANISMS)
+    count = models.IntegerField(default=0)
+    
+    @staticmethod
+    def bucket_of(footprint):
+        """
+        The bucket of the given footprint per portion
+        
+        """
+        return int(math.floor(4*footprint / RecipeFootprintBucket.WIDTH))
+    
+    def __unicode__(self):
+        return u'%s, %s: %d' % (self.get_course_display(), self.get_veganism_display(), self.count)
 
 class UnknownIngredient(models.Model):
     class Meta:
@@ -322,4 +792,26 @@ class Vote(models.Model):
     def delete(self, *args, **kwargs):
         super(Vote, self).delete(*args, **kwargs)
         self.recipe.calculate_and_set_rating()
-    
\ No newline at end of file
+
+def remember_histogram_values(sender, instance, **kwargs):
+    """
+    Remember the stored values of a recipe that is about to be deleted, so its bucket can
+    be decremented once it is gone. This is connected to the pre_delete signal of Recipe,
+    which is also sent for queryset and cascading deletes.
+    
+    """
+    instance._deleted_histogram_values = instance.histogram_values()
+
+def record_deleted_recipe(sender, instance, **kwargs):
+    """
+    Remove a deleted recipe from the footprint buckets. This is connected to the 
+    post_delete signal of Recipe.
+    
+    """
+    RecipeFootprintBucket.objects.record(getattr(instance, '_deleted_histogram_values', []), [])
+
+pre_delete.connect(remember_histogram_values, sender=Recipe, dispatch_uid='remember_recipe_histogram_values')
+post_delete.connect(record_deleted_recipe, sender=Recipe, dispatch_uid='record_deleted_recipe')
+
+# Connect the signals that keep the site statistics and the ingredient index up to date
+from recipes import statistics, ingredient_index
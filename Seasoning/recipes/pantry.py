@@ -0,0 +1,114 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import numpy
+from django.db.models import Q
+from ingredients import catalog
+from ingredients.models import Ingredient
+from recipes.models import Recipe
+from recipes.ingredient_index import get_index
+
+# The default amount of recipes returned by a pantry search
+PANTRY_RESULTS = 48
+
+# The maximum amount of recipe ids that is sent to the database in one query
+PANTRY_BATCH_SIZE = 500
+
+def split_ingredient_names(ingredient_names):
+    """
+    Split a comma separated list of ingredient names
+    
+    """
+    return [name.strip() for name in ingredient_names.split(',') if name.strip()]
+
+def resolve_ingredient_names(names):
+    """
+    Return the ids of the accepted ingredients with the given names (or synonyms), and
+    the names that did not match any of them. The names are looked up in the catalog
+    snapshot like ``Ingredient.objects.accepted_with_name`` does, only the names that
+    are not in it are looked up in the database.
+    
+    """
+    snapshot = catalog.get_catalog()
+    ingredient_ids, missing_names = set(), []
+    for name in names:
+        name_ingredient_ids = snapshot.ingredient_ids_with_name(name, accepted_only=True)
+        if name_ingredient_ids:
+            ingredient_ids.update(name_ingredient_ids)
+        else:
+            missing_names.append(name)
+    if len(missing_names) <= 0:
+        return ingredient_ids, []
+    
+    # The ingredients might have been added or accepted after the snapshot was loaded
+    name_filter = Q()
+    for name in missing_names:
+        name_filter = name_filter | Q(name__iexact=name) | Q(synonyms__name__iexact=name)
+    found_names = set()
+    for ingredient_id, name, synonym_name in Ingredient.objects.filter(name_filter, accepted=True).values_list('id', 'name', 'synonyms__name'):
+        ingredient_ids.add(ingredient_id)
+        found_names.update([catalog.normalize_name(name), catalog.normalize_name(synonym_name or '')])
+    return ingredient_ids, [name for name in missing_names if catalog.normalize_name(name) not in found_names]
+
+def pantry_recipes(ingredient_ids, limit=PANTRY_RESULTS):
+    """
+    Return the accepted recipes that can be made best with the given ingredients, as a list
+    of (recipe, coverage) tuples. The coverage of a recipe is the fraction of its
+    UsesIngredient objects that use one of the given ingredients. Recipes with a higher
+    coverage come first, recipes with the same coverage are ordered by their footprint.
+    
+    The coverage of every recipe is calculated in memory with the ingredient index, only
+    the recipes that can make it into the results are loaded from the database.
+    
+    """
+    index = get_index()
+    coverage = index.coverage(ingredient_ids)
+    candidates = numpy.nonzero(coverage > 0)[0]
+    if len(candidates) <= 0:
+        return []
+    # A stable sort keeps the candidates with the same coverage ordered by id
+    candidates = candidates[numpy.argsort(-coverage[candidates], kind='mergesort')]
+    sorted_coverage = -coverage[candidates]
+    
+    def recipe_ids(start, end):
+        return [int(recipe_id) for recipe_id in index.all_recipe_ids[candidates[start:end]]]
+    
+    # Load the candidates in batches until there are enough accepted recipes. Every batch
+    # also covers all recipes with the same coverage as its last recipe, because the
+    # footprint decides between them. As there can be any amount of those, they are
+    # loaded in chunks of which only the recipes with the smallest footprints are kept.
+    recipes, start = [], 0
+    while start < len(candidates) and len(recipes) < limit:
+        needed = limit - len(recipes)
+        end = min(start + needed, len(candidates))
+        ties_start = max(start, numpy.searchsorted(sorted_coverage, sorted_coverage[end - 1], side='left'))
+        ties_end = numpy.searchsorted(sorted_coverage, sorted_coverage[end - 1], side='right')
+        if ties_start > start:
+            recipes.extend(Recipe.objects.filter(pk__in=recipe_ids(start, ties_start), accepted=True))
+        ties = []
+        for chunk_start in range(ties_start, ties_end, PANTRY_BATCH_SIZE):
+            chunk_ids = recipe_ids(chunk_start, min(chunk_start + PANTRY_BATCH_SIZE, ties_end))
+            ties.extend(Recipe.objects.filter(pk__in=chunk_ids, accepted=True).order_by('footprint')[:needed])
+            ties = sorted(ties, key=lambda recipe: recipe.footprint)[:needed]
+        recipes.extend(ties)
+        start = ties_end
+    
+    recipe_coverage = dict((int(index.all_recipe_ids[i]), float(coverage[i])) for i in candidates[:start])
+    recipes = sorted(recipes, key=lambda recipe: (-recipe_coverage[recipe.pk], recipe.footprint))
+    return [(recipe, recipe_coverage[recipe.pk]) for recipe in recipes[:limit]]
@@ -0,0 +1,171 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+import re
+import unicodedata
+from django.conf import settings
+from django.db import connection
+from ingredients.models import Synonym
+from recipes.models import Recipe, UsesIngredient, RecipeSearchTerm
+
+# The weight of a term in the different parts of a recipe. The relevance of a recipe
+# for a search is the sum of the weights of the terms it matches.
+NAME_WEIGHT = 3
+INGREDIENT_WEIGHT = 2
+SYNONYM_WEIGHT = 1
+DESCRIPTION_WEIGHT = 1
+
+# The suffixes of the terms in the name and the ingredients of a recipe are indexed as
+# well, with a fraction of the weight of the term, so a search for a part of a compound
+# word matches it (e.g. 'soep' matches 'tomatensoep'). Shorter suffixes are left out.
+COMPOUND_PART_WEIGHT = 0.5
+COMPOUND_PART_MIN_LENGTH = 4
+
+# Words that are too common to search for
+STOPWORDS = frozenset(['de', 'het', 'een', 'en', 'of', 'met', 'van', 'in', 'op', 'aan', 'voor', 'bij', 'uit', 'te',
+                       'tot', 'om', 'als', 'die', 'dat', 'is', 'zijn', 'wordt', 'je', 'ze', 'er', 'nog', 'ook', 'zonder'])
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+VOWELS = 'aeiouy'
+
+def tokenize(text):
+    """
+    Split the given text into lowercase words without accents
+    
+    """
+    text = unicodedata.normalize('NFKD', unicode(text)).encode('ascii', 'ignore').lower()
+    return TOKEN_RE.findall(text)
+
+def stem(word):
+    """
+    Remove the most common Dutch inflections (plurals, diminutives and the inflected
+    adjective ending) from the given word, a light version of the Snowball Dutch stemmer
+    
+    """
+    if word.endswith('heden'):
+        return word[:-5] + 'heid'
+    for suffix in ('tjes', 'tje', 'jes', 'je'):
+        stripped = word[:-len(suffix)]
+        # The t belongs to the word if it follows a vowel (e.g. 'tomaatje')
+        if word.endswith(suffix) and len(stripped) >= 3 and not (suffix.startswith('t') and stripped[-1] in VOWELS):
+            return stripped
+    for suffix in ('en', 'e', 's'):
+        stripped = word[:-len(suffix)]
+        if word.endswith(suffix) and len(stripped) >= 3 and stripped[-1] not in VOWELS and stripped[-1] != 'j':
+            # Undouble the final consonant (e.g. 'bessen' -> 'bes')
+            if len(stripped) >= 4 and stripped[-1] == stripped[-2] and stripped[-1] not in VOWELS:
+                stripped = stripped[:-1]
+            return stripped
+    return word
+
+def terms(text):
+    """
+    Return the search terms in the given text: its words without stopwords, stemmed
+    unless the RECIPE_SEARCH_STEMMING setting is False
+    
+    """
+    stemming = getattr(settings, 'RECIPE_SEARCH_STEMMING', True)
+    max_length = RecipeSearchTerm._meta.get_field('term').max_length
+    return [(stem(word) if stemming else word)[:max_length] for word in tokenize(text)
+            if word not in STOPWORDS and len(word) > 1]
+
+def compound_parts(term):
+    """
+    Return the suffixes of the given term that could be the last part of a compound word,
+    the term itself excluded
+    
+    """
+    return [term[i:] for i in range(1, len(term) - COMPOUND_PART_MIN_LENGTH + 1)]
+
+def recipe_terms(name, description, ingredient_names, synonym_names):
+    """
+    Return a dict mapping every term of a recipe to its weight. A term counts once
+    for every text it occurs in. For the name and the ingredients, the compound parts
+    of the terms are included as well.
+    
+    """
+    weights = {}
+    for texts, weight, compounds in (([name], NAME_WEIGHT, True), (ingredient_names, INGREDIENT_WEIGHT, True),
+                                     (synonym_names, SYNONYM_WEIGHT, False), ([description], DESCRIPTION_WEIGHT, False)):
+        for text in texts:
+            text_terms = set(terms(text))
+            for term in text_terms:
+                weights[term] = weights.get(term, 0) + weight
+            if compounds:
+                parts = set(part for term in text_terms for part in compound_parts(term)) - text_terms
+                for part in parts:
+                    weights[part] = weights.get(part, 0) + weight*COMPOUND_PART_WEIGHT
+    return weights
+
+def index_recipes(recipe_ids):
+    """
+    Replace the search terms of the recipes with the given ids by their current terms
+    
+    """
+    recipe_ids = list(recipe_ids)
+    for start in range(0, len(recipe_ids), 500):
+        chunk_ids = recipe_ids[start:start + 500]
+        recipes = dict((recipe_id, (name, description, [], [])) for recipe_id, name, description
+                       in Recipe.objects.filter(pk__in=chunk_ids).values_list('id', 'name', 'description'))
+        
+        ingredient_recipes = {}
+        for recipe_id, ingredient_id, ingredient_name, plural_name in (UsesIngredient.objects.filter(recipe__in=chunk_ids)
+                                                                       .values_list('recipe', 'ingredient', 'ingredient__name',
+                                                                                    'ingredient__plural_name')):
+            recipes[recipe_id][2].append(u'%s %s' % (ingredient_name, plural_name))
+            ingredient_recipes.setdefault(ingredient_id, set()).add(recipe_id)
+        for ingredient_id, synonym_name, plural_name in (Synonym.objects.filter(ingredient__in=list(ingredient_recipes.keys()))
+                                                         .values_list('ingredient', 'name', 'plural_name')):
+            for recipe_id in ingredient_recipes[ingredient_id]:
+                recipes[recipe_id][3].append(u'%s %s' % (synonym_name, plural_name))
+        
+        RecipeSearchTerm.objects.filter(recipe__in=chunk_ids).delete()
+        RecipeSearchTerm.objects.bulk_create([RecipeSearchTerm(recipe_id=recipe_id, term=term, weight=weight)
+                                              for recipe_id, texts in recipes.items()
+                                              for term, weight in recipe_terms(*texts).items()], batch_size=500)
+
+def search(recipes, search_string):
+    """
+    Filter the given queryset of recipes on the given search string, using the search index.
+    Every term of the search string must match a term of the recipe, or be the beginning of
+    one. This includes the compound parts of the terms in its name and ingredients. The
+    recipes are annotated with their ``relevance`` for the search, the sum of the weights
+    of the matched terms, and ordered by it. Recipes that are equally relevant are ordered
+    by their footprint.
+    
+    A search string without terms (e.g. an empty one) does not filter the recipes. Every
+    term is looked up in the index with a prefix match, so the amount of rows that are read
+    only depends on the amount of matching recipes.
+    
+    """
+    search_terms = sorted(set(terms(search_string)))
+    if len(search_terms) <= 0:
+        return recipes
+    
+    for term in search_terms:
+        # Every filter joins the index again, so every term has to match
+        recipes = recipes.filter(search_terms__term__istartswith=term)
+    
+    qn = connection.ops.quote_name
+    term_table = qn(RecipeSearchTerm._meta.db_table)
+    relevance = ('SELECT SUM(%(table)s.%(weight)s) FROM %(table)s WHERE %(table)s.%(recipe)s = %(recipe_table)s.%(id)s AND (%(terms)s)'
+                 % {'table': term_table, 'weight': qn('weight'), 'recipe': qn('recipe'),
+                    'recipe_table': qn(Recipe._meta.db_table), 'id': qn('id'),
+                    'terms': ' OR '.join(['%s.%s LIKE %%s' % (term_table, qn('term'))] * len(search_terms))})
+    return recipes.extra(select={'relevance': relevance}, select_params=['%s%%' % term for term in search_terms]).order_by('-relevance', 'footprint').distinct()
@@ -0,0 +1,85 @@
+"""
+Copyright 2012, 2013 Driesen Joep
+
+This file is part of Seasoning.
+
+Seasoning is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Seasoning is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+from django.core.cache import cache
+from django.db.models import Min, Max, Avg, Count, Sum
+from django.db.models.signals import post_save, post_delete
+from general.models import DataVersion
+from recipes.models import Recipe
+
+# The cache key of the site statistics, followed by their version. Every change to a
+# recipe increments the version, so every process knows its statistics are outdated.
+SITE_STATISTICS_KEY = 'recipes_site_statistics'
+SITE_STATISTICS_VERSION = 'recipes_site_statistics'
+SITE_STATISTICS_TIMEOUT = 24*60*60
+
+class SiteStatistics(object):
+    """
+    The smallest, largest and mean footprint per portion of all recipes, the mean rating
+    of the rated recipes, the amount of recipes and the total amount of votes
+    
+    """
+    
+    def __init__(self, min_footprint, max_footprint, mean_footprint, mean_rating, recipe_count, vote_count):
+        self.min_footprint = min_footprint
+        self.max_footprint = max_footprint
+        self.mean_footprint = mean_footprint
+        self.mean_rating = mean_rating
+        self.recipe_count = recipe_count
+        self.vote_count = vote_count
+
+def calculate_site_statistics():
+    """
+    Calculate the site statistics with a single aggregate query
+    
+    """
+    aggregates = Recipe.objects.aggregate(Min('footprint'), Max('footprint'), Avg('footprint'), Avg('rating'),
+                                          Count('id'), Sum('number_of_votes'))
+    return SiteStatistics(min_footprint=aggregates['footprint__min'],
+                          max_footprint=aggregates['footprint__max'],
+                          mean_footprint=aggregates['footprint__avg'],
+                          mean_rating=aggregates['rating__avg'],
+                          recipe_count=aggregates['id__count'],
+                          vote_count=aggregates['number_of_votes__sum'] or 0)
+
+def invalidate_site_statistics(**kwargs):
+    """
+    Mark the site statistics of every process as outdated, they will be recalculated the
+    next time they are needed. This is connected to the post_save and post_delete signals
+    of recipes, and used after recipes have been updated in bulk, which doesn't send signals.
+    
+    """
+    DataVersion.objects.increment(SITE_STATISTICS_VERSION)
+
+def get_site_statistics():
+    """
+    Return the site statistics of the current version from the cache, they are only
+    calculated if they are not in the cache. Changes made by other processes are noticed
+    within ``general.models.VERSION_CHECK_INTERVAL`` seconds.
+    
+    """
+    key = '%s_%d' % (SITE_STATISTICS_KEY, DataVersion.objects.current_version(SITE_STATISTICS_VERSION))
+    statistics = cache.get(key)
+    if statistics is None:
+        statistics = calculate_site_statistics()
+        cache.set(key, statistics, SITE_STATISTICS_TIMEOUT)
+    return statistics
+
+post_save.connect(invalidate_site_statistics, sender=Recipe, dispatch_uid='invalidate_site_statistics_save')
+post_delete.connect(invalidate_site_statistics, sender=Recipe, dispatch_uid='invalidate_site_statistics_delete')
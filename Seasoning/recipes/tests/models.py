@@ -1,12 +1,39 @@
 from django.test import TestCase
-from recipes.models import Recipe, Vote, UsesIngredient, Cuisine
+from recipes.models import Recipe, Vote, UsesIngredient, Cuisine, QueuedRecipe,\
+    RecipeMonthlyFootprint, RecipeFootprintBucket, RecipeSearchTerm
 from authentication.models import User
 from django.db.utils import IntegrityError
-from ingredients.models import Ingredient, Unit, CanUseUnit
-from django.core.exceptions import ValidationError
+from ingredients.models import Ingredient, Unit, CanUseUnit, Country, TransportMethod,\
+    AvailableInCountry, AvailableIn, Synonym
+from ingredients.engine import FootprintEngine
+from recipes.engine import RecipeFootprintMatrix, recalculate_recipe_footprints,\
+    recalculate_transitioning_recipe_footprints, recompute_queued_recipes,\
+    update_monthly_footprints, update_percentile_ranks
+import datetime
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from recipes.management.commands.update_recipe_footprints import Command
+from StringIO import StringIO
 from django_dynamic_fixture import G, N
 import time
+import numpy
+import os
+import json
+import tempfile
 from django.conf import settings
+from django.core.paginator import Paginator
+from django.template import Template, Context
+from recipes.statistics import get_site_statistics, invalidate_site_statistics
+from recipes import statistics, ingredient_index
+from recipes.search import stem, terms, compound_parts
+from recipes.pantry import resolve_ingredient_names, pantry_recipes
+from recipes import pantry
+from recipes.forms import EditRecipeIngredientsForm
+from ingredients import catalog
+from general.models import DataVersion
+import general.models
+from django.db.models import F
 from django.utils.unittest.case import skipIf, skip
 from general.decorators import mysqldb_required
 
@@ -55,6 +82,40 @@ class UsesIngredientModelTestCase(TestCase):
         ui = N(UsesIngredient, ingredient=cuu.ingredient, unit=cuu.unit)
         self.assertEqual(ui.clean(), ui)
     
+    def test_ingredients_formset(self):
+        recipe = G(Recipe)
+        unit = G(Unit, parent_unit=None)
+        ingredients = [G(Ingredient, name='Ingredient %d' % i, plural_name='', accepted=True) for i in range(5)]
+        for ingredient in ingredients:
+            G(CanUseUnit, ingredient=ingredient, unit=unit, conversion_factor=1)
+        G(Synonym, name='Synoniem', ingredient=ingredients[0])
+        G(UsesIngredient, recipe=recipe, ingredient=ingredients[0], unit=unit, amount=1)
+        FormSet = EditRecipeIngredientsForm.form_classes['ingredients']
+        
+        data = {'ingredients-TOTAL_FORMS': '6', 'ingredients-INITIAL_FORMS': '0', 'ingredients-MAX_NUM_FORMS': '1000'}
+        for i, name in enumerate(['synoniem'] + [ingredient.name for ingredient in ingredients[1:]]):
+            data.update({'ingredients-%d-ingredient' % i: name, 'ingredients-%d-amount' % i: '2',
+                         'ingredients-%d-unit' % i: str(unit.pk), 'ingredients-%d-group' % i: ''})
+        catalog.get_catalog()
+        # The recipes uses, the ingredients and the units are loaded once for all forms
+        self.assertNumQueries(3, lambda: FormSet(data, instance=recipe, prefix='ingredients').is_valid())
+        formset = FormSet(data, instance=recipe, prefix='ingredients')
+        self.assertTrue(formset.is_valid())
+        self.assertEqual([form.cleaned_data['ingredient'] for form in formset.forms[:5]], ingredients)
+        
+        # Units the ingredient can not use are rejected
+        data['ingredients-1-unit'] = str(G(Unit).pk)
+        self.assertFalse(FormSet(data, instance=recipe, prefix='ingredients').is_valid())
+        
+        # Unknown ingredients are reported with suggestions
+        data['ingredients-1-unit'] = str(unit.pk)
+        data['ingredients-5-ingredient'] = 'Ingredient 55'
+        data.update({'ingredients-5-amount': '2', 'ingredients-5-unit': str(unit.pk), 'ingredients-5-group': ''})
+        formset = FormSet(data, instance=recipe, prefix='ingredients')
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.unknown_ingredients[0]['name'], 'Ingredient 55')
+        self.assertEqual(len(formset.unknown_ingredients[0]['suggestions']), 5)
+    
     @mysqldb_required
     def test_save(self):
         ing = G(Ingredient, type=Ingredient.BASIC, base_footprint=50, accepted=True)
@@ -102,6 +163,211 @@ class RecipeModelTestCase(TestCase):
         recipe.save()
         self.assertEqual(recipe.total_footprint(), 50)
     
+    def test_save_with_ingredients(self):
+        unit = G(Unit, parent_unit=None)
+        vegan = G(Ingredient, type=Ingredient.BASIC, base_footprint=2, veganism=Ingredient.VEGAN, accepted=True)
+        meat = G(Ingredient, type=Ingredient.BASIC, base_footprint=3, veganism=Ingredient.NON_VEGETARIAN, accepted=True)
+        for ingredient in (vegan, meat):
+            G(CanUseUnit, ingredient=ingredient, unit=unit, conversion_factor=1)
+        recipe = G(Recipe, portions=2)
+        uses1 = G(UsesIngredient, recipe=recipe, ingredient=vegan, unit=unit, amount=1, group='')
+        uses2 = G(UsesIngredient, recipe=recipe, ingredient=meat, unit=unit, amount=2)
+        
+        uses1.amount = 3
+        uses3 = UsesIngredient(ingredient=meat, unit=unit, amount=1, group='Saus')
+        version = DataVersion.objects.current_version(ingredient_index.INDEX_VERSION)
+        recipe.save_with_ingredients([uses1, uses3], [uses2])
+        # The version of the ingredient index is incremented once for the whole recipe
+        self.assertEqual(DataVersion.objects.current_version(ingredient_index.INDEX_VERSION), version + 1)
+        self.assertEqual(sorted(UsesIngredient.objects.filter(recipe=recipe).values_list('ingredient', 'amount', 'group', 'footprint')),
+                         sorted([(vegan.pk, 3, '', 6), (meat.pk, 1, 'Saus', 3)]))
+        recipe = Recipe.objects.get(pk=recipe.pk)
+        self.assertEqual((recipe.footprint, recipe.veganism, recipe.accepted), (4.5, Ingredient.NON_VEGETARIAN, True))
+        
+        # The amount of queries does not depend on the amount of ingredients
+        def save_new_recipe(amount):
+            recipe = N(Recipe, portions=1)
+            recipe.save_with_ingredients([UsesIngredient(ingredient=vegan, unit=unit, amount=1) for _ in range(amount)])
+            self.assertEqual(Recipe.objects.get(pk=recipe.pk).footprint, 2*amount)
+        # Without an ingredient index in this process, only its version is incremented
+        ingredient_index._index = None
+        self.assertNumQueries(16, save_new_recipe, 2)
+        self.assertNumQueries(16, save_new_recipe, 10)
+        
+        # Ingredients added by another process after the snapshot was loaded are read from
+        # the database
+        snapshot = catalog.get_catalog()
+        new = G(Ingredient, type=Ingredient.BASIC, base_footprint=5, veganism=Ingredient.VEGAN, accepted=True)
+        G(CanUseUnit, ingredient=new, unit=unit, conversion_factor=2)
+        snapshot.version = DataVersion.objects.current_version(catalog.CATALOG_VERSION)
+        catalog._snapshot = snapshot
+        recipe = N(Recipe, portions=1)
+        recipe.save_with_ingredients([UsesIngredient(ingredient=new, unit=unit, amount=3)])
+        self.assertEqual(Recipe.objects.get(pk=recipe.pk).footprint, 30)
+        self.assertEqual(list(recipe.uses.values_list('footprint', flat=True)), [30])
+    
+    def test_site_statistics(self):
+        invalidate_site_statistics()
+        G(Recipe, portions=1)
+        recipe = G(Recipe, portions=1)
+        Recipe.objects.filter(pk=recipe.pk).update(footprint=4)
+        invalidate_site_statistics()
+        self.assertEqual(get_site_statistics().max_footprint, 4)
+        self.assertEqual(get_site_statistics().recipe_count, 2)
+        
+        # The statistics are read from the cache, also by the template tags
+        with self.assertNumQueries(0):
+            html = Template('{% load ratings %}{% mean_footprint 1 %}').render(Context({'site_statistics': get_site_statistics()}))
+        self.assertTrue('width: 25%' in html)
+        
+        # Saving a recipe only increments their version, they are recalculated once when needed
+        with self.assertNumQueries(1):
+            invalidate_site_statistics(sender=Recipe, instance=recipe)
+        recipe.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(get_site_statistics().max_footprint, 0)
+        with self.assertNumQueries(0):
+            get_site_statistics()
+        
+        # Another process changing a recipe increments the version in the database, which is
+        # only read once every VERSION_CHECK_INTERVAL seconds
+        Recipe.objects.filter(pk=recipe.pk).update(footprint=6)
+        DataVersion.objects.filter(name=statistics.SITE_STATISTICS_VERSION).update(version=F('version') + 1)
+        self.assertEqual(get_site_statistics().max_footprint, 0)
+        old_interval, general.models.VERSION_CHECK_INTERVAL = general.models.VERSION_CHECK_INTERVAL, 0
+        try:
+            self.assertEqual(get_site_statistics().max_footprint, 6)
+        finally:
+            general.models.VERSION_CHECK_INTERVAL = old_interval
+    
+    def test_search(self):
+        self.assertEqual(terms(u'De Aardappelen met rode b\xe9ssen'), ['aardappel', 'rod', 'bes'])
+        self.assertEqual([stem(word) for word in ['tomaatjes', 'wortels', 'kaas', 'mogelijkheden']],
+                         ['tomaat', 'wortel', 'kaas', 'mogelijkheid'])
+        
+        ing = G(Ingredient, name='Aardappel', plural_name='Aardappelen')
+        G(Synonym, name='Patat', ingredient=ing)
+        soup = G(Recipe, name='Aardappelsoep', description='Een romige soep')
+        stew = G(Recipe, name='Stoofpot', description='Met aardappelen')
+        salad = G(Recipe, name='Salade', description='Fris')
+        uses = G(UsesIngredient, recipe=salad, ingredient=ing)
+        
+        # The name weighs more than the ingredients, which weigh more than the description
+        self.assertEqual(list(Recipe.objects.search('aardappelen')), [soup, salad, stew])
+        self.assertEqual(list(Recipe.objects.search('patatten')), [salad])
+        self.assertEqual(list(Recipe.objects.search('romige soep')), [soup])
+        self.assertEqual(list(Recipe.objects.search('soep salade')), [])
+        self.assertEqual(Recipe.objects.search('').count(), 3)
+        
+        # The index is updated when recipes change
+        uses.delete()
+        self.assertEqual(list(Recipe.objects.search('patat')), [])
+        stew.name = 'Frisse stoofpot'
+        stew.save()
+        self.assertEqual(set(Recipe.objects.search('fris')), set([salad, stew]))
+        self.assertEqual(list(Recipe.objects.query(search_string='fris', sort_field='name')), [stew, salad])
+        # Saves that don't change the name, the description or the ingredients, like those of
+        # a vote, leave the index alone
+        term_ids = set(RecipeSearchTerm.objects.filter(recipe=stew).values_list('id', flat=True))
+        stew.vote(G(User), 4)
+        self.assertEqual(set(RecipeSearchTerm.objects.filter(recipe=stew).values_list('id', flat=True)), term_ids)
+        
+        # The parts of compound words are found as well, but weigh less than whole words
+        self.assertEqual(compound_parts('tomatensoep'), ['omatensoep', 'matensoep', 'atensoep', 'tensoep', 'ensoep', 'nsoep', 'soep'])
+        tomato_soup = G(Recipe, name='Tomatensoep', description='')
+        self.assertEqual(list(Recipe.objects.search('soepen')), [soup, tomato_soup])
+        self.assertEqual(list(Recipe.objects.search('tomaten soep')), [tomato_soup])
+        self.assertEqual(list(Recipe.objects.search('oep')), [])
+    
+    def test_query_ingredients(self):
+        potato = G(Ingredient, name='Aardappel')
+        G(Synonym, name='Patat', ingredient=potato)
+        carrot = G(Ingredient, name='Wortel')
+        leek = G(Ingredient, name='Prei')
+        recipe1, recipe2, recipe3 = G(Recipe), G(Recipe), G(Recipe)
+        G(UsesIngredient, recipe=recipe1, ingredient=potato)
+        G(UsesIngredient, recipe=recipe1, ingredient=carrot)
+        G(UsesIngredient, recipe=recipe2, ingredient=potato)
+        
+        def query(include=[], operator='and', exclude=[]):
+            return set(Recipe.objects.query(advanced_search=True, include_ingredients_operator=operator,
+                                            include_ingredient_names=include, exclude_ingredient_names=exclude))
+        self.assertEqual(query(['patat', 'wortel']), set([recipe1]))
+        self.assertEqual(query(['wortel', 'prei']), set())
+        self.assertEqual(query(['aardap'], exclude=['wortel']), set([recipe2]))
+        self.assertEqual(query(exclude=['wortel']), set([recipe2, recipe3]))
+        
+        # The index follows the changes of the recipes. The index of this process is updated in
+        # place, by incrementing the version, reading it and loading the entries of the recipe
+        index = ingredient_index.get_index()
+        self.assertNumQueries(3, ingredient_index.update_index, [recipe2.pk])
+        G(UsesIngredient, recipe=recipe3, ingredient=leek)
+        self.assertTrue(ingredient_index.get_index() is index)
+        self.assertEqual(query(['wortel', 'prei'], 'or'), set([recipe1, recipe3]))
+        self.assertEqual(list(index.recipes_using([potato.pk])), [recipe1.pk, recipe2.pk])
+        
+        # If another process changed the ingredients of a recipe as well, the index is rebuilt
+        DataVersion.objects.filter(name=ingredient_index.INDEX_VERSION).update(version=F('version') + 1)
+        recipe1.uses.get(ingredient=carrot).delete()
+        self.assertFalse(ingredient_index.get_index() is index)
+        self.assertEqual(query(['wortel']), set())
+        G(UsesIngredient, recipe=recipe1, ingredient=carrot)
+        
+        # Deleted recipes are removed from the index
+        Recipe.objects.get(pk=recipe2.pk).delete()
+        self.assertEqual(list(ingredient_index.get_index().recipes_using([potato.pk])), [recipe1.pk])
+        
+        # Only the recipes of the requested page are fetched, in the order of the query
+        Recipe.objects.filter(pk=recipe1.pk).update(footprint=2, active_time=10, passive_time=0)
+        Recipe.objects.filter(pk=recipe3.pk).update(footprint=1, active_time=0, passive_time=20)
+        def page(sort_field, number):
+            recipes = Recipe.objects.query(advanced_search=True, sort_field=sort_field, include_ingredients_operator='or',
+                                           include_ingredient_names=['wortel', 'prei'])
+            paginator = Paginator(recipes, 1)
+            self.assertEqual(paginator.count, 2)
+            return list(paginator.page(number))
+        self.assertEqual(page('footprint', 1), [recipe3])
+        self.assertEqual(page('footprint', 2), [recipe1])
+        self.assertEqual(page('tot_time', 1), [recipe1])
+        # The ingredients of both names, the ids of the recipes and the recipes of the page
+        self.assertNumQueries(4, page, 'tot_time', 2)
+    
+    def test_pantry(self):
+        potato = G(Ingredient, name='Aardappel', accepted=False)
+        G(Synonym, name='Patat', ingredient=potato)
+        carrot = G(Ingredient, name='Wortel', accepted=False)
+        leek = G(Ingredient, name='Prei', accepted=False)
+        recipe1, recipe2, recipe3, recipe4, recipe5 = [G(Recipe, accepted=True) for _ in range(5)]
+        for recipe, ingredient in ((recipe1, potato), (recipe1, carrot), (recipe2, potato), (recipe3, potato),
+                                   (recipe3, leek), (recipe4, leek), (recipe5, potato)):
+            G(UsesIngredient, recipe=recipe, ingredient=ingredient)
+        for recipe, footprint in ((recipe1, 3), (recipe2, 2), (recipe3, 1), (recipe4, 1)):
+            Recipe.objects.filter(pk=recipe.pk).update(footprint=footprint)
+        Recipe.objects.filter(pk=recipe5.pk).update(accepted=False)
+        # Only accepted ingredients are resolved
+        Ingredient.objects.filter(pk__in=[potato.pk, carrot.pk]).update(accepted=True)
+        catalog.invalidate_catalog()
+        
+        self.assertEqual(resolve_ingredient_names(['patat', u'W\xd3RTEL', 'banaan', 'prei']), (set([potato.pk, carrot.pk]), ['banaan', 'prei']))
+        self.assertNumQueries(0, resolve_ingredient_names, ['patat', 'wortel'])
+        
+        # Recipes with the same coverage are ordered by their footprint
+        results = [(recipe.pk, coverage) for recipe, coverage in pantry_recipes([potato.pk])]
+        self.assertEqual(results, [(recipe2.pk, 1), (recipe3.pk, 0.5), (recipe1.pk, 0.5)])
+        results = [(recipe.pk, coverage) for recipe, coverage in pantry_recipes([potato.pk], limit=2)]
+        self.assertEqual(results, [(recipe2.pk, 1), (recipe3.pk, 0.5)])
+        results = [(recipe.pk, coverage) for recipe, coverage in pantry_recipes([potato.pk, carrot.pk])]
+        self.assertEqual(results, [(recipe2.pk, 1), (recipe1.pk, 1), (recipe3.pk, 0.5)])
+        self.assertEqual(pantry_recipes([]), [])
+        
+        # Recipes with the same coverage are loaded in chunks
+        batch_size, pantry.PANTRY_BATCH_SIZE = pantry.PANTRY_BATCH_SIZE, 1
+        try:
+            results = [(recipe.pk, coverage) for recipe, coverage in pantry_recipes([potato.pk], limit=2)]
+            self.assertEqual(results, [(recipe2.pk, 1), (recipe3.pk, 0.5)])
+        finally:
+            pantry.PANTRY_BATCH_SIZE = batch_size
+    
     @mysqldb_required
     def test_vote(self):
         recipe = G(Recipe)
@@ -137,6 +403,241 @@ class RecipeModelTestCase(TestCase):
         recipe.calculate_and_set_rating()
         self.assertEqual(recipe.rating, 3)
 
+class RecipeFootprintMatrixTestCase(TestCase):
+    
+    def setUp(self):
+        G(Cuisine, name='Andere')
+        unit = G(Unit)
+        self.bing = G(Ingredient, type=Ingredient.BASIC, base_footprint=2, accepted=True)
+        G(CanUseUnit, ingredient=self.bing, unit=unit, conversion_factor=0.5)
+        self.sing = G(Ingredient, type=Ingredient.SEASONAL, base_footprint=1, accepted=True)
+        G(CanUseUnit, ingredient=self.sing, unit=unit, conversion_factor=1)
+        G(AvailableInCountry, ingredient=self.sing, location=G(Country, distance=10),
+          transport_method=G(TransportMethod, emission_per_km=1), extra_production_footprint=0,
+          date_from=datetime.date(2013, 1, 1), date_until=datetime.date(2013, 6, 30))
+        G(AvailableInCountry, ingredient=self.sing, location=G(Country, distance=100),
+          transport_method=G(TransportMethod, emission_per_km=1), extra_production_footprint=0,
+          date_from=datetime.date(2013, 1, 1), date_until=datetime.date(2013, 12, 31))
+        
+        self.recipe1 = G(Recipe, portions=2)
+        self.uses1 = G(UsesIngredient, recipe=self.recipe1, ingredient=self.bing, unit=unit, amount=4)
+        self.uses2 = G(UsesIngredient, recipe=self.recipe1, ingredient=self.sing, unit=unit, amount=3)
+        self.empty_recipe = G(Recipe, portions=1)
+        self.recipe2 = G(Recipe, portions=1)
+        G(UsesIngredient, recipe=self.recipe2, ingredient=self.sing, unit=unit, amount=1)
+    
+    def test_dot(self):
+        engine = FootprintEngine()
+        matrix = RecipeFootprintMatrix(engine.index)
+        self.assertEqual(len(matrix), 3)
+        
+        footprints = numpy.zeros(len(engine))
+        footprints[engine.index[self.bing.pk]] = 2
+        footprints[engine.index[self.sing.pk]] = 11
+        self.assertEqual(list(matrix.dot(footprints)), [(4*0.5*2 + 3*11)/2.0, 0, 11])
+        self.assertEqual(list(matrix.uses_footprints(footprints)), [4*0.5*2, 3*11, 11])
+        
+        # Multiplying by the calendar gives the footprints on every day
+        calendar_footprints = matrix.dot(engine.footprint_calendar().T)
+        self.assertEqual(calendar_footprints.shape, (3, AvailableIn.DAYS_IN_BASE_YEAR))
+        self.assertEqual(calendar_footprints[2, 0], 11)
+        self.assertEqual(calendar_footprints[2, -1], 101)
+    
+    def test_recalculate_recipe_footprints(self):
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 8, 1)), 3)
+        self.assertEqual(UsesIngredient.objects.get(pk=self.uses2.pk).footprint, 3*101)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, (4*0.5*2 + 3*101)/2.0)
+        self.assertEqual(Recipe.objects.get(pk=self.empty_recipe.pk).footprint, 0)
+        
+        # Only the given recipes are updated
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 2, 1), recipe_ids=[self.recipe2.pk]), 1)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, (4*0.5*2 + 3*101)/2.0)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, 11)
+        
+        # The results are the same as when saving the recipe
+        recipe = Recipe.objects.get(pk=self.recipe2.pk)
+        recipe.save()
+        self.assertEqual(recipe.footprint, 11)
+        
+        # A recipe using a unit without a conversion factor can not be saved, so its footprint
+        # is left untouched instead of leaving out the ingredient
+        uses = UsesIngredient.objects.get(pk=self.uses1.pk)
+        uses.unit = G(Unit)
+        self.assertRaises(ObjectDoesNotExist, uses.save)
+        UsesIngredient.objects.filter(pk=self.uses1.pk).update(unit=uses.unit)
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 2, 1)), 2)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, (4*0.5*2 + 3*101)/2.0)
+        self.assertEqual(UsesIngredient.objects.get(pk=self.uses2.pk).footprint, 3*101)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, 11)
+        
+        # Unaccepted ingredients don't add to the footprint, whatever their unit
+        Ingredient.objects.filter(pk=self.bing.pk).update(accepted=False)
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 2, 1)), 3)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, 3*11/2.0)
+        
+        # Neither can a recipe using an accepted ingredient that is not available
+        AvailableInCountry.objects.filter(ingredient=self.sing).update(date_until=datetime.date(2013, 6, 30))
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 8, 1)), 1)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, 11)
+    
+    def test_recalculate_transitioning_recipe_footprints(self):
+        Recipe.objects.all().update(footprint=-1)
+        # Nothing changes on the 2nd of May
+        self.assertEqual(recalculate_transitioning_recipe_footprints(date=datetime.date(2013, 5, 2)), 0)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, -1)
+        
+        # On the 1st of July, the cheapest available in is no longer active
+        self.assertEqual(recalculate_transitioning_recipe_footprints(date=datetime.date(2013, 7, 1)), 2)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, (4*0.5*2 + 3*101)/2.0)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, 101)
+        self.assertEqual(Recipe.objects.get(pk=self.empty_recipe.pk).footprint, -1)
+    
+    def test_in_season_on(self):
+        self.assertEqual(set(Recipe.objects.in_season_on(datetime.date(2013, 8, 1))), set([self.recipe1, self.empty_recipe, self.recipe2]))
+        AvailableInCountry.objects.get(date_until=datetime.date(2000, 12, 31)).delete()
+        self.assertEqual(list(Recipe.objects.in_season_on(datetime.date(2013, 8, 1))), [self.empty_recipe])
+        self.assertEqual(set(Recipe.objects.in_season_on(datetime.date(2013, 2, 1))), set([self.recipe1, self.empty_recipe, self.recipe2]))
+    
+    def test_update_monthly_footprints(self):
+        self.assertEqual(update_monthly_footprints(daily=True), 3)
+        evolution = RecipeMonthlyFootprint.objects.get(recipe=self.recipe2)
+        self.assertEqual(evolution.monthly_footprints(), [11]*6 + [101]*6)
+        self.assertEqual(len(evolution.daily_footprints()), AvailableIn.DAYS_IN_BASE_YEAR)
+        self.assertEqual(RecipeMonthlyFootprint.objects.get(recipe=self.empty_recipe).monthly_footprints(), [0]*12)
+        
+        # The evolution is read from the stored footprints
+        resp = self.client.get('/recipes/data/fpevo/', {'recipe': self.recipe2.pk}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(resp.content)['footprints'], [44] + [44]*6 + [404]*6 + [404])
+        self.assertTrue('Last-Modified' in resp)
+        
+        # A vote leaves the evolution alone (the footprint of the fixture is brought up to date first)
+        recipe2 = Recipe.objects.get(pk=self.recipe2.pk)
+        recipe2.save()
+        update_monthly_footprints(recipe_ids=[self.recipe2.pk])
+        recipe2.vote(G(User), 4)
+        self.assertTrue(RecipeMonthlyFootprint.objects.filter(recipe=self.recipe2).exists())
+        
+        # Changing the portions of a recipe removes its evolution, it is rebuilt when it is requested
+        recipe2 = Recipe.objects.get(pk=self.recipe2.pk)
+        recipe2.portions = 2
+        recipe2.save()
+        self.assertFalse(RecipeMonthlyFootprint.objects.filter(recipe=self.recipe2).exists())
+        resp = self.client.post('/recipes/data/fpevo/', {'recipe': self.recipe2.pk}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(json.loads(resp.content)['footprints'][1], 22)  # Half the footprint per portion
+        self.assertEqual(RecipeMonthlyFootprint.objects.get(recipe=self.recipe2).daily_footprints(), [])
+    
+    def test_footprint_histogram(self):
+        recalculate_recipe_footprints(date=datetime.date(2013, 8, 1))
+        recipe1 = Recipe.objects.get(pk=self.recipe1.pk)
+        histogram = RecipeFootprintBucket.objects.histogram(recipe1.course, recipe1.veganism)
+        # Normalized footprints 0, 404 and 614
+        self.assertEqual(histogram['all_fps'], [1, 0, 0, 0, 0, 0, 1, 0, 0, 1])
+        self.assertAlmostEqual(histogram['min_fp'], 0)
+        self.assertAlmostEqual(histogram['max_fp'], 614.1)
+        self.assertAlmostEqual(histogram['interval_length'], 61.41)
+        self.assertEqual(sum(histogram['cat_fps']), Recipe.objects.filter(course=recipe1.course).count())
+        
+        # The buckets follow the changes of the recipes
+        recalculate_recipe_footprints(date=datetime.date(2013, 2, 1))
+        recipe1.course = Recipe.SOUP if recipe1.course != Recipe.SOUP else Recipe.SALAD
+        recipe1.save()
+        Recipe.objects.get(pk=self.empty_recipe.pk).delete()
+        counts = dict(((bucket, course), count) for bucket, course, count
+                      in RecipeFootprintBucket.objects.values_list('bucket', 'course', 'count'))
+        RecipeFootprintBucket.objects.rebuild()
+        self.assertEqual(counts, dict(((bucket, course), count) for bucket, course, count
+                                      in RecipeFootprintBucket.objects.values_list('bucket', 'course', 'count')))
+        self.assertEqual(sum(counts.values()), 2)
+        
+        resp = self.client.post('/recipes/data/fprel/', {'recipe': self.recipe2.pk}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(resp.content)
+        self.assertEqual(data['fp'], 44)
+        self.assertEqual(sum(data['all_fps']), 2)
+        
+        # Recipes deleted by a queryset are removed from their buckets as well
+        Recipe.objects.filter(pk=recipe1.pk).delete()
+        self.assertEqual(sum(RecipeFootprintBucket.objects.values_list('count', flat=True)), 1)
+    
+    def test_update_percentile_ranks(self):
+        recalculate_recipe_footprints(date=datetime.date(2013, 8, 1))
+        Recipe.objects.filter(pk__in=[self.recipe1.pk, self.recipe2.pk]).update(course=Recipe.SOUP)
+        Recipe.objects.filter(pk=self.empty_recipe.pk).update(course=Recipe.SALAD)
+        
+        self.assertEqual(update_percentile_ranks(), 3)
+        self.assertEqual(update_percentile_ranks(), 0)
+        self.assertAlmostEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint_percentile, 200/3.0)
+        self.assertEqual(list(Recipe.objects.greenest(50)), [self.empty_recipe])
+        self.assertEqual(list(Recipe.objects.greenest(50, course=Recipe.SOUP)), [self.recipe2])
+        self.assertEqual(list(Recipe.objects.greenest(100, course=Recipe.SALAD)), [self.empty_recipe])
+        
+        # Only the recipes whose rank changes are updated
+        Recipe.objects.filter(pk=self.empty_recipe.pk).update(footprint=1000)
+        self.assertEqual(update_percentile_ranks(), 3)
+        self.assertEqual(Recipe.objects.get(pk=self.empty_recipe.pk).course_footprint_percentile, 100)
+    
+    def test_recompute_queue(self):
+        QueuedRecipe.objects.all().delete()
+        self.assertEqual(QueuedRecipe.objects.depth(), 0)
+        self.assertEqual(QueuedRecipe.objects.lag(), None)
+        
+        # Changing an ingredient queues the recipes using it, only once
+        self.sing.veganism = Ingredient.VEGETARIAN
+        self.sing.save()
+        G(CanUseUnit, ingredient=self.sing, unit=G(Unit), conversion_factor=1)
+        self.assertEqual(set(QueuedRecipe.objects.values_list('recipe', flat=True)), set([self.recipe1.pk, self.recipe2.pk]))
+        self.assertEqual(QueuedRecipe.objects.depth(), 2)
+        self.assertTrue(QueuedRecipe.objects.lag() >= datetime.timedelta(0))
+        
+        # A recipe that is queued again while it is being recalculated stays in the queue
+        Recipe.objects.all().update(footprint=-1)
+        recompute_queued_recipes(batch_size=1)
+        self.assertEqual(QueuedRecipe.objects.depth(), 1)
+        QueuedRecipe.objects.enqueue([self.recipe1.pk, self.recipe2.pk])
+        
+        call_command('process_recompute_queue', batch_size=1, stdout=StringIO())
+        self.assertEqual(QueuedRecipe.objects.depth(), 0)
+        recipe = Recipe.objects.get(pk=self.recipe2.pk)
+        self.assertTrue(recipe.footprint in [11, 101])
+        self.assertEqual(recipe.veganism, Ingredient.VEGETARIAN)
+        self.assertTrue(recipe.accepted)
+        self.assertEqual(Recipe.objects.get(pk=self.empty_recipe.pk).footprint, -1)
+        self.assertEqual(RecipeMonthlyFootprint.objects.get(recipe=self.recipe2).monthly_footprints()[0], 11)
+    
+    def test_update_recipe_footprints_command(self):
+        checkpoint_file = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        def write_checkpoint(date, last_id):
+            with open(checkpoint_file, 'w') as f:
+                json.dump({'date': date.strftime('%Y-%m-%d'), 'last_id': last_id}, f)
+        Recipe.objects.all().update(footprint=-1)
+        
+        # A checkpoint of an earlier day is refused
+        write_checkpoint(datetime.date.today() - datetime.timedelta(days=1), self.recipe1.pk)
+        self.assertRaises(CommandError, call_command, 'update_recipe_footprints', matrix=True, chunk_size=1,
+                          checkpoint=checkpoint_file, stdout=StringIO())
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, -1)
+        
+        # Pretend the first recipe was already updated by an interrupted run of today, which
+        # can be resumed with another chunk size
+        write_checkpoint(datetime.date.today(), self.recipe1.pk)
+        call_command('update_recipe_footprints', matrix=True, chunk_size=5, checkpoint=checkpoint_file, stdout=StringIO())
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, -1)
+        self.assertEqual(Recipe.objects.get(pk=self.empty_recipe.pk).footprint, 0)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe2.pk).footprint, 101)
+        self.assertFalse(os.path.exists(checkpoint_file))
+        
+        # A range of ids is recalculated in a single chunk
+        self.assertEqual(recalculate_recipe_footprints(date=datetime.date(2013, 8, 1), id_range=(self.recipe1.pk, self.recipe2.pk)), 2)
+        self.assertEqual(Recipe.objects.get(pk=self.recipe1.pk).footprint, (4*0.5*2 + 3*101)/2.0)
+        
+        # The chunks are paged through the ids of the recipes, gaps don't lead to empty chunks
+        command = Command()
+        Recipe.objects.filter(pk=self.empty_recipe.pk).delete()
+        self.assertEqual(command.chunk_bounds(None, 1), [(1, self.recipe1.pk + 1), (self.recipe1.pk + 1, self.recipe2.pk + 1)])
+        self.assertEqual(command.chunk_bounds(self.recipe1.pk, 2), [(self.recipe1.pk + 1, self.recipe2.pk + 1)])
+        self.assertEqual(command.chunk_bounds(self.recipe2.pk, 1), [])
+        # The ids are fetched in a single query, however many chunks there are
+        self.assertNumQueries(1, command.chunk_bounds, None, 1)
+
 #class RecipeModelsTestCase(TestCase):
 #    fixtures = ['users.json', 'ingredients.json', 'recipes.json', ]
 #    
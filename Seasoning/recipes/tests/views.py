@@ -1,8 +1,12 @@
 from django.test import TestCase
 from django_dynamic_fixture import G
 from authentication.models import User
-from recipes.models import Cuisine
+from recipes.models import Cuisine, Recipe, UsesIngredient
 from ingredients.models import Ingredient, Unit, CanUseUnit
+from recipes.views import EditRecipeWizard
+from recipes.forms import EditRecipeIngredientsForm
+from django.test.client import RequestFactory
+from django.contrib.messages.storage.cookie import CookieStorage
 
 class RecipeViewsTestCase(TestCase):
     
@@ -37,6 +41,49 @@ class RecipeViewsTestCase(TestCase):
         self.assertTrue('recipe_form' in resp.context)
         self.assertTrue(resp.context['new_recipe'])
     
+    def test_edit_recipe_wizard_done(self):
+        aardappel, aardbei = Ingredient.objects.get(name='Aardappel'), Ingredient.objects.get(name='Aardbei')
+        unit = CanUseUnit.objects.get(ingredient=aardappel).unit
+        
+        def done(recipe, ingredients):
+            data = {'ingredients-ingredients_general_info-portions': '2',
+                    'ingredients-ingredients-TOTAL_FORMS': str(len(ingredients)),
+                    'ingredients-ingredients-INITIAL_FORMS': str(len([uses for uses, _, _ in ingredients if uses is not None])),
+                    'ingredients-ingredients-MAX_NUM_FORMS': '1000'}
+            for i, (uses, name, amount) in enumerate(ingredients):
+                data.update({'ingredients-ingredients-%d-ingredient' % i: name, 'ingredients-ingredients-%d-amount' % i: amount,
+                             'ingredients-ingredients-%d-unit' % i: str(unit.pk), 'ingredients-ingredients-%d-group' % i: ''})
+                if uses is not None:
+                    data['ingredients-ingredients-%d-id' % i] = str(uses.pk)
+                    data['ingredients-ingredients-%d-recipe' % i] = str(recipe.pk)
+                    if amount == '0':
+                        data['ingredients-ingredients-%d-DELETE' % i] = 'on'
+            form = EditRecipeIngredientsForm(data=data, prefix='ingredients', instance=recipe)
+            self.assertTrue(form.is_valid())
+            
+            wizard = EditRecipeWizard()
+            wizard.request = RequestFactory().post('/recipes/add/')
+            wizard.request.user = self.user
+            wizard.request._messages = CookieStorage(wizard.request)
+            wizard.instance = recipe
+            resp = wizard.done([form])
+            self.assertEqual(resp.status_code, 302)
+            return Recipe.objects.get(pk=recipe.pk)
+        
+        # A new recipe
+        recipe = done(Recipe(name='Stoemp', cuisine=self.cuisine, course=Recipe.MAIN_COURSE, description='',
+                             active_time=10, passive_time=10, instructions=''),
+                      [(None, 'Aardappel', '2'), (None, 'Aardbei', '1')])
+        self.assertEqual(recipe.author, self.user)
+        self.assertEqual(recipe.portions, 2)
+        self.assertEqual(sorted(recipe.uses.values_list('ingredient', 'amount')), sorted([(aardappel.pk, 2), (aardbei.pk, 1)]))
+        
+        # Editing the recipe
+        usess = dict((uses.ingredient_id, uses) for uses in recipe.uses.all())
+        recipe = done(recipe, [(usess[aardappel.pk], 'Aardappel', '3'), (usess[aardbei.pk], 'Aardbei', '0')])
+        self.assertEqual(list(recipe.uses.values_list('ingredient', 'amount')), [(aardappel.pk, 3)])
+        self.assertEqual(list(UsesIngredient.objects.filter(pk=usess[aardappel.pk].pk).values_list('recipe', flat=True)), [recipe.pk])
+    
     def test_add_recipe_one_ingredient(self):
         location = '/recipes/add/'
         self.client.post('/login/', {'username': self.user.email,
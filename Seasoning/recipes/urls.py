@@ -24,6 +24,7 @@ from recipes.views import EditRecipeWizard
 urlpatterns = patterns('',
     url(r'^$', 'recipes.views.browse_recipes', name='browse_recipes'),
     url(r'^(\d*)/$', 'recipes.views.view_recipe', name='view_recipe'),
+    url(r'^pantry/$', 'recipes.views.pantry', name='pantry'),
    
     url(r'^portions/$', 'recipes.views.get_recipe_portions'),
     url(r'^vote/$', 'recipes.views.vote'),
@@ -37,6 +38,7 @@ urlpatterns = patterns('',
     # Statistical data about recipes
     url(r'^data/fpevo/$', 'recipes.views.get_recipe_footprint_evolution'),
     url(r'^data/fprel/$', 'recipes.views.get_relative_footprint'),
+    url(r'^data/pantry/$', 'recipes.views.get_pantry_recipes'),
     
     url(r'^ingunits/$', 'recipes.views.ajax_ingredient_units'),
     url(r'^markdownpreview/$', 'recipes.views.ajax_markdown_preview'),
@@ -18,7 +18,8 @@ along with Seasoning.  If not, see <http://www.gnu.org/licenses/>.
     
 """
 from django.shortcuts import render, redirect, get_object_or_404
-from recipes.models import Recipe, Vote, UsesIngredient, UnknownIngredient
+from recipes.models import Recipe, Vote, UsesIngredient, UnknownIngredient,\
+    RecipeMonthlyFootprint, RecipeFootprintBucket
 from recipes.forms import AddRecipeForm, UsesIngredientForm, SearchRecipeForm,\
     IngredientInRecipeSearchForm, EditRecipeBasicInfoForm,\
     EditRecipeIngredientsForm, EditRecipeInstructionsForm
@@ -42,11 +43,10 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 import json
 from django.core.serializers.json import DjangoJSONEncoder
-from recipes.forms import IngredientsFormSet
+from recipes.forms import IngredientsFormSet, PantryForm
 from django.core.mail import send_mail
 import datetime
 import ingredients
-from django.db.models.aggregates import Max, Min
 from django.contrib.formtools.wizard.views import SessionWizardView
 from django.utils.decorators import method_decorator
 from django.core.files.storage import FileSystemStorage
@@ -56,6 +56,10 @@ from django import forms
 from general.forms import FormContainer
 from django.contrib.formtools.wizard.forms import ManagementForm
 from ingredients.models import Unit
+from django.views.decorators.http import condition
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from recipes.pantry import split_ingredient_names, resolve_ingredient_names, pantry_recipes
 
 def browse_recipes(request):
     """
@@ -85,7 +89,9 @@ def browse_recipes(request):
             # A simple search with only the recipe name was done (from the homepage)
             search_form.is_valid()
             if 'search_string' in search_form.cleaned_data:
-                recipes_list = Recipe.objects.filter(name__icontains=search_form.cleaned_data['search_string'], accepted=True).order_by('footprint')
+                recipes_list = Recipe.objects.search(search_form.cleaned_data['search_string']).filter(accepted=True)
+                if not recipes_list.ordered:
+                    recipes_list = recipes_list.order_by('footprint')
             else:
                 recipes_list = []
             search_form = SearchRecipeForm()
@@ -117,6 +123,25 @@ def browse_recipes(request):
                                                            'exclude_ingredients_formset': exclude_ingredients_formset,
                                                            'recipes': recipes})
 
+def pantry(request):
+    """
+    Show the recipes that can be made best with the ingredients a user has
+    
+    """
+    results, unknown_ingredients = [], []
+    if 'ingredients' in request.GET:
+        pantry_form = PantryForm(request.GET)
+        if pantry_form.is_valid():
+            ingredient_names = split_ingredient_names(pantry_form.cleaned_data['ingredients'])
+            ingredient_ids, unknown_ingredients = resolve_ingredient_names(ingredient_names)
+            results = pantry_recipes(ingredient_ids)
+    else:
+        pantry_form = PantryForm()
+    
+    return render(request, 'recipes/pantry.html', {'pantry_form': pantry_form,
+                                                   'results': results,
+                                                   'unknown_ingredients': unknown_ingredients})
+
 def view_recipe(request, recipe_id):
     
     recipe = Recipe.objects.select_related('author', 'cuisine').get(pk=recipe_id)
@@ -345,48 +370,55 @@ class EditRecipeWizard(SessionWizardView):
     def done(self, form_list, **kwargs):
         if not self.instance.author:
             self.instance.author = self.request.user
-        # recipe has not been saved yet
-        self.instance.save()
         
         # Check if the ingredients form is present
+        ing_form = None
         for form in form_list:
-            if hasattr(form, 'forms') and 'ingredients' in form.forms:
+            if hasattr(form, 'forms') and 'ingredients' in form.forms and form.forms['ingredients'].has_changed():
                 ing_form = form.forms['ingredients']
-                if ing_form.has_changed():
-                    # Check for unknown ingredients
-                    if ing_form.unknown_ingredients:
-                        request_string = ''
-                        for ingredient_info in ing_form.unknown_ingredients:
-                            request_string += 'Naam ingredient: %s\nGevraagde eenheid: %s\n\n' % (ingredient_info['name'], ingredient_info['unit'])
-                            try:
-                                ingredient = Ingredient.objects.with_name(ingredient_info['name'])
-                                # If this works, the ingredient exists, but isn't accepted
-                            except Ingredient.DoesNotExist:
-                                # An ingredient with the given name does not exist, so we need to add it
-                                ingredient = Ingredient(name=ingredient_info['name'], category=Ingredient.DRINKS, base_footprint=0)
-                                ingredient.save()
-                            if not ingredient.can_use_unit(ingredient_info['unit']):
-                                ingredients.models.CanUseUnit(ingredient=ingredient, unit=ingredient_info['unit'], conversion_factor=0).save()
-                            if not UnknownIngredient.objects.filter(name=ingredient_info['name'], requested_by=self.request.user, real_ingredient=ingredient, for_recipe=self.instance).exists():
-                                UnknownIngredient(name=ingredient_info['name'], requested_by=self.request.user, real_ingredient=ingredient, for_recipe=self.instance).save()
-                        
-                        # revalidate the ingredient forms
-                        for form in ing_form:
-                            # Allow unaccepted ingredients this time around
-                            form.fields['ingredient'].unaccepted_ingredients_allowed = True
-                            form.full_clean()
-                        
-                        # Send mail
-                        send_mail('Aanvraag voor Ingredienten', render_to_string('emails/request_ingredients_email.txt', {'user': self.request.user,
-                                                                                                                          'request_string': request_string}), 
-                                  self.request.user.email,
-                                  ['info@seasoning.be'], fail_silently=True)
-            
-                    ing_form.save()
-                        
-                    # And save the recipe again to update the footprint
-                    recipe = Recipe.objects.select_related().prefetch_related('uses__unit').get(pk=self.instance.pk)
-                    recipe.save()
+        
+        with transaction.commit_on_success():
+            if ing_form is None:
+                self.instance.save()
+            else:
+                # Check for unknown ingredients
+                if ing_form.unknown_ingredients:
+                    if self.instance.pk is None:
+                        # The requests for the unknown ingredients refer to the recipe
+                        self.instance.save()
+                    request_string = ''
+                    for ingredient_info in ing_form.unknown_ingredients:
+                        request_string += 'Naam ingredient: %s\nGevraagde eenheid: %s\n\n' % (ingredient_info['name'], ingredient_info['unit'])
+                        try:
+                            ingredient = Ingredient.objects.with_name(ingredient_info['name'])
+                            # If this works, the ingredient exists, but isn't accepted
+                        except Ingredient.DoesNotExist:
+                            # An ingredient with the given name does not exist, so we need to add it
+                            ingredient = Ingredient(name=ingredient_info['name'], category=Ingredient.DRINKS, base_footprint=0)
+                            ingredient.save()
+                        if not ingredient.can_use_unit(ingredient_info['unit']):
+                            ingredients.models.CanUseUnit(ingredient=ingredient, unit=ingredient_info['unit'], conversion_factor=0).save()
+                        if not UnknownIngredient.objects.filter(name=ingredient_info['name'], requested_by=self.request.user, real_ingredient=ingredient, for_recipe=self.instance).exists():
+                            UnknownIngredient(name=ingredient_info['name'], requested_by=self.request.user, real_ingredient=ingredient, for_recipe=self.instance).save()
+                    
+                    # revalidate the ingredient forms
+                    for form in ing_form:
+                        # Allow unaccepted ingredients this time around
+                        form.fields['ingredient'].unaccepted_ingredients_allowed = True
+                        form.full_clean()
+                    
+                    # Send mail
+                    send_mail('Aanvraag voor Ingredienten', render_to_string('emails/request_ingredients_email.txt', {'user': self.request.user,
+                                                                                                                      'request_string': request_string}), 
+                              self.request.user.email,
+                              ['info@seasoning.be'], fail_silently=True)
+                
+                # Write the recipe and all of its ingredients at once (the formset deletes the
+                # removed ingredients itself)
+                ing_form.save(commit=False)
+                usess = [form.instance for form in ing_form.initial_forms if form not in ing_form.deleted_forms]
+                usess.extend(ing_form.new_objects)
+                self.instance.save_with_ingredients(usess)
         
         messages.add_message(self.request, messages.INFO, 'Je nieuwe recept werd met succes toegevoegd!')
         return redirect('/recipes/%d/' % self.instance.id)
@@ -476,32 +508,49 @@ def get_recipe_portions(request):
     
     raise PermissionDenied
 
+def recipe_footprint_evolution_last_modified(request):
+    """
+    The evolution of a recipe changes when it is recomputed, and the current day of the
+    year that is sent along with it changes at midnight
+    
+    """
+    recipe_id = request.REQUEST.get('recipe', None)
+    try:
+        time_updated = RecipeMonthlyFootprint.objects.filter(recipe=recipe_id).values_list('time_updated', flat=True)[0]
+    except (IndexError, ValueError):
+        return None
+    return max(time_updated, datetime.datetime.combine(datetime.date.today(), datetime.time()))
+
 @csrf_exempt
+@condition(last_modified_func=recipe_footprint_evolution_last_modified)
 def get_recipe_footprint_evolution(request):
     
-    if request.is_ajax() and request.method == 'POST':
-        recipe_id = request.POST.get('recipe', None)
+    if request.is_ajax() and request.method in ('GET', 'POST'):
+        recipe_id = request.REQUEST.get('recipe', None)
     
         if recipe_id is not None:
             try:
-                recipe = Recipe.objects.get(pk=recipe_id)
-                usess = UsesIngredient.objects.select_related('ingredient', 'unit__parent_unit').prefetch_related('ingredient__available_in_country', 'ingredient__available_in_sea', 'ingredient__canuseunit_set__unit__parent_unit').filter(recipe=recipe).order_by('group', 'ingredient__name')
-                # One footprint per month
-                footprints = [0] * 12
-                dates = [datetime.date(day=1, month=month, year=ingredients.models.AvailableIn.BASE_YEAR) for month in range(1, 13)]
-                for uses in usess:
-                    for i in range(12):
-                        footprints[i] += uses.normalized_footprint(uses.ingredient.footprint(date=dates[i]))
-                footprints = [float('%.2f' % (4*footprint/recipe.portions)) for footprint in footprints]
-                footprints.append(footprints[-1])
-                footprints.insert(0, footprints[0])
-                data = {'footprints': footprints,
-                        'doy': datetime.date.today().timetuple().tm_yday}
-                json_data = simplejson.dumps(data)
+                evolution = RecipeMonthlyFootprint.objects.get(recipe=recipe_id)
+            except (RecipeMonthlyFootprint.DoesNotExist, ValueError):
+                # The evolution has not been calculated since the recipe was last saved
+                if not Recipe.objects.filter(pk=recipe_id).exists():
+                    raise Http404
+                from recipes.engine import update_monthly_footprints
+                update_monthly_footprints(recipe_ids=[recipe_id])
+                evolution = RecipeMonthlyFootprint.objects.get(recipe=recipe_id)
             
-                return HttpResponse(json_data)
-            except Recipe.DoesNotExist, UsesIngredient.DoesNotExist:
-                raise Http404
+            # One footprint per month
+            footprints = [float('%.2f' % (4*footprint)) for footprint in evolution.monthly_footprints()]
+            footprints.append(footprints[-1])
+            footprints.insert(0, footprints[0])
+            data = {'footprints': footprints,
+                    'doy': datetime.date.today().timetuple().tm_yday}
+            json_data = simplejson.dumps(data)
+            
+            response = HttpResponse(json_data)
+            # Browsers have to check whether the evolution has changed before using their copy
+            patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+            return response
         
     raise PermissionDenied
 
@@ -514,41 +563,14 @@ def get_relative_footprint(request):
         if recipe_id is not None:
             try:
                 recipe = Recipe.objects.get(pk=recipe_id)
-                bounds = Recipe.objects.aggregate(Max('footprint'), Min('footprint'))
-                min_fp = 4*bounds['footprint__min']
-                max_fp = 4*bounds['footprint__max']
-                interval_count = 10
-                interval_length = (max_fp-min_fp)/interval_count
-                recipes = Recipe.objects.values('footprint', 'course', 'veganism').all().order_by('footprint')
-                
-                intervals = [min_fp+i*interval_length for i in range(interval_count+1)]
-                all_footprints = []
-                category_footprints = []
-                veganism_footprints = []
-                
-                footprint_index = 0
-                for upper_bound in intervals[1:]:
-                    # Don't check the first value in the intervals, because we only need upper bounds
-                    # of intervals
-                    all_footprints.append(0)
-                    category_footprints.append(0)
-                    veganism_footprints.append(0)
-                    while 4*recipes[footprint_index]['footprint'] <= upper_bound:
-                        all_footprints[-1] += 1
-                        if recipe.course == recipes[footprint_index]['course']:
-                            category_footprints[-1] += 1
-                        if recipe.veganism == recipes[footprint_index]['veganism']:
-                            veganism_footprints[-1] += 1
-                        footprint_index += 1
-                        if footprint_index >= len(recipes):
-                            break
-                data = {'all_fps': all_footprints,
-                        'cat_fps': category_footprints,
-                        'veg_fps': veganism_footprints,
-                        'min_fp': min_fp,
-                        'max_fp': max_fp,
-                        'interval_length': interval_length,
-                        'fp': 4*recipe.footprint}
+                # The histograms are read from the footprint buckets, which are kept up to date
+                # when recipes change
+                data = RecipeFootprintBucket.objects.histogram(recipe.course, recipe.veganism)
+                if data is None:
+                    # The buckets have never been counted
+                    RecipeFootprintBucket.objects.rebuild()
+                    data = RecipeFootprintBucket.objects.histogram(recipe.course, recipe.veganism)
+                data['fp'] = 4*recipe.footprint
                 json_data = simplejson.dumps(data)
             
                 return HttpResponse(json_data)
@@ -558,6 +580,32 @@ def get_relative_footprint(request):
         
     raise PermissionDenied
 
+def get_pantry_recipes(request):
+    """
+    The pantry search as JSON: the recipes that can be made best with the comma separated
+    ingredients in the 'ingredients' parameter, with the fraction of their ingredients
+    that is covered
+    
+    """
+    if request.is_ajax() and request.method == 'GET':
+        ingredient_ids, unknown_ingredients = resolve_ingredient_names(split_ingredient_names(request.GET.get('ingredients', '')))
+        try:
+            limit = min(int(request.GET.get('limit', 12)), 100)
+        except ValueError:
+            limit = 12
+        
+        results = pantry_recipes(ingredient_ids, limit=max(limit, 1))
+        data = {'recipes': [{'id': recipe.id,
+                             'name': recipe.name,
+                             'url': '/recipes/%d/' % recipe.id,
+                             'coverage': round(coverage, 2),
+                             'footprint': float('%.2f' % recipe.normalized_footprint())}
+                            for recipe, coverage in results],
+                'unknown': unknown_ingredients}
+        return HttpResponse(simplejson.dumps(data), content_type='application/json')
+    
+    raise PermissionDenied
+
 @csrf_exempt
 def ajax_ingredient_units(request):
     if request.method == 'POST' and request.is_ajax():